@@ -0,0 +1,96 @@
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List
+
+from prometheus_client import Histogram
+
+BATCH_SIZE_HISTOGRAM = Histogram('batch_size',
+                                 'Number of requests per forward pass',
+                                 labelnames=('queue', ),
+                                 buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+QUEUE_WAIT_HISTOGRAM = Histogram(
+    'batch_queue_wait_seconds',
+    'Time a request waits in the batching queue',
+    labelnames=('queue', ),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+class BatchQueue:
+
+    def __init__(self,
+                 process_batch: Callable[[List[Any]], List[Any]],
+                 group_key: Callable[[Any], Hashable],
+                 max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0,
+                 name: str = 'default'):
+        assert max_batch_size > 0
+        self.process_batch = process_batch
+        self.group_key = group_key
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.queue = None
+        self.worker = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, item: Any):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        pending = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self.queue.get(),
+                                                      timeout))
+            except asyncio.TimeoutError:
+                break
+        return pending
+
+    async def _run_group(self, group: List[tuple]):
+        loop = asyncio.get_running_loop()
+        now = time.perf_counter()
+        for _, _, enqueued in group:
+            QUEUE_WAIT_HISTOGRAM.labels(self.name).observe(now - enqueued)
+        BATCH_SIZE_HISTOGRAM.labels(self.name).observe(len(group))
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self.process_batch,
+                [item for item, _, _ in group])
+        except Exception as error:
+            for _, future, _ in group:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future, _), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _run(self):
+        while True:
+            groups = defaultdict(list)
+            for entry in await self._collect():
+                groups[self.group_key(entry[0])].append(entry)
+            for group in groups.values():
+                await self._run_group(group)
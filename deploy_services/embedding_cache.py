@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+
+def cache_key(content_key: str, embedding_type: str, namespace: str):
+    return hashlib.sha1(
+        f'{namespace}:{embedding_type}:{content_key}'.encode()).hexdigest()
+
+
+def entry_size(embedding_info: dict):
+    return sum(value.nbytes for value in embedding_info.values()
+               if isinstance(value, np.ndarray)) + 256
+
+
+class DiskSpill:
+
+    # files are read and written by the caller's thread; the lock only guards
+    # the LRU bookkeeping, never file I/O
+    def __init__(self, spill_dir: str, max_bytes: int):
+        self.spill_dir = Path(spill_dir)
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()
+        for tmp_file in self.spill_dir.glob('*.tmp'):
+            tmp_file.unlink(missing_ok=True)
+        for spill_file in sorted(self.spill_dir.glob('*.npz'),
+                                 key=lambda f: f.stat().st_mtime):
+            self.files[spill_file.stem] = spill_file.stat().st_size
+        self.total_bytes = sum(self.files.values())
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.files:
+                return None
+            self.files.move_to_end(key)
+        try:
+            with np.load(self.spill_dir / f'{key}.npz') as data:
+                embedding_info = json.loads(str(data['metadata']))
+                embedding_info.update(
+                    {k: data[k]
+                     for k in data.files if k != 'metadata'})
+        except FileNotFoundError:
+            # evicted by a concurrent put after the lookup
+            return None
+        return embedding_info
+
+    def put(self, key: str, embedding_info: dict):
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+                return
+        spill_file = self.spill_dir / f'{key}.npz'
+        arrays = {
+            k: v
+            for k, v in embedding_info.items() if isinstance(v, np.ndarray)
+        }
+        metadata = {k: v for k, v in embedding_info.items() if k not in arrays}
+        # written under a unique name and moved into place, so a concurrent
+        # get never reads a partial file
+        tmp_file = spill_file.with_suffix(f'.{uuid.uuid4().hex}.tmp')
+        with open(tmp_file, 'wb') as fp:
+            np.savez(fp, metadata=json.dumps(metadata), **arrays)
+        size = tmp_file.stat().st_size
+        os.replace(tmp_file, spill_file)
+        evicted_keys = []
+        with self.lock:
+            if key not in self.files:
+                self.files[key] = size
+                self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.files) > 1:
+                evicted, evicted_size = self.files.popitem(last=False)
+                evicted_keys.append(evicted)
+                self.total_bytes -= evicted_size
+        for evicted in evicted_keys:
+            (self.spill_dir / f'{evicted}.npz').unlink(missing_ok=True)
+
+    def put_many(self, entries: list):
+        for key, embedding_info in entries:
+            self.put(key, embedding_info)
+
+
+class EmbeddingCache:
+
+    # the in-memory LRU is updated under the lock; spill reads and writes run
+    # on a worker thread after it is released, off the event loop
+    def __init__(self,
+                 max_bytes: int,
+                 spill_dir: Optional[str] = None,
+                 spill_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.spill = DiskSpill(spill_dir,
+                               spill_max_bytes) if spill_dir else None
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        logger.info(f'Embedding cache: {max_bytes / 2**20:.0f} MiB in memory'
+                    f', spill: {spill_dir}')
+
+    async def get(self, key: str):
+        with self.lock:
+            embedding_info = self.entries.get(key)
+            if embedding_info is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding_info
+        if self.spill is not None:
+            embedding_info = await asyncio.to_thread(self.spill.get, key)
+        with self.lock:
+            if embedding_info is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            spilled = self._put(key, embedding_info)
+        await self._spill(spilled)
+        return embedding_info
+
+    async def put(self, key: str, embedding_info: dict):
+        with self.lock:
+            spilled = self._put(key, embedding_info)
+        await self._spill(spilled)
+
+    async def _spill(self, spilled: list):
+        if spilled and self.spill is not None:
+            await asyncio.to_thread(self.spill.put_many, spilled)
+
+    def _put(self, key: str, embedding_info: dict):
+        # returns the (key, entry) pairs that leave memory for the spill
+        size = entry_size(embedding_info)
+        if key in self.entries:
+            self.total_bytes -= entry_size(self.entries.pop(key))
+        if size > self.max_bytes:
+            return [(key, embedding_info)]
+        self.entries[key] = embedding_info
+        self.total_bytes += size
+        spilled = []
+        while self.total_bytes > self.max_bytes:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= entry_size(evicted)
+            spilled.append((evicted_key, evicted))
+        return spilled
@@ -0,0 +1,220 @@
+import contextlib
+import os
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+from loguru import logger
+from PIL import Image
+from torchvision.transforms import v2
+
+EMBEDDING_TYPES = ('image', 'patch', 'combined')
+DINOV2_HUB_REPO = 'facebookresearch/dinov2'
+
+
+def build_transform(image_size: int):
+    return v2.Compose([
+        v2.Resize(size=image_size),
+        v2.ToTensor(),
+        v2.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
+    ])
+
+
+def preprocess(image: Image.Image, transform: v2.Compose, patch_size: int,
+               embedding_type: str):
+    assert embedding_type in EMBEDDING_TYPES
+    trns_img = transform(image)
+    _, height, width = trns_img.size()
+    trns_img = trns_img[:, :(height // patch_size) *
+                        patch_size, :(width // patch_size) * patch_size]
+    return dict(tensor=trns_img,
+                image_shape=[height, width],
+                embedding_type=embedding_type)
+
+
+def batch_key(item: dict):
+    # one forward pass yields both the CLS and patch tokens, so requests of
+    # any embedding type share a batch
+    return tuple(item['tensor'].shape)
+
+
+class DinoV2Embedder(torch.nn.Module):
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+        self.patch_size = model.patch_size
+        self.embed_dim = model.embed_dim
+
+    def forward(self, images: torch.Tensor):
+        features = self.model.forward_features(images)
+        return (self.model.head(features['x_norm_clstoken']),
+                features['x_norm_patchtokens'])
+
+
+class TracedEmbedder(torch.nn.Module):
+    # positional embeddings are interpolated with Python arithmetic on the
+    # input size, so one trace is recorded per input shape. Batches are
+    # zero-padded to a few bucket sizes so that micro-batches of every size
+    # share traces, and the least recently used trace is dropped once
+    # max_traces are kept
+    def __init__(self, embedder: DinoV2Embedder, max_traces: int = 16):
+        super().__init__()
+        self.embedder = embedder
+        self.patch_size = embedder.patch_size
+        self.embed_dim = embedder.embed_dim
+        self.max_traces = max_traces
+        self.traced = OrderedDict()
+
+    @staticmethod
+    def bucket_size(batch_size: int):
+        # 1, 2, 4, 8, then multiples of 8
+        if batch_size <= 8:
+            return 1 << (batch_size - 1).bit_length()
+        return -(-batch_size // 8) * 8
+
+    def forward(self, images: torch.Tensor):
+        batch_size = len(images)
+        padding = self.bucket_size(batch_size) - batch_size
+        if padding:
+            images = torch.cat(
+                [images, images.new_zeros((padding, *images.shape[1:]))])
+        shape = tuple(images.shape)
+        if shape in self.traced:
+            self.traced.move_to_end(shape)
+        else:
+            logger.info(f'Trace embedder for input shape: {shape}')
+            self.traced[shape] = torch.jit.freeze(
+                torch.jit.trace(self.embedder, images, check_trace=False))
+            if len(self.traced) > self.max_traces:
+                self.traced.popitem(last=False)
+        image_features, patch_features = self.traced[shape](images)
+        return image_features[:batch_size], patch_features[:batch_size]
+
+
+def configure_threads(num_threads: Optional[int] = None,
+                      num_interop_threads: Optional[int] = None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        torch.set_num_interop_threads(num_interop_threads)
+    logger.info(f'Torch intra-op threads: {torch.get_num_threads()} '
+                f'inter-op threads: {torch.get_num_interop_threads()}')
+
+
+def default_hub_dir():
+    return os.path.join(torch.hub.get_dir(), 'facebookresearch_dinov2_main')
+
+
+def load_model(model_name: str,
+               device: torch.device,
+               weights_file: Optional[str] = None,
+               hub_dir: Optional[str] = None):
+    if weights_file is None:
+        logger.info(f'Start Loading DinoV2:{model_name}!')
+        model = torch.hub.load(DINOV2_HUB_REPO, model_name)
+        return model.to(device).eval()
+    # the architecture comes from a local checkout of the hub repo and the
+    # weights are memory-mapped from the snapshot: no download, no copy
+    hub_dir = hub_dir or default_hub_dir()
+    logger.info(f'Start Loading DinoV2:{model_name} from {weights_file} '
+                f'(code: {hub_dir})')
+    snapshot = torch.load(weights_file,
+                          mmap=True,
+                          weights_only=True,
+                          map_location='cpu')
+    assert snapshot['model'] == model_name, (
+        f'{weights_file} holds {snapshot["model"]}, not {model_name}')
+    with torch.device('meta'):
+        model = torch.hub.load(hub_dir,
+                               model_name,
+                               source='local',
+                               pretrained=False)
+    model.load_state_dict(snapshot['state_dict'], assign=True)
+    return model.to(device).eval()
+
+
+def save_model_snapshot(model: torch.nn.Module, model_name: str,
+                        weights_file: str):
+    torch.save(dict(model=model_name, state_dict=model.state_dict()),
+               weights_file)
+    logger.info(f'Save DinoV2:{model_name} snapshot: {weights_file}')
+
+
+def build_embedder(model: torch.nn.Module,
+                   device: torch.device,
+                   precision: str = 'fp32',
+                   compile_mode: str = 'none',
+                   max_traces: int = 16):
+    assert precision in ('fp32', 'bf16', 'int8')
+    assert compile_mode in ('none', 'trace', 'compile')
+    if precision == 'int8':
+        assert device.type == 'cpu', 'int8 dynamic quantization is CPU only'
+        model = torch.ao.quantization.quantize_dynamic(model,
+                                                       {torch.nn.Linear},
+                                                       dtype=torch.qint8)
+    embedder = DinoV2Embedder(model).eval()
+    if compile_mode == 'trace':
+        embedder = TracedEmbedder(embedder, max_traces=max_traces)
+    elif compile_mode == 'compile':
+        compiled = torch.compile(embedder, dynamic=True)
+        compiled.patch_size = embedder.patch_size
+        compiled.embed_dim = embedder.embed_dim
+        embedder = compiled
+    return embedder
+
+
+def autocast(device: torch.device, precision: str):
+    if precision != 'bf16':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
+@torch.inference_mode()
+def forward_batch(embedder: torch.nn.Module,
+                  items: List[dict],
+                  device: torch.device,
+                  precision: str = 'fp32'):
+    assert all(batch_key(item) == batch_key(items[0]) for item in items)
+    patch_size = embedder.patch_size
+    batch = torch.stack([item['tensor'] for item in items]).to(device)
+    with autocast(device, precision):
+        image_features, patch_features = embedder(batch)
+    image_features = image_features.float().cpu().numpy()
+    patch_features = patch_features.float().cpu().numpy()
+
+    results = []
+    for item, image_feature, patch_feature in zip(items, image_features,
+                                                  patch_features):
+        height, width = item['image_shape']
+        grid_shape = (height // patch_size, width // patch_size)
+        if item['embedding_type'] == 'image':
+            result = dict(embedding=image_feature,
+                          embedding_shape=(1, image_feature.shape[-1]))
+        else:
+            result = dict(embedding=patch_feature,
+                          embedding_shape=(*grid_shape,
+                                           patch_feature.shape[-1]))
+            if item['embedding_type'] == 'combined':
+                result['image_embedding'] = image_feature
+        results.append(
+            dict(**result, image_shape=[height, width], patch_size=patch_size))
+    return results
+
+
+def warm_up(embedder: torch.nn.Module,
+            device: torch.device,
+            image_size: int,
+            precision: str = 'fp32',
+            iterations: int = 2):
+    patch_size = embedder.patch_size
+    size = (image_size // patch_size) * patch_size
+    items = [
+        dict(tensor=torch.zeros(3, size, size),
+             image_shape=[image_size, image_size],
+             embedding_type='image')
+    ]
+    for _ in range(iterations):
+        forward_batch(embedder, items, device=device, precision=precision)
+    logger.info(f'Warm up embedder with {iterations} iterations '
+                f'on input {size}x{size}')
@@ -1,14 +1,26 @@
-import io
+import asyncio
+import importlib
+import os
 from argparse import ArgumentParser
-from typing import Optional
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
 
-import torch
 import uvicorn
-from fastapi import FastAPI
+from fastapi import APIRouter, Depends, FastAPI, Header, Response
+from fastapi.responses import StreamingResponse
 from loguru import logger
-from PIL import Image, ImageOps
+from prometheus_client import Info
 from pydantic import BaseModel
-from torchvision.transforms import v2
+
+from batching import BatchQueue
+from image_loader import ImageLoader
+from lifecycle import Readiness, add_health_routes
+from telemetry import (executor_queue_size, instrument_app, stage,
+                       track_cache, track_queue)
+from wire_format import (encode_embedding, encode_frame, negotiate,
+                         stream_media_type)
 
 
 def arg_parse():
@@ -18,99 +30,318 @@ def arg_parse():
     parser.add_argument('--apply-gs', action='store_true')
     parser.add_argument('--gs-bucket-name', type=str, required=None)
     parser.add_argument('--gs-credential', type=str, required=None)
+    parser.add_argument('--gs-fake-bucket-dir', type=str, default=None)
+    parser.add_argument('--gs-pool-size', type=int, default=32)
+    parser.add_argument('--gs-max-prefetch', type=int, default=256)
+    parser.add_argument('--gs-cache-dir', type=str, default=None)
+    parser.add_argument('--gs-cache-bytes', type=int, default=10 * 2**30)
     parser.add_argument('--image-size', type=int, default=448)
+    parser.add_argument('--model', type=str, default='dinov2_vitb14')
+    parser.add_argument('--weights-file',
+                        type=str,
+                        default=None,
+                        help='model snapshot written by '
+                        'tools/export_snapshot.py; loaded with mmap instead '
+                        'of fetching the model from torch hub')
+    parser.add_argument('--hub-dir',
+                        type=str,
+                        default=None,
+                        help='local checkout of facebookresearch/dinov2 '
+                        '(default: the torch hub cache)')
+    parser.add_argument('--device',
+                        type=str,
+                        default=None,
+                        help='default: cuda:0 when available, else cpu')
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--num-interop-threads', type=int, default=None)
+    parser.add_argument('--precision',
+                        type=str,
+                        default='fp32',
+                        choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument('--compile',
+                        type=str,
+                        default='none',
+                        choices=['none', 'trace', 'compile'])
+    parser.add_argument('--max-traces',
+                        type=int,
+                        default=16,
+                        help='--compile trace: traced graphs kept, one per '
+                        'input size and padded batch size')
+    parser.add_argument('--warmup-iters', type=int, default=2)
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-batch-wait-ms', type=float, default=5.0)
+    parser.add_argument('--preprocess-mode',
+                        type=str,
+                        default='thread',
+                        choices=['thread', 'process'])
+    parser.add_argument('--preprocess-workers',
+                        type=int,
+                        default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--io-workers', type=int, default=16)
+    parser.add_argument('--batch-concurrency', type=int, default=64)
+    parser.add_argument('--no-draft', action='store_true')
     return parser.parse_args()
 
 
-class ImageLoader:
+class ImageInfo(BaseModel):
+    image_path: str
+
 
-    def __init__(self,
-                 apply_gs: bool = False,
-                 gs_bucket_name: Optional[str] = None,
-                 gs_credential: Optional[str] = None):
-        self.apply_gs = apply_gs
-        if self.apply_gs:
-            from google.cloud import storage
-            storage_client = storage.Client.from_service_account_json(
-                gs_credential)
-            self.bucket = storage_client.bucket(gs_bucket_name)
+class ImageBatch(BaseModel):
+    image_paths: List[str]
 
-    def load(self, img_file):
-        if not self.apply_gs:
-            image = Image.open(img_file)
-        else:
-            blob = self.bucket.blob(img_file)
-            image_content = io.BytesIO(blob.download_as_bytes())
-            image = Image.open(image_content)
-        image = ImageOps.exif_transpose(image)
-        return image
 
+args = None
+readiness: Optional[Readiness] = None
+preprocess_executor = io_executor = None
+device = dinov2_embedder = img_loader = batch_queue = None
+# torch and torchvision take seconds to import; the modules that need them
+# are imported by the background load, after the server is bound
+embedding_model = preprocessing = None
+patch_size = embedding_dim = None
 
-class ImageInfo(BaseModel):
-    image_path: str
+
+def run_dinov2_batch(items: List[dict]):
+    with stage('forward'):
+        return embedding_model.forward_batch(dinov2_embedder,
+                                             items,
+                                             device=device,
+                                             precision=args.precision)
+
+
+def load_services():
+    # runs on a worker thread while the server already answers probes
+    global device, dinov2_embedder, patch_size, embedding_dim, img_loader
+    import torch
+    device = torch.device(args.device or (
+        'cuda:0' if torch.cuda.is_available() else 'cpu'))
+    embedding_model.configure_threads(
+        num_threads=args.num_threads,
+        num_interop_threads=args.num_interop_threads)
+    dinov2_model = embedding_model.load_model(model_name=args.model,
+                                              device=device,
+                                              weights_file=args.weights_file,
+                                              hub_dir=args.hub_dir)
+    dinov2_embedder = embedding_model.build_embedder(
+        dinov2_model,
+        device=device,
+        precision=args.precision,
+        compile_mode=args.compile,
+        max_traces=args.max_traces)
+
+    patch_size = dinov2_model.patch_size
+    embedding_dim = dinov2_model.embed_dim
+    logger.info(
+        f'Finish Loading DinoV2:{args.model}: patch-size: {patch_size} embedding: {embedding_dim} '
+        f'device: {device} precision: {args.precision} compile: {args.compile}'
+    )
+    embedding_model.warm_up(dinov2_embedder,
+                            device=device,
+                            image_size=args.image_size,
+                            precision=args.precision,
+                            iterations=args.warmup_iters)
+
+    logger.info('Start setting ImageLoader')
+    img_loader = ImageLoader(apply_gs=args.apply_gs,
+                             gs_bucket_name=args.gs_bucket_name,
+                             gs_credential=args.gs_credential,
+                             fake_bucket_dir=args.gs_fake_bucket_dir,
+                             pool_size=args.gs_pool_size,
+                             max_prefetch=args.gs_max_prefetch,
+                             cache_dir=args.gs_cache_dir,
+                             cache_bytes=args.gs_cache_bytes)
+    Info('embedding_model', 'Loaded embedding model').info(
+        dict(model=args.model,
+             device=str(device),
+             precision=args.precision,
+             compile=args.compile,
+             image_size=str(args.image_size),
+             patch_size=str(patch_size),
+             embedding_dim=str(embedding_dim)))
+    track_cache('image_disk', img_loader.cache)
+
+
+async def start_services():
+    global embedding_model, preprocessing, preprocess_executor, batch_queue
+    preprocessing = await asyncio.to_thread(importlib.import_module,
+                                            'preprocessing')
+    embedding_model = importlib.import_module('embedding_model')
+    # worker processes fork on the event loop thread, before the model and
+    # torch thread pools exist
+    preprocess_executor = preprocessing.build_preprocess_executor(
+        mode=args.preprocess_mode, num_workers=args.preprocess_workers)
+    track_queue('preprocess', executor_queue_size(preprocess_executor))
+    await asyncio.to_thread(load_services)
+    batch_queue = BatchQueue(process_batch=run_dinov2_batch,
+                             group_key=embedding_model.batch_key,
+                             max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_batch_wait_ms,
+                             name='dinov2')
+    batch_queue.start()
+    track_queue('dinov2_batch', lambda: batch_queue.queue.qsize())
+    logger.info('Start Serving!')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global io_executor
+    io_executor = ThreadPoolExecutor(max_workers=args.io_workers,
+                                     thread_name_prefix='image-io')
+    track_queue('image_io', executor_queue_size(io_executor))
+    readiness.start(start_services)
+    yield
+    await readiness.stop()
+    if batch_queue is not None:
+        await batch_queue.stop()
+    if preprocess_executor is not None:
+        preprocess_executor.shutdown(wait=False)
+    io_executor.shutdown(wait=False)
+    if img_loader is not None:
+        img_loader.close()
+
+
+async def require_ready():
+    await readiness.require()
+
+
+router = APIRouter(dependencies=[Depends(require_ready)])
+
+
+async def load_item(image_path: str, embedding_type: str):
+    # reading, decoding and resizing run on worker pools, so images of the
+    # next batch are prepared while the current batch is in the model
+    loop = asyncio.get_running_loop()
+    with stage('image_load'):
+        content = await loop.run_in_executor(io_executor, img_loader.read,
+                                             image_path)
+    with stage('preprocess'):
+        return await loop.run_in_executor(
+            preprocess_executor,
+            partial(preprocessing.decode_and_preprocess,
+                    content,
+                    image_size=args.image_size,
+                    patch_size=patch_size,
+                    embedding_type=embedding_type,
+                    draft=not args.no_draft))
+
+
+async def generate_embedding(image_path: str, embedding_type: str = 'image'):
+    item = await load_item(image_path, embedding_type=embedding_type)
+    return await batch_queue.submit(item)
+
+
+def embedding_response(embedding_info: dict, accept: Optional[str]):
+    media_type, dtype = negotiate(accept)
+    content, headers = encode_embedding(embedding_info,
+                                        media_type=media_type,
+                                        dtype=dtype)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+@router.get('/model-info/')
+async def model_info():
+    return dict(model=args.model,
+                image_size=args.image_size,
+                precision=args.precision,
+                patch_size=patch_size,
+                embedding_dim=embedding_dim)
+
+
+@router.post('/generate-image-embedding/')
+async def generate_image_embedding(img_info: ImageInfo,
+                                   accept: Optional[str] = Header(None)):
+    embedding_info = await generate_embedding(img_info.image_path,
+                                              embedding_type='image')
+    return embedding_response(embedding_info, accept)
+
+
+@router.post('/generate-patch-embedding/')
+async def generate_patch_embedding(img_info: ImageInfo,
+                                   accept: Optional[str] = Header(None)):
+    embedding_info = await generate_embedding(img_info.image_path,
+                                              embedding_type='patch')
+    return embedding_response(embedding_info, accept)
+
+
+@router.post('/generate-embedding/')
+async def generate_combined_embedding(img_info: ImageInfo,
+                                      accept: Optional[str] = Header(None)):
+    embedding_info = await generate_embedding(img_info.image_path,
+                                              embedding_type='combined')
+    return embedding_response(embedding_info, accept)
+
+
+async def stream_embeddings(image_paths: List[str], embedding_type: str,
+                            media_type: str, dtype: str):
+    semaphore = asyncio.Semaphore(args.batch_concurrency)
+
+    async def run(index: int, image_path: str):
+        frame = dict(index=index, image_path=image_path)
+        try:
+            async with semaphore:
+                frame.update(await generate_embedding(
+                    image_path, embedding_type=embedding_type))
+        except Exception as error:
+            # a bad image is reported in its own frame, the batch goes on
+            logger.warning(f'Embedding failed for {image_path}: {error!r}')
+            frame['error'] = repr(error)
+        return frame
+
+    img_loader.prefetch(image_paths)
+    tasks = [
+        asyncio.create_task(run(index, image_path))
+        for index, image_path in enumerate(image_paths)
+    ]
+    try:
+        # frames are sent as images finish, not in request order
+        for task in asyncio.as_completed(tasks):
+            yield encode_frame(await task, media_type=media_type, dtype=dtype)
+    finally:
+        for task in tasks:
+            task.cancel()
+        img_loader.release_prefetch(image_paths)
+
+
+def batch_response(img_batch: ImageBatch, embedding_type: str,
+                   accept: Optional[str]):
+    media_type, dtype = negotiate(accept)
+    media_type = stream_media_type(media_type)
+    return StreamingResponse(stream_embeddings(img_batch.image_paths,
+                                               embedding_type=embedding_type,
+                                               media_type=media_type,
+                                               dtype=dtype),
+                             media_type=media_type)
+
+
+@router.post('/generate-image-embedding/batch')
+async def generate_image_embedding_batch(
+    img_batch: ImageBatch, accept: Optional[str] = Header(None)):
+    return batch_response(img_batch, embedding_type='image', accept=accept)
+
+
+@router.post('/generate-patch-embedding/batch')
+async def generate_patch_embedding_batch(
+    img_batch: ImageBatch, accept: Optional[str] = Header(None)):
+    return batch_response(img_batch, embedding_type='patch', accept=accept)
+
+
+@router.post('/generate-embedding/batch')
+async def generate_combined_embedding_batch(
+    img_batch: ImageBatch, accept: Optional[str] = Header(None)):
+    return batch_response(img_batch, embedding_type='combined', accept=accept)
 
 
-app = FastAPI()
-args = arg_parse()
-
-logger.info(f'Start Loading DinoV2:dinov2_vitb14!')
-dinov2_model = torch.hub.load('facebookresearch/dinov2',
-                              'dinov2_vitb14').to(torch.device('cuda:0'))
-
-patch_size = dinov2_model.patch_size
-embedding_dim = dinov2_model.embed_dim
-logger.info(
-    f'Finish Loading DinoV2:dinov2_vitb14: patch-size: {patch_size} embedding: {embedding_dim}'
-)
-
-img_transform = v2.Compose([
-    v2.Resize(size=args.image_size),
-    v2.ToTensor(),
-    v2.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
-])
-
-logger.info('Start setting ImageLoader')
-img_loader = ImageLoader(apply_gs=args.apply_gs,
-                         gs_bucket_name=args.gs_bucket_name,
-                         gs_credential=args.gs_credential)
-logger.info('Start Serving!')
-
-
-@torch.inference_mode()
-def generate_embedding(image: Image.Image, embedding_type: str = 'image'):
-    assert embedding_type in ('image', 'patch')
-    trns_img = img_transform(image)
-    _, height, width = trns_img.size()
-    trns_img = trns_img[:, :(height // patch_size) *
-                        patch_size, :(width // patch_size) *
-                        patch_size].unsqueeze(0).to(torch.device('cuda:0'))
-    if embedding_type == 'image':
-        features = dinov2_model(trns_img)
-        grid_shape = (1, )
-    else:
-        features = dinov2_model.forward_features(
-            trns_img)['x_norm_patchtokens']
-        grid_shape = (height // patch_size, width // patch_size)
-
-    return dict(embedding=features[0].cpu().numpy().tolist(),
-                embedding_shape=(*grid_shape, features.size(-1)),
-                image_shape=[height, width],
-                patch_size=patch_size)
-
-
-@app.post('/generate-image-embedding/')
-async def generate_image_embedding(img_info: ImageInfo):
-    image = img_loader.load(img_file=img_info.image_path)
-    embedding_info = generate_embedding(image, embedding_type='image')
-    return embedding_info
-
-
-@app.post('/generate-patch-embedding/')
-async def generate_patch_embedding(img_info: ImageInfo):
-    image = img_loader.load(img_file=img_info.image_path)
-    embedding_info = generate_embedding(image, embedding_type='patch')
-    return embedding_info
+def create_app(cli_args=None):
+    global args, readiness
+    args = cli_args or arg_parse()
+    readiness = Readiness('embedding')
+    app = FastAPI(lifespan=lifespan)
+    instrument_app(app, service='embedding')
+    add_health_routes(app, readiness)
+    app.include_router(router)
+    return app
 
 
 if __name__ == '__main__':
+    app = create_app()
     uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,77 @@
+from typing import List, Optional
+
+import numpy as np
+
+
+def search_patch_hits(db,
+                      focus_embedding: np.ndarray,
+                      top_m: int,
+                      chunk_size: int = 256,
+                      search_params: Optional[dict] = None):
+    hit_image_ids, hit_scores, hit_queries = [], [], []
+    for start in range(0, len(focus_embedding), chunk_size):
+        results = db.search(collection_name='patch_embeddings',
+                            data=focus_embedding[start:start + chunk_size],
+                            output_fields=['image_id'],
+                            search_params=search_params or
+                            {'metric_type': 'COSINE'},
+                            limit=top_m)
+        for query_index, hits in enumerate(results, start=start):
+            hit_image_ids.extend(hit['entity']['image_id'] for hit in hits)
+            hit_scores.extend(hit['distance'] for hit in hits)
+            hit_queries.extend([query_index] * len(hits))
+    return (np.asarray(hit_image_ids), np.asarray(hit_scores,
+                                                  dtype=np.float32),
+            np.asarray(hit_queries, dtype=np.int64))
+
+
+def rank_images_by_patch_hits(hit_image_ids: np.ndarray,
+                              hit_scores: np.ndarray,
+                              hit_queries: np.ndarray,
+                              num_queries: int,
+                              top_k: int) -> List[str]:
+    if not hit_scores.size:
+        return []
+    image_ids, image_index = np.unique(hit_image_ids, return_inverse=True)
+    num_images = len(image_ids)
+
+    # best patch similarity per (query patch, image) pair
+    pair = hit_queries * num_images + image_index
+    order = np.argsort(pair, kind='stable')
+    sorted_pair = pair[order]
+    starts = np.flatnonzero(
+        np.concatenate([[True], sorted_pair[1:] != sorted_pair[:-1]]))
+    best_scores = np.maximum.reduceat(hit_scores[order], starts)
+    pair_queries = sorted_pair[starts] // num_images
+    pair_images = sorted_pair[starts] % num_images
+
+    # an image missing from a query's top-M scores at most that query's
+    # lowest returned similarity, which is used as its best-patch estimate
+    query_floor = np.full(num_queries, np.inf, dtype=np.float32)
+    np.minimum.at(query_floor, hit_queries, hit_scores)
+    query_floor[np.isinf(query_floor)] = 0
+    total_scores = np.bincount(pair_images,
+                               weights=best_scores - query_floor[pair_queries],
+                               minlength=num_images) + query_floor.sum()
+    mean_scores = total_scores / num_queries
+    ranking = np.argsort(-mean_scores, kind='stable')[:top_k]
+    return image_ids[ranking].tolist()
+
+
+def rank_images_by_max_sim(focus_embedding: np.ndarray,
+                           patch_image_ids: np.ndarray,
+                           patch_embedding: np.ndarray,
+                           top_k: int) -> List[str]:
+    # exact score of each candidate image: the mean over focus patches of
+    # their best similarity to any of the image's patches; both sides come
+    # normalized (index patches as the index scores them)
+    if not len(patch_image_ids):
+        return []
+    image_ids, image_index = np.unique(patch_image_ids, return_inverse=True)
+    order = np.argsort(image_index, kind='stable')
+    starts = np.flatnonzero(
+        np.concatenate([[True], np.diff(image_index[order]) != 0]))
+    scores = focus_embedding @ patch_embedding[order].T
+    mean_scores = np.maximum.reduceat(scores, starts, axis=1).mean(axis=0)
+    ranking = np.argsort(-mean_scores, kind='stable')[:top_k]
+    return image_ids[ranking].tolist()
@@ -0,0 +1,114 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+
+class ForegroundModel:
+
+    def __init__(self, mean: np.ndarray, component: np.ndarray,
+                 minimum: float, maximum: float):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.component = np.asarray(component, dtype=np.float32)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        # ((x - mean) @ component - minimum) / (maximum - minimum)
+        scale = 1 / max(self.maximum - self.minimum, np.finfo(np.float32).eps)
+        self.weight = self.component * scale
+        self.bias = -(float(self.mean @ self.component) + self.minimum) * scale
+
+    def score(self, embedding: np.ndarray):
+        return np.asarray(embedding, dtype=np.float32) @ self.weight + self.bias
+
+    def mask(self, embedding: np.ndarray, threshold: float = 0.5):
+        return self.score(embedding) > threshold
+
+    def save(self, path: str):
+        with open(path, 'wb') as fp:
+            np.savez(fp,
+                     mean=self.mean,
+                     component=self.component,
+                     minimum=self.minimum,
+                     maximum=self.maximum)
+
+    @classmethod
+    def load(cls, path: str):
+        if Path(path).suffix == '.pkl':
+            return cls.from_sklearn_pipeline(path)
+        with np.load(path) as data:
+            return cls(mean=data['mean'],
+                       component=data['component'],
+                       minimum=data['minimum'],
+                       maximum=data['maximum'])
+
+    @classmethod
+    def from_sklearn_pipeline(cls, pkl_file: str):
+        import joblib
+        with open(pkl_file, 'rb') as fp:
+            fg_pipeline = joblib.load(fp)
+        pca, scaler = fg_pipeline.named_steps['pca'], fg_pipeline.named_steps[
+            'scaler']
+        return cls(mean=pca.mean_,
+                   component=pca.components_[0],
+                   minimum=scaler.data_min_[0],
+                   maximum=scaler.data_max_[0])
+
+
+class ForegroundEstimator:
+
+    def __init__(self, sample_size: int = 50000, seed: int = 0):
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self.sample: Optional[np.ndarray] = None
+        self.num_seen = 0
+
+    def partial_fit(self, embedding: np.ndarray):
+        # vectorized reservoir sampling (Algorithm R) over patch rows
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self.sample is None:
+            self.sample = np.empty((0, embedding.shape[1]), dtype=np.float32)
+        free = max(self.sample_size - len(self.sample), 0)
+        if free:
+            self.sample = np.concatenate([self.sample, embedding[:free]])
+        rest = embedding[free:]
+        if len(rest):
+            positions = self.num_seen + free + np.arange(len(rest))
+            slots = (self.rng.random(len(rest)) * (positions + 1)).astype(
+                np.int64)
+            keep = slots < self.sample_size
+            # later rows win when several rows draw the same slot
+            self.sample[slots[keep]] = rest[keep]
+        self.num_seen += len(embedding)
+        return self
+
+    def fit_model(self):
+        assert self.sample is not None and len(self.sample) > 1
+        mean = self.sample.mean(axis=0)
+        centered = self.sample - mean
+        _, _, vt = np.linalg.svd(centered, full_matrices=False)
+        component = vt[0]
+        # deterministic sign: largest absolute loading is positive
+        component *= np.sign(component[np.argmax(np.abs(component))])
+        projection = centered @ component
+        logger.info(f'Fit foreground model on {len(self.sample)} sampled '
+                    f'patches of {self.num_seen} seen')
+        return ForegroundModel(mean=mean,
+                               component=component,
+                               minimum=projection.min(),
+                               maximum=projection.max())
+
+    def save(self, path: str):
+        with open(path, 'wb') as fp:
+            np.savez(fp,
+                     sample=self.sample,
+                     num_seen=self.num_seen,
+                     sample_size=self.sample_size)
+
+    @classmethod
+    def load(cls, path: str, seed: int = 0):
+        with np.load(path) as data:
+            estimator = cls(sample_size=int(data['sample_size']), seed=seed)
+            estimator.sample = data['sample']
+            estimator.num_seen = int(data['num_seen'])
+        return estimator
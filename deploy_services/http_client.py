@@ -0,0 +1,43 @@
+import asyncio
+
+import httpx
+from loguru import logger
+
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+def build_async_client(timeout: float = 30.0,
+                       connect_timeout: float = 5.0,
+                       max_connections: int = 64):
+    # connections are kept alive and shared by all concurrent requests;
+    # failed connection attempts are retried by request_with_retry only, so
+    # the attempts of the two layers do not multiply
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max_connections))
+    return httpx.AsyncClient(timeout=httpx.Timeout(timeout,
+                                                   connect=connect_timeout),
+                             transport=transport)
+
+
+async def request_with_retry(client: httpx.AsyncClient,
+                             method: str,
+                             url: str,
+                             retries: int = 2,
+                             backoff: float = 0.2,
+                             **kwargs):
+    for attempt in range(retries + 1):
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or (
+                    attempt == retries):
+                response.raise_for_status()
+                return response
+            logger.warning(f'{method} {url}: {response.status_code}, retry '
+                           f'{attempt + 1}/{retries}')
+        except (httpx.TimeoutException, httpx.NetworkError) as error:
+            if attempt == retries:
+                raise
+            logger.warning(f'{method} {url}: {error!r}, retry '
+                           f'{attempt + 1}/{retries}')
+        await asyncio.sleep(backoff * 2**attempt)
@@ -0,0 +1,211 @@
+import hashlib
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from loguru import logger
+
+
+class DirectoryBlob:
+
+    def __init__(self, bucket: 'DirectoryBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = bucket.root / name
+        stat = self.path.stat()
+        self.generation = stat.st_mtime_ns
+        self.size = stat.st_size
+
+    def download_as_bytes(self):
+        self.bucket.simulate_latency()
+        return self.path.read_bytes()
+
+
+class DirectoryBucket:
+    # offline stand-in for google.cloud.storage.Bucket: blob names are paths
+    # under root and the generation is the file mtime
+    def __init__(self, root: str, latency_ms: float = 0.0):
+        self.root = Path(root)
+        self.latency = latency_ms / 1000
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_blob(self, name: str):
+        self.simulate_latency()
+        if not (self.root / name).is_file():
+            return None
+        return DirectoryBlob(self, name)
+
+
+class DiskLRUCache:
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        # access times are kept in mtime so LRU order survives a restart
+        for cache_file in sorted(self.cache_dir.glob('*.bin'),
+                                 key=lambda f: f.stat().st_mtime):
+            self.files[cache_file.stem] = cache_file.stat().st_size
+        self.total_bytes = sum(self.files.values())
+        self.hits = self.misses = 0
+        logger.info(f'Image disk cache: {cache_dir} {len(self.files)} files '
+                    f'{self.total_bytes / 2**20:.0f}/'
+                    f'{max_bytes / 2**20:.0f} MiB')
+
+    @staticmethod
+    def key(name: str):
+        return hashlib.sha1(name.encode()).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.files:
+                self.misses += 1
+                return None
+            self.files.move_to_end(key)
+            self.hits += 1
+        cache_file = self.cache_dir / f'{key}.bin'
+        try:
+            content = cache_file.read_bytes()
+            os.utime(cache_file)
+            return content
+        except FileNotFoundError:
+            # evicted by another thread between the lookup and the read
+            return None
+
+    def put(self, key: str, content: bytes):
+        if len(content) > self.max_bytes:
+            return
+        cache_file = self.cache_dir / f'{key}.bin'
+        tmp_file = self.cache_dir / f'.{key}.{threading.get_ident()}.tmp'
+        tmp_file.write_bytes(content)
+        os.replace(tmp_file, cache_file)
+        with self.lock:
+            if key in self.files:
+                self.total_bytes -= self.files.pop(key)
+            self.files[key] = len(content)
+            self.total_bytes += len(content)
+            while self.total_bytes > self.max_bytes:
+                evicted, size = self.files.popitem(last=False)
+                (self.cache_dir / f'{evicted}.bin').unlink(missing_ok=True)
+                self.total_bytes -= size
+
+
+class ImageLoader:
+
+    def __init__(self,
+                 apply_gs: bool = False,
+                 gs_bucket_name: Optional[str] = None,
+                 gs_credential: Optional[str] = None,
+                 fake_bucket_dir: Optional[str] = None,
+                 pool_size: int = 32,
+                 max_prefetch: int = 256,
+                 cache_dir: Optional[str] = None,
+                 cache_bytes: int = 10 * 2**30):
+        self.apply_gs = apply_gs or fake_bucket_dir is not None
+        self.bucket = None
+        if fake_bucket_dir is not None:
+            self.bucket = DirectoryBucket(fake_bucket_dir)
+        elif self.apply_gs:
+            from google.cloud import storage
+            from requests.adapters import HTTPAdapter
+            storage_client = storage.Client.from_service_account_json(
+                gs_credential)
+            # the default urllib3 pool keeps 10 connections per host, fewer
+            # than the download threads
+            storage_client._http.mount(
+                'https://',
+                HTTPAdapter(pool_connections=pool_size,
+                            pool_maxsize=pool_size))
+            self.bucket = storage_client.bucket(gs_bucket_name)
+        self.cache = DiskLRUCache(cache_dir, cache_bytes) if (
+            self.apply_gs and cache_dir) else None
+        self.executor = ThreadPoolExecutor(max_workers=pool_size,
+                                           thread_name_prefix='gcs-fetch')
+        self.max_prefetch = max_prefetch
+        self.lock = threading.Lock()
+        self.queued = deque()
+        self.futures = {}
+        # batch requests holding each prefetched file; a future is dropped
+        # when the last of them is released, so one batch ending never
+        # cancels a download another batch still waits on
+        self.refs = Counter()
+        # read by their only holder; not downloaded again until prefetched
+        # by another batch
+        self.consumed = set()
+
+    def fetch(self, img_file: str):
+        # object names carry the image id and upload time and are never
+        # rewritten, so a cached copy is served without a metadata request
+        key = DiskLRUCache.key(img_file)
+        content = self.cache.get(key) if self.cache is not None else None
+        if content is not None:
+            return content
+        blob = self.bucket.get_blob(img_file)
+        if blob is None:
+            raise FileNotFoundError(f'Blob not found: {img_file}')
+        content = blob.download_as_bytes()
+        if self.cache is not None:
+            self.cache.put(key, content)
+        return content
+
+    def _fill(self):
+        while self.queued and len(self.futures) < self.max_prefetch:
+            img_file = self.queued.popleft()
+            if (img_file in self.refs and img_file not in self.futures
+                    and img_file not in self.consumed):
+                self.futures[img_file] = self.executor.submit(
+                    self.fetch, img_file)
+
+    def prefetch(self, img_files: List[str]):
+        # downloads run ahead of the requests that need them, with at most
+        # max_prefetch fetched blobs held in memory; every call is matched by
+        # a release_prefetch of the same files
+        if not self.apply_gs:
+            return
+        with self.lock:
+            for img_file in img_files:
+                self.refs[img_file] += 1
+                self.consumed.discard(img_file)
+            self.queued.extend(img_files)
+            self._fill()
+
+    def release_prefetch(self, img_files: List[str]):
+        if not self.apply_gs:
+            return
+        with self.lock:
+            for img_file in img_files:
+                self.refs[img_file] -= 1
+                if self.refs[img_file] > 0:
+                    continue
+                del self.refs[img_file]
+                self.consumed.discard(img_file)
+                future = self.futures.pop(img_file, None)
+                if future is not None:
+                    future.cancel()
+            self._fill()
+
+    def read(self, img_file: str):
+        if not self.apply_gs:
+            with open(img_file, 'rb') as fp:
+                return fp.read()
+        with self.lock:
+            future = self.futures.get(img_file)
+            # other holders keep the future until they read or release it
+            if self.refs[img_file] <= 1:
+                self.futures.pop(img_file, None)
+                if img_file in self.refs:
+                    self.consumed.add(img_file)
+                self._fill()
+        return future.result() if future is not None else self.fetch(img_file)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
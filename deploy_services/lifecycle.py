@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from loguru import logger
+from prometheus_client import Gauge
+
+# with several workers, ready once every live worker is
+SERVICE_READY = Gauge('service_ready',
+                      'Whether the service finished loading',
+                      labelnames=('service', ),
+                      multiprocess_mode='livemin')
+LOAD_SECONDS = Gauge('service_load_seconds',
+                     'Time from process start to ready',
+                     labelnames=('service', ),
+                     multiprocess_mode='livemax')
+
+
+class Readiness:
+    # the server binds right away and answers /healthz; models and indexes
+    # load in the background and /readyz flips once they are in place
+
+    def __init__(self, service: str):
+        self.service = service
+        self.ready = False
+        self.error = None
+        self.task = None
+        self.start_time = time.perf_counter()
+        SERVICE_READY.labels(service).set(0)
+
+    def start(self, load_func):
+        self.task = asyncio.create_task(self._load(load_func))
+
+    async def _load(self, load_func):
+        try:
+            await load_func()
+        except Exception as error:
+            logger.exception(f'[{self.service}] loading failed')
+            self.error = repr(error)
+            return
+        elapsed = time.perf_counter() - self.start_time
+        self.ready = True
+        SERVICE_READY.labels(self.service).set(1)
+        LOAD_SECONDS.labels(self.service).set(elapsed)
+        logger.info(f'[{self.service}] ready after {elapsed:.2f}s')
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def require(self):
+        if not self.ready:
+            raise HTTPException(status_code=503,
+                                detail=self.error or 'loading',
+                                headers={'Retry-After': '1'})
+
+
+def add_health_routes(app: FastAPI, readiness: Readiness):
+
+    @app.get('/healthz')
+    async def healthz():
+        return dict(status='ok')
+
+    @app.get('/readyz')
+    async def readyz():
+        return JSONResponse(status_code=200 if readiness.ready else 503,
+                            content=dict(ready=readiness.ready,
+                                         error=readiness.error,
+                                         uptime=time.perf_counter() -
+                                         readiness.start_time))
@@ -0,0 +1,222 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+PATCH_CODEC_FILE = 'patch_codec.npz'
+PATCH_STORAGES = ('float32', 'float16', 'sq8', 'pq')
+
+
+class Float32Codec:
+
+    name = 'float32'
+    dtype = np.float32
+    # float32 blocks are scored straight from the memory map
+    scan_size = 262144
+
+    def __init__(self, embedding_size: int):
+        self.embedding_size = embedding_size
+
+    @property
+    def code_shape(self):
+        return (self.embedding_size, )
+
+    def fit(self, sample: np.ndarray):
+        return self
+
+    def encode(self, embedding: np.ndarray):
+        return np.asarray(embedding, dtype=self.dtype)
+
+    def decode(self, codes: np.ndarray):
+        return np.asarray(codes, dtype=np.float32)
+
+    def scores(self, query: np.ndarray, codes: np.ndarray):
+        return query @ self.decode(codes).T
+
+    def params(self):
+        return {}
+
+
+class Float16Codec(Float32Codec):
+
+    name = 'float16'
+    dtype = np.float16
+    scan_size = 32768
+
+
+class SQ8Codec(Float32Codec):
+
+    name = 'sq8'
+    dtype = np.int8
+    scan_size = 32768
+
+    def __init__(self, embedding_size: int, scale: Optional[np.ndarray] = None):
+        super().__init__(embedding_size)
+        self.scale = scale
+
+    def fit(self, sample: np.ndarray):
+        # symmetric per-dimension scale over the (l2-normalized) sample
+        self.scale = np.maximum(np.abs(sample).max(axis=0),
+                                np.finfo(np.float32).tiny) / 127
+        self.scale = self.scale.astype(np.float32)
+        return self
+
+    def encode(self, embedding: np.ndarray):
+        return np.clip(np.rint(embedding / self.scale), -127,
+                       127).astype(np.int8)
+
+    def decode(self, codes: np.ndarray):
+        return codes.astype(np.float32) * self.scale
+
+    def scores(self, query: np.ndarray, codes: np.ndarray):
+        return (query * self.scale) @ codes.astype(np.float32).T
+
+    def params(self):
+        return dict(scale=self.scale)
+
+
+class PQCodec(Float32Codec):
+
+    name = 'pq'
+    dtype = np.uint8
+    scan_size = 32768
+    num_centroids = 256
+
+    def __init__(self,
+                 embedding_size: int,
+                 num_subvectors: int = 64,
+                 centroids: Optional[np.ndarray] = None,
+                 iterations: int = 10,
+                 seed: int = 0):
+        super().__init__(embedding_size)
+        assert embedding_size % num_subvectors == 0
+        self.num_subvectors = num_subvectors
+        self.sub_size = embedding_size // num_subvectors
+        # (num_subvectors, 256, sub_size)
+        self.centroids = centroids
+        self.iterations = iterations
+        self.seed = seed
+
+    @property
+    def code_shape(self):
+        return (self.num_subvectors, )
+
+    def _split(self, embedding: np.ndarray):
+        return np.asarray(embedding, dtype=np.float32).reshape(
+            len(embedding), self.num_subvectors, self.sub_size)
+
+    def _assign(self, sub_embedding: np.ndarray, centroids: np.ndarray):
+        distances = (np.square(centroids).sum(axis=1)[None, :] -
+                     2 * sub_embedding @ centroids.T)
+        return distances.argmin(axis=1)
+
+    def fit(self, sample: np.ndarray):
+        rng = np.random.default_rng(self.seed)
+        sub_sample = self._split(sample)
+        num_centroids = min(self.num_centroids, len(sample))
+        self.centroids = np.zeros(
+            (self.num_subvectors, self.num_centroids, self.sub_size),
+            dtype=np.float32)
+        for m in range(self.num_subvectors):
+            points = sub_sample[:, m]
+            centroids = points[rng.choice(len(points),
+                                          num_centroids,
+                                          replace=False)]
+            # Lloyd iterations; empty clusters keep their previous centroid
+            for _ in range(self.iterations):
+                labels = self._assign(points, centroids)
+                counts = np.bincount(labels, minlength=num_centroids)
+                sums = np.stack([
+                    np.bincount(labels,
+                                weights=points[:, d],
+                                minlength=num_centroids)
+                    for d in range(self.sub_size)
+                ],
+                                axis=1)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+            self.centroids[m, :num_centroids] = centroids
+        logger.info(f'Fit PQ codec: {self.num_subvectors} subvectors x '
+                    f'{self.num_centroids} centroids on {len(sample)} rows')
+        return self
+
+    def encode(self, embedding: np.ndarray):
+        sub_embedding = self._split(embedding)
+        codes = np.empty((len(embedding), self.num_subvectors), dtype=np.uint8)
+        for m in range(self.num_subvectors):
+            codes[:, m] = self._assign(sub_embedding[:, m], self.centroids[m])
+        return codes
+
+    def decode(self, codes: np.ndarray):
+        codes = np.asarray(codes)
+        return self.centroids[np.arange(self.num_subvectors),
+                              codes].reshape(len(codes), -1)
+
+    def scores(self, query: np.ndarray, codes: np.ndarray):
+        # asymmetric distance: per query, one 256-entry lookup table of
+        # subvector dot products per subvector, summed over the codes; rows
+        # are scored in blocks whose (rows, queries) output stays in cache
+        luts = np.ascontiguousarray(
+            np.einsum('qms,mcs->mcq', self._split(query), self.centroids))
+        codes = np.asarray(codes)
+        scores = np.empty((len(codes), len(query)), dtype=np.float32)
+        block_size = max(1, 65536 // len(query))
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size]
+            out = scores[start:start + block_size]
+            np.take(luts[0], block[:, 0], axis=0, out=out)
+            for m in range(1, self.num_subvectors):
+                out += np.take(luts[m], block[:, m], axis=0)
+        return scores.T
+
+    def params(self):
+        return dict(centroids=self.centroids)
+
+
+def build_codec(storage: str, embedding_size: int, pq_subvectors: int = 64):
+    assert storage in PATCH_STORAGES
+    if storage == 'pq':
+        return PQCodec(embedding_size, num_subvectors=pq_subvectors)
+    return dict(float32=Float32Codec, float16=Float16Codec,
+                sq8=SQ8Codec)[storage](embedding_size)
+
+
+def save_codec(codec, path: str):
+    with open(path, 'wb') as fp:
+        np.savez(fp,
+                 name=codec.name,
+                 embedding_size=codec.embedding_size,
+                 **codec.params())
+
+
+def load_codec(index_dir: str, embedding_size: int):
+    codec_file = Path(index_dir) / PATCH_CODEC_FILE
+    if not codec_file.exists():
+        return Float32Codec(embedding_size)
+    with np.load(codec_file) as data:
+        name = str(data['name'])
+        if name == 'sq8':
+            return SQ8Codec(embedding_size, scale=data['scale'])
+        if name == 'pq':
+            return PQCodec(embedding_size,
+                           num_subvectors=data['centroids'].shape[0],
+                           centroids=data['centroids'])
+        return build_codec(name, embedding_size)
+
+
+def pool_patches(image_index: np.ndarray, grid: np.ndarray,
+                 embedding: np.ndarray, pooling: int):
+    # average the stored (foreground) patches of each pooling x pooling grid
+    # block; pooled rows sit on the coarser grid of blocks, so callers store
+    # pooling * patch_size as their patch size
+    if pooling <= 1 or not len(embedding):
+        return image_index, grid, embedding
+    blocks = np.column_stack([image_index, grid // pooling])
+    blocks, block_index = np.unique(blocks, axis=0, return_inverse=True)
+    block_index = block_index.ravel()
+    counts = np.bincount(block_index, minlength=len(blocks))
+    pooled = np.zeros((len(blocks), embedding.shape[1]), dtype=np.float32)
+    np.add.at(pooled, block_index, np.asarray(embedding, dtype=np.float32))
+    pooled /= counts[:, None]
+    return blocks[:, 0], blocks[:, 1:].astype(grid.dtype), pooled
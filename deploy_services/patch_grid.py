@@ -0,0 +1,95 @@
+from typing import List
+
+import numpy as np
+
+BOX_KEYS = ('x1', 'y1', 'x2', 'y2')
+
+
+def parse_regions(coords_info: dict):
+    # a focus area is one box (x1, y1, x2, y2 keys), a list of boxes and/or
+    # a list of polygons given as [[x, y], ...] points
+    boxes = [coords_info] if all(k in coords_info
+                                 for k in BOX_KEYS) else []
+    boxes = np.asarray([[box[k] for k in BOX_KEYS]
+                        for box in boxes + coords_info.get('boxes', [])],
+                       dtype=np.float32).reshape(-1, 4)
+    polygons = [
+        np.asarray(polygon, dtype=np.float32).reshape(-1, 2)
+        for polygon in coords_info.get('polygons', [])
+    ]
+    return boxes, polygons
+
+
+def resize_points(points: np.ndarray, from_size: tuple, to_size: tuple):
+    # points (..., 2k) hold interleaved x, y values; sizes are (height, width)
+    scale = np.asarray(to_size, dtype=np.float32)[::-1] / np.asarray(
+        from_size, dtype=np.float32)[::-1]
+    points = np.asarray(points, dtype=np.float32)
+    # explicit pair count: -1 cannot be inferred for zero rows (no boxes)
+    return (points.reshape(*points.shape[:-1], points.shape[-1] // 2, 2) *
+            scale).reshape(points.shape)
+
+
+def grid_shape(image_shape: tuple, patch_size: int):
+    # a partial last row / column still holds a cell (a pooled border block)
+    return -(-image_shape[0] // patch_size), -(-image_shape[1] // patch_size)
+
+
+def box_slices(box: np.ndarray, patch_size: int, shape: tuple):
+    # patches touched by the box, clipped to the grid
+    x1, y1, x2, y2 = (np.asarray(box) // patch_size).astype(int)
+    return (slice(y1, min(y2, shape[0] - 1) + 1),
+            slice(x1, min(x2, shape[1] - 1) + 1))
+
+
+def polygon_mask(polygon: np.ndarray, patch_size: int, shape: tuple):
+    # even-odd test of every patch centre against all polygon edges at once
+    centre_y, centre_x = (np.indices(shape, dtype=np.float32) +
+                          np.float32(0.5)) * patch_size
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    py, px = centre_y[..., None], centre_x[..., None]
+    crosses = (y1 > py) != (y2 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+    return np.logical_xor.reduce(crosses & (px < x_cross), axis=-1)
+
+
+def region_mask(boxes: np.ndarray, polygons: List[np.ndarray],
+                patch_size: int, shape: tuple):
+    mask = np.zeros(shape, dtype=bool)
+    for box in boxes:
+        mask[box_slices(box, patch_size, shape)] = True
+    for polygon in polygons:
+        mask |= polygon_mask(polygon, patch_size, shape)
+    return mask
+
+
+def extract_region_patches(embedding: np.ndarray,
+                           fg_mask: np.ndarray,
+                           boxes: np.ndarray,
+                           polygons: List[np.ndarray],
+                           patch_size: int,
+                           image_shape: tuple,
+                           embedding_shape: tuple):
+    # (H, W, D) view of the patch embedding; only selected rows are copied
+    grid = np.asarray(embedding).reshape(*embedding_shape)
+    fg_grid = np.asarray(fg_mask).reshape(*embedding_shape[:2])
+    if len(boxes) == 1 and not polygons:
+        region = box_slices(boxes[0], patch_size, fg_grid.shape)
+        return grid[region][fg_grid[region]].astype(np.float32, copy=False)
+    mask = region_mask(boxes, polygons, patch_size, fg_grid.shape)
+    return grid[mask & fg_grid].astype(np.float32, copy=False)
+
+
+def select_grid_rows(grid: np.ndarray, boxes: np.ndarray,
+                     polygons: List[np.ndarray], patch_size: int,
+                     image_shape: tuple):
+    # stored rows whose (y, x) grid position falls inside the region
+    shape = grid_shape(image_shape, patch_size)
+    mask = region_mask(boxes, polygons, patch_size, shape)
+    grid = np.asarray(grid)
+    in_grid = (grid[:, 0] < shape[0]) & (grid[:, 1] < shape[1])
+    selected = np.zeros(len(grid), dtype=bool)
+    selected[in_grid] = mask[grid[in_grid, 0], grid[in_grid, 1]]
+    return selected
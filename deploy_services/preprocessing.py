@@ -0,0 +1,58 @@
+import io
+import multiprocessing
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from functools import lru_cache
+
+import torch
+from PIL import Image, ImageOps
+
+from embedding_model import build_transform, preprocess
+
+
+def decode_image(content: bytes, image_size: int, draft: bool = True):
+    image = Image.open(io.BytesIO(content))
+    if draft and image.format == 'JPEG':
+        # let libjpeg decode at 1/2, 1/4 or 1/8 scale while both sides stay
+        # at least image_size, so the shorter side still resizes down
+        image.draft('RGB', (image_size, image_size))
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGB')
+
+
+@lru_cache(maxsize=4)
+def cached_transform(image_size: int):
+    return build_transform(image_size=image_size)
+
+
+def decode_and_preprocess(content: bytes,
+                          image_size: int,
+                          patch_size: int,
+                          embedding_type: str,
+                          draft: bool = True):
+    image = decode_image(content, image_size=image_size, draft=draft)
+    return preprocess(image,
+                      transform=cached_transform(image_size),
+                      patch_size=patch_size,
+                      embedding_type=embedding_type)
+
+
+def init_worker(num_threads: int):
+    # keep worker processes from oversubscribing cores with torch threads
+    torch.set_num_threads(num_threads)
+
+
+def build_preprocess_executor(mode: str, num_workers: int) -> Executor:
+    assert mode in ('thread', 'process')
+    if mode == 'thread':
+        # PIL decode/resize and torch kernels release the GIL
+        return ThreadPoolExecutor(max_workers=num_workers,
+                                  thread_name_prefix='preprocess')
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=init_worker,
+        initargs=(1, ))
+    # fork all workers now, before the model and torch thread pools exist
+    executor.submit(int).result()
+    return executor
@@ -1,170 +1,479 @@
+import asyncio
+import hashlib
 import os
 from argparse import ArgumentParser
-from pathlib import Path
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Optional
 
-import joblib
 import numpy as np
-import requests
 import uvicorn
-from fastapi import FastAPI
+from fastapi import APIRouter, Depends, FastAPI
 from loguru import logger
 from pydantic import BaseModel
-from pymilvus import MilvusClient
 
-IMAGE_EMBEDDING_API = 'http://127.0.0.1:8001/generate-image-embedding/'
-PATCH_EMBEDDING_API = 'http://127.0.0.1:8001/generate-patch-embedding/'
+from embedding_cache import EmbeddingCache, cache_key
+from focus_search import rank_images_by_max_sim, rank_images_by_patch_hits
+from foreground import ForegroundModel
+from http_client import build_async_client, request_with_retry
+from lifecycle import Readiness, add_health_routes
+from patch_grid import (extract_region_patches, grid_shape, parse_regions,
+                        region_mask, resize_points, select_grid_rows)
+from result_cache import ResultCache, result_key
+from telemetry import (executor_queue_size, instrument_app,
+                       prepare_multiprocess_dir, stage, trace_headers,
+                       track_cache, track_queue)
+from vector_index import (index_version_file, is_server_uri, l2_normalize,
+                          load_index, read_index_version)
+from wire_format import accept_header, decode_embedding
 
 
 class QueryImage(BaseModel):
     image_path: str
     coords_info: Optional[dict]
+    image_id: Optional[str] = None
+    image_hash: Optional[str] = None
 
 
 def arg_parse():
     parser = ArgumentParser()
-    parser.add_argument('--fg-pipeline', type=str, default='fg-pipeline.pkl')
+    parser.add_argument('--fg-pipeline', type=str, default='fg-model.npz')
+    parser.add_argument('--index-backend',
+                        type=str,
+                        default='milvus',
+                        choices=['milvus', 'numpy'])
     parser.add_argument('--db-file', type=str, default='embedding.db')
+    parser.add_argument('--index-dir', type=str, default='embedding-index')
+    parser.add_argument('--index-version-file',
+                        type=str,
+                        default=None,
+                        help='version file the indexer publishes for a Milvus '
+                        'server URI (Milvus Lite: [DB_FILE].version)')
     parser.add_argument('--host', type=str, default='127.0.0.1')
     parser.add_argument('--port', type=int, default=8002)
     parser.add_argument('--top-k', type=int, default=10)
-    return parser.parse_args()
-
-
-def load_db(db_file: str):
-    logger.info(f'Load db: {db_file}')
-    if Path(f'.{db_file}.lock').exists():
-        os.remove(f'.{db_file}.lock')
-    return MilvusClient(db_file)
-
-
-def load_fg_pipeline(pkl_file: str):
-    with open(pkl_file, 'rb') as fp:
-        return joblib.load(fp)
-
-
-def resize_coords(coords: dict, coords_img_size: tuple,
-                  target_img_size: tuple):
-    coords_img_height, coords_img_width = coords_img_size
-    target_img_height, target_img_width = target_img_size
-    height_ratio = target_img_height / coords_img_height
-    width_ratio = target_img_width / coords_img_width
-    return dict(
-        x1=coords['x1'] * width_ratio,
-        y1=coords['y1'] * height_ratio,
-        x2=coords['x2'] * width_ratio,
-        y2=coords['y2'] * height_ratio,
-    )
-
-
-def locate_focus_patches(
-    embedding: np.ndarray,
-    coords: dict,
-    patch_size: int,
-    image_shape: tuple,
-    embedding_shape: tuple,
-):
-    x1, y1, x2, y2 = coords['x1'], coords['y1'], coords['x2'], coords['y2']
-    grid_size = (image_shape[0] // patch_size, image_shape[1] // patch_size)
-    grid_x = int(x1 // patch_size), min(int(x2 // patch_size),
-                                        grid_size[1] - 1)
-    grid_y = int(y1 // patch_size), min(int(y2 // patch_size),
-                                        grid_size[0] - 1)
-    grid_index = [(y, x) for x in range(grid_x[0], grid_x[1] + 1, 1)
-                  for y in range(grid_y[0], grid_y[1] + 1, 1)]
-    y_values, x_values = zip(*grid_index)
-    fg_embedding = fg_pipeline.transform(np.asarray(embedding))
-    embedding_array = np.asarray(embedding)
-    embedding_array[~(fg_embedding.ravel() > 0.5), :] = 0
-    focus_embedding = embedding_array.reshape(*embedding_shape)[y_values,
-                                                                x_values, :]
-    return focus_embedding[focus_embedding.any(axis=1), :]
-
-
-def get_embedding(image_path: str, embedding_type: str):
+    parser.add_argument('--focus-top-m', type=int, default=2048)
+    parser.add_argument('--focus-chunk-size', type=int, default=256)
+    parser.add_argument('--focus-candidates',
+                        type=int,
+                        default=0,
+                        help='two-stage focus search over the top C '
+                        'candidate images; 0 scores the whole catalog')
+    parser.add_argument('--focus-candidate-source',
+                        type=str,
+                        default='image',
+                        choices=['image', 'centroid'])
+    parser.add_argument('--nprobe', type=int, default=None)
+    parser.add_argument('--ef', type=int, default=None)
+    parser.add_argument('--embedding-format',
+                        type=str,
+                        default='ndarray',
+                        choices=['json', 'ndarray', 'msgpack'])
+    parser.add_argument('--embedding-dtype',
+                        type=str,
+                        default='float32',
+                        choices=['float32', 'float16'])
+    parser.add_argument('--embedding-cache-bytes',
+                        type=int,
+                        default=256 * 2**20)
+    parser.add_argument('--embedding-cache-dir', type=str, default=None)
+    parser.add_argument('--embedding-cache-dir-bytes',
+                        type=int,
+                        default=2 * 2**30)
+    parser.add_argument('--embedding-url',
+                        type=str,
+                        default='http://127.0.0.1:8001')
+    parser.add_argument('--http-timeout', type=float, default=30.0)
+    parser.add_argument('--http-connect-timeout', type=float, default=5.0)
+    parser.add_argument('--http-max-connections', type=int, default=64)
+    parser.add_argument('--http-retries', type=int, default=2)
+    parser.add_argument('--index-threads', type=int, default=8)
+    parser.add_argument('--result-cache-size',
+                        type=int,
+                        default=4096,
+                        help='cached recommendation results; 0 disables')
+    parser.add_argument('--result-cache-ttl', type=float, default=600.0)
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='server processes sharing the memory-mapped '
+                        'numpy index')
+    parser.add_argument('--index-poll-interval',
+                        type=float,
+                        default=2.0,
+                        help='seconds between checks for a new numpy index '
+                        'version; 0 disables hot swapping')
+    parser.add_argument('--num-shards',
+                        type=int,
+                        default=1,
+                        help='search K shards written by generate_embedding '
+                        '--num-shards in parallel')
+    args = parser.parse_args()
+    if args.workers > 1 and args.index_backend == 'milvus' and not (
+            is_server_uri(args.db_file)):
+        parser.error('--workers needs --index-backend numpy or a Milvus '
+                     'server URI: Milvus Lite locks its DB file')
+    if args.num_shards > 1 and args.index_backend == 'milvus' and (
+            is_server_uri(args.db_file)):
+        parser.error('--num-shards splits local Milvus Lite DB files; a '
+                     'Milvus server shards its collections itself')
+    return args
+
+
+async def run_blocking(func, *args, **kwargs):
+    # index lookups block (Milvus client) or burn CPU (NumPy), so they run
+    # on a bounded thread pool instead of the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(index_executor,
+                                      partial(func, *args, **kwargs))
+
+
+async def cached_search(embedding: np.ndarray, focus_cells: Optional[
+    np.ndarray], func, *search_args):
+    # repeated searches (search again, paging back) with the same query
+    # embedding and focus cells reuse the result until the index changes
+    key = result_key(embedding, focus_cells, args.top_k)
+    if result_cache is None:
+        return await run_blocking(func, *search_args)
+    # read before searching: a result computed while a new version is
+    # published is stored under the version that answered it
+    version = search_version()
+    image_ids = result_cache.get(key, version)
+    if image_ids is not None:
+        return image_ids
+    image_ids = await run_blocking(func, *search_args)
+    result_cache.put(key, version, image_ids)
+    return image_ids
+
+
+def search_version():
+    # a numpy index is swapped in by the watcher, so the version file can
+    # be ahead of the loaded index; Milvus serves rows once they are written
+    if args.index_backend == 'numpy':
+        return index.version
+    return read_index_version(milvus_version_file)
+
+
+async def embedding_namespace():
+    global model_namespace
+    if model_namespace is None:
+        response = await request_with_retry(http_client,
+                                            'GET',
+                                            MODEL_INFO_API,
+                                            retries=args.http_retries,
+                                            headers=trace_headers())
+        model_info = response.json()
+        model_namespace = f'{model_info["model"]}:{model_info["image_size"]}:{model_info["precision"]}'
+    return model_namespace
+
+
+async def request_embedding(image_path: str):
+    with stage('embedding_request'):
+        response = await request_with_retry(
+            http_client,
+            'POST',
+            EMBEDDING_API,
+            retries=args.http_retries,
+            json=dict(image_path=image_path),
+            headers={
+                'Accept': accept_header(args.embedding_format,
+                                        args.embedding_dtype),
+                **trace_headers()
+            })
+    return decode_embedding(response.content,
+                            content_type=response.headers['Content-Type'],
+                            headers=response.headers)
+
+
+def split_combined_embedding(embedding_info: dict):
+    image_embedding = embedding_info.pop('image_embedding')
+    image_info = dict(embedding=image_embedding,
+                      embedding_shape=(1, image_embedding.shape[-1]),
+                      image_shape=embedding_info['image_shape'],
+                      patch_size=embedding_info['patch_size'])
+    with stage('fg_mask'):
+        embedding_info['fg_mask'] = fg_model.mask(embedding_info['embedding'])
+    return dict(image=image_info, patch=embedding_info)
+
+
+async def get_embedding(query_img: QueryImage, embedding_type: str):
     assert embedding_type in ['image', 'patch']
-    api_url = IMAGE_EMBEDDING_API if embedding_type == 'image' else PATCH_EMBEDDING_API
-    response = requests.post(api_url, json=dict(image_path=image_path))
-    response.raise_for_status()
-    return response.json()
-
-
-def recommend_imgs_by_image_embedding(image_path: str):
-    embedding_info = get_embedding(image_path=image_path,
-                                   embedding_type='image')
-    results = db.search('image_embeddings',
-                        data=[embedding_info['embedding']],
-                        output_fields=['image_id'],
-                        search_params={'metric_type': 'COSINE'},
-                        limit=args.top_k)[0]
-    return [info['entity']['image_id'] for info in results]
-
-
-def recommend_imgs_by_patch_embedding(image_path: str, focus_area: dict):
-    embedding_info = get_embedding(image_path=image_path,
-                                   embedding_type='patch')
-    patch_embedding, image_shape, patch_size, embedding_shape = embedding_info[
-        'embedding'], embedding_info['image_shape'], embedding_info[
-            'patch_size'], embedding_info['embedding_shape']
-    target_coords = resize_coords(coords=dict(x1=focus_area['x1'],
-                                              y1=focus_area['y1'],
-                                              x2=focus_area['x2'],
-                                              y2=focus_area['y2']),
-                                  coords_img_size=(focus_area['height'],
-                                                   focus_area['width']),
-                                  target_img_size=image_shape)
-    focus_patches_embedding = locate_focus_patches(
-        embedding=patch_embedding,
-        coords=target_coords,
-        patch_size=patch_size,
-        image_shape=image_shape,
-        embedding_shape=embedding_shape)
+    if embedding_type == 'image' and query_img.image_id is not None:
+        with stage('index_lookup'):
+            stored_embedding = await run_blocking(index.get_image_embedding,
+                                                  query_img.image_id)
+        if stored_embedding is not None:
+            return dict(embedding=stored_embedding)
+
+    if embedding_type == 'patch' and query_img.image_id is not None:
+        with stage('index_lookup'):
+            patch_grid = await run_blocking(index.get_patch_grid,
+                                            query_img.image_id)
+        if patch_grid is not None:
+            return patch_grid
+
+    namespace = await embedding_namespace()
+    # cached patch entries carry a foreground mask of the loaded model
+    namespaces = dict(image=namespace,
+                      patch=f'{namespace}:{fg_model_digest}')
+    keys = {
+        key_type: cache_key(content_key=query_img.image_hash or
+                            query_img.image_path,
+                            embedding_type=key_type,
+                            namespace=key_namespace)
+        for key_type, key_namespace in namespaces.items()
+    }
+    embedding_info = await embedding_cache.get(keys[embedding_type])
+    if embedding_info is None:
+        # both embeddings come from one forward pass; cache the other one
+        # for a later query on the same image
+        embedding_infos = split_combined_embedding(await request_embedding(
+            query_img.image_path))
+        for key_type, info in embedding_infos.items():
+            await embedding_cache.put(keys[key_type], info)
+        embedding_info = embedding_infos[embedding_type]
+    return embedding_info
+
+
+async def recommend_imgs_by_image_embedding(query_img: QueryImage):
+    embedding_info = await get_embedding(query_img, embedding_type='image')
+    return await cached_search(embedding_info['embedding'], None,
+                               search_images, embedding_info['embedding'])
+
+
+def search_images(embedding: np.ndarray):
+    with stage('image_search'):
+        image_ids, _ = index.search_images(embedding, limit=args.top_k)
+    return image_ids
+
+
+def search_focus_candidates(focus_patches_embedding: np.ndarray):
+    # coarse stage: the mean focus region picks C candidate images; the
+    # exact patch max-sim then only scores those images' patches
+    region_embedding = l2_normalize(focus_patches_embedding).mean(axis=0)
+    search_candidates = index.search_patch_centroids if (
+        args.focus_candidate_source == 'centroid') else index.search_images
+    with stage('candidate_search'):
+        candidate_ids, _ = search_candidates(region_embedding,
+                                             limit=args.focus_candidates)
+    with stage('candidate_patches'):
+        patch_image_ids, patch_embedding = index.get_patches(candidate_ids)
+    with stage('rank'):
+        return rank_images_by_max_sim(l2_normalize(focus_patches_embedding),
+                                      patch_image_ids,
+                                      patch_embedding,
+                                      top_k=args.top_k)
+
+
+def search_focus_patches(focus_patches_embedding: np.ndarray):
+    if args.focus_candidates:
+        return search_focus_candidates(focus_patches_embedding)
+    with stage('patch_search'):
+        hit_image_ids, hit_scores, hit_queries = index.search_patches(
+            focus_patches_embedding,
+            limit=args.focus_top_m,
+            chunk_size=args.focus_chunk_size)
+    with stage('rank'):
+        return rank_images_by_patch_hits(
+            hit_image_ids,
+            hit_scores,
+            hit_queries,
+            num_queries=len(focus_patches_embedding),
+            top_k=args.top_k)
+
+
+async def recommend_imgs_by_patch_embedding(query_img: QueryImage,
+                                            focus_area: dict):
+    embedding_info = await get_embedding(query_img, embedding_type='patch')
+    boxes, polygons = parse_regions(focus_area)
+    # focus coordinates are relative to the image as displayed
+    coords_img_size = (focus_area['height'], focus_area['width'])
+    boxes = resize_points(boxes, coords_img_size,
+                          embedding_info['image_shape'])
+    polygons = [
+        resize_points(polygon, coords_img_size, embedding_info['image_shape'])
+        for polygon in polygons
+    ]
+    with stage('focus_select'):
+        if 'grid' in embedding_info:
+            focus_patches_embedding = embedding_info['embedding'][
+                select_grid_rows(embedding_info['grid'],
+                                 boxes,
+                                 polygons,
+                                 patch_size=embedding_info['patch_size'],
+                                 image_shape=embedding_info['image_shape'])]
+        else:
+            focus_patches_embedding = extract_region_patches(
+                embedding=embedding_info['embedding'],
+                fg_mask=embedding_info['fg_mask'],
+                boxes=boxes,
+                polygons=polygons,
+                patch_size=embedding_info['patch_size'],
+                image_shape=embedding_info['image_shape'],
+                embedding_shape=embedding_info['embedding_shape'])
 
     if not focus_patches_embedding.size:
-        return recommend_imgs_by_image_embedding(image_path=image_path)
-
-    distances = []
-    all_images = db.query(collection_name='image_embeddings',
-                          filter='id > 0',
-                          output_fields=['image_id'])
-    for image_in_db in all_images:
-        image_id = image_in_db['image_id']
-        results = db.search(collection_name='patch_embeddings',
-                            data=focus_patches_embedding,
-                            filter=f'image_id == "{image_id}"',
-                            output_fields=['image_id'],
-                            limit=1)
-        mean_distances = [r[0]['distance'] for r in results]
-        distances.append({
-            'image_id': image_id,
-            'distance': np.mean(mean_distances)
-        })
-    sorted_distance = sorted(distances,
-                             key=lambda a: a['distance'],
-                             reverse=True)
-
-    return [i['image_id'] for i in sorted_distance][:args.top_k]
-
-
-def recommend_imgs(image_path: str, focus_area: Optional[dict] = None):
-    return recommend_imgs_by_patch_embedding(
-        image_path, focus_area
-    ) if focus_area is not None else recommend_imgs_by_image_embedding(
-        image_path)
-
-
-app = FastAPI()
-args = arg_parse()
-db = load_db(db_file=args.db_file)
-fg_pipeline = load_fg_pipeline(pkl_file=args.fg_pipeline)
-
-
-@app.post('/recommend-image/')
+        return await recommend_imgs_by_image_embedding(query_img)
+
+    focus_cells = region_mask(
+        boxes, polygons, embedding_info['patch_size'],
+        grid_shape(embedding_info['image_shape'],
+                   embedding_info['patch_size']))
+    return await cached_search(embedding_info['embedding'], focus_cells,
+                               search_focus_patches, focus_patches_embedding)
+
+
+async def recommend_imgs(query_img: QueryImage):
+    focus_area = query_img.coords_info
+    if focus_area is not None:
+        return await recommend_imgs_by_patch_embedding(query_img, focus_area)
+    return await recommend_imgs_by_image_embedding(query_img)
+
+
+args = None
+readiness: Optional[Readiness] = None
+EMBEDDING_API = MODEL_INFO_API = None
+index = index_executor = fg_model = fg_model_digest = None
+embedding_cache = http_client = result_cache = index_watcher = None
+milvus_version_file: Optional[str] = None
+model_namespace: Optional[str] = None
+
+
+def load_index_version():
+    global index, fg_model, fg_model_digest
+    new_index = load_index(backend=args.index_backend,
+                           db_file=args.db_file,
+                           index_dir=args.index_dir,
+                           nprobe=args.nprobe,
+                           ef=args.ef,
+                           num_shards=args.num_shards)
+    assert args.focus_candidate_source != 'centroid' or (
+        new_index.has_patch_centroids), 'index has no patch centroids'
+    # a numpy index version carries the foreground model it was built with
+    new_fg_model = ForegroundModel.load(
+        getattr(new_index, 'fg_model_file', None) or args.fg_pipeline)
+    # searches already running keep their reference to the old index, whose
+    # mapped files stay readable after the indexer removes them
+    index, fg_model = new_index, new_fg_model
+    fg_model_digest = hashlib.sha1(fg_model.weight.tobytes()).hexdigest()[:12]
+
+
+async def watch_index_version():
+    version_file = index_version_file(backend='numpy',
+                                      index_dir=args.index_dir)
+    while True:
+        await asyncio.sleep(args.index_poll_interval)
+        version = read_index_version(version_file)
+        if version == index.version:
+            continue
+        logger.info(f'Swap numpy index: {index.version} -> {version}')
+        try:
+            await asyncio.to_thread(load_index_version)
+        except Exception:
+            logger.exception(f'Loading index version {version} failed')
+
+
+def load_services():
+    # runs on a worker thread while the server already answers probes
+    global embedding_cache, result_cache, milvus_version_file
+    load_index_version()
+    embedding_cache = EmbeddingCache(
+        max_bytes=args.embedding_cache_bytes,
+        spill_dir=args.embedding_cache_dir,
+        spill_max_bytes=args.embedding_cache_dir_bytes)
+    milvus_version_file = index_version_file(
+        backend='milvus',
+        db_file=args.db_file,
+        version_file=args.index_version_file)
+    if args.result_cache_size and args.index_backend == 'milvus' and (
+            milvus_version_file is None):
+        logger.warning('No index version file (Milvus server URI without '
+                       '--index-version-file): cached results only expire '
+                       'after the ttl')
+    result_cache = ResultCache(
+        max_entries=args.result_cache_size,
+        ttl=args.result_cache_ttl) if args.result_cache_size else None
+    track_cache('result', result_cache)
+    track_cache('embedding', embedding_cache)
+
+
+async def start_services():
+    global index_watcher
+    await asyncio.to_thread(load_services)
+    if args.index_backend == 'numpy' and args.index_poll_interval > 0:
+        index_watcher = asyncio.create_task(watch_index_version())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global index_executor, http_client
+    index_executor = ThreadPoolExecutor(max_workers=args.index_threads,
+                                        thread_name_prefix='index')
+    http_client = build_async_client(
+        timeout=args.http_timeout,
+        connect_timeout=args.http_connect_timeout,
+        max_connections=args.http_max_connections)
+    track_queue('index', executor_queue_size(index_executor))
+    readiness.start(start_services)
+    yield
+    await readiness.stop()
+    if index_watcher is not None:
+        index_watcher.cancel()
+    await http_client.aclose()
+    index_executor.shutdown(wait=False)
+
+
+async def require_ready():
+    await readiness.require()
+
+
+router = APIRouter(dependencies=[Depends(require_ready)])
+
+
+@router.get('/cache-stats/')
+async def cache_stats():
+    return dict(result=result_cache.stats() if result_cache is not None else
+                None,
+                embedding=dict(entries=len(embedding_cache.entries),
+                               bytes=embedding_cache.total_bytes,
+                               hits=embedding_cache.hits,
+                               misses=embedding_cache.misses))
+
+
+@router.post('/recommend-image/')
 async def recommend_image(query_img: QueryImage):
-    img_ids = recommend_imgs(image_path=query_img.image_path,
-                             focus_area=query_img.coords_info)
+    img_ids = await recommend_imgs(query_img)
     return img_ids
 
 
+def create_app(cli_args=None):
+    global args, readiness, EMBEDDING_API, MODEL_INFO_API
+    args = cli_args or arg_parse()
+    EMBEDDING_API = f'{args.embedding_url}/generate-embedding/'
+    MODEL_INFO_API = f'{args.embedding_url}/model-info/'
+    readiness = Readiness('recommender')
+    app = FastAPI(lifespan=lifespan)
+    instrument_app(app, service='recommender')
+    add_health_routes(app, readiness)
+    app.include_router(router)
+    return app
+
+
 if __name__ == '__main__':
-    uvicorn.run(app, host=args.host, port=args.port)
+    args = arg_parse()
+    if args.workers > 1:
+        # every worker builds its own app from the same command line and
+        # maps the same index files; BLAS threads are split between them
+        threads = str(max(1, (os.cpu_count() or 1) // args.workers))
+        for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                     'MKL_NUM_THREADS'):
+            os.environ.setdefault(name, threads)
+        prepare_multiprocess_dir()
+        uvicorn.run('recommender:create_app',
+                    factory=True,
+                    host=args.host,
+                    port=args.port,
+                    workers=args.workers)
+    else:
+        uvicorn.run(create_app(args), host=args.host, port=args.port)
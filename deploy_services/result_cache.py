@@ -0,0 +1,58 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from loguru import logger
+
+
+def result_key(embedding: np.ndarray, focus_cells: np.ndarray, top_k: int):
+    digest = hashlib.sha1(np.ascontiguousarray(embedding).tobytes())
+    if focus_cells is not None:
+        digest.update(str(focus_cells.shape).encode())
+        digest.update(np.packbits(focus_cells).tobytes())
+    digest.update(f':{top_k}'.encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+        logger.info(f'Result cache: {max_entries} entries, ttl {ttl}s')
+
+    def get(self, key: str, version: str):
+        # version: of the index that would answer the search now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] != version or
+                                      entry[1] < time.monotonic()):
+                del self.entries[key]
+                self.invalidations += entry[0] != version
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: str, version: str, result):
+        # version: of the index that answered the search, read before it ran
+        with self.lock:
+            self.entries[key] = (version, time.monotonic() + self.ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries),
+                        hits=self.hits,
+                        misses=self.misses,
+                        invalidations=self.invalidations)
@@ -0,0 +1,209 @@
+import atexit
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from fastapi import FastAPI, Request
+from loguru import logger
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram,
+                               make_asgi_app, multiprocess)
+from prometheus_client.core import CounterMetricFamily, REGISTRY
+
+TRACE_HEADER = 'X-Trace-Id'
+UNTRACED_PATHS = ('/metrics', '/healthz', '/readyz')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds',
+                            'Latency of HTTP requests',
+                            labelnames=('method', 'path', 'status'),
+                            buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram('stage_duration_seconds',
+                          'Latency of a processing stage within a request',
+                          labelnames=('stage', ),
+                          buckets=LATENCY_BUCKETS)
+# set for the worker processes of a multi-worker server; their metrics are
+# written to files in this directory and /metrics adds them up
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight',
+                           'HTTP requests being served',
+                           multiprocess_mode='livesum')
+QUEUE_DEPTH = Gauge('queue_depth',
+                    'Items waiting in a work queue',
+                    labelnames=('queue', ),
+                    multiprocess_mode='livesum')
+
+trace_id_var: ContextVar[str] = ContextVar('trace_id', default='-')
+
+
+def trace_headers():
+    return {TRACE_HEADER: trace_id_var.get()}
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(name).observe(time.perf_counter() - start)
+
+
+def prepare_multiprocess_dir():
+    # called by the parent process before the workers start; files left by
+    # an earlier run would be added to the new counters
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir is None:
+        metrics_dir = tempfile.mkdtemp(prefix='prometheus-')
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+        atexit.register(shutil.rmtree, metrics_dir, ignore_errors=True)
+    Path(metrics_dir).mkdir(parents=True, exist_ok=True)
+    for db_file in Path(metrics_dir).glob('*.db'):
+        db_file.unlink()
+    logger.info(f'Prometheus multiprocess metrics in {metrics_dir}')
+    return metrics_dir
+
+
+queue_sizes = {}
+
+
+def track_queue(name: str, size_func):
+    # function gauges are read at collection time, which a multiprocess
+    # collector cannot do for other workers; there they are sampled instead
+    if MULTIPROCESS:
+        queue_sizes[name] = size_func
+    else:
+        QUEUE_DEPTH.labels(name).set_function(size_func)
+
+
+def executor_queue_size(executor):
+    # submitted but unfinished work: thread pools queue it in _work_queue,
+    # process pools track it in _pending_work_items
+    if hasattr(executor, '_work_queue'):
+        return lambda: executor._work_queue.qsize()
+    return lambda: len(executor._pending_work_items)
+
+
+class CacheCollector:
+    # exports the hit/miss counters that the caches already keep
+
+    def __init__(self):
+        self.caches = {}
+
+    def collect(self):
+        hits = CounterMetricFamily('cache_hits', 'Cache hits',
+                                   labels=['cache'])
+        misses = CounterMetricFamily('cache_misses', 'Cache misses',
+                                     labels=['cache'])
+        for name, cache in self.caches.items():
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+        yield hits
+        yield misses
+
+
+class CacheCounters:
+    # multiprocess variant of CacheCollector: the counters of this worker's
+    # caches are added to shared counters as deltas since the last sync
+
+    def __init__(self):
+        self.caches = {}
+        self.synced = {}
+        self.hits = Counter('cache_hits', 'Cache hits', labelnames=('cache', ))
+        self.misses = Counter('cache_misses',
+                              'Cache misses',
+                              labelnames=('cache', ))
+
+    def sync(self):
+        for name, cache in self.caches.items():
+            synced_hits, synced_misses = self.synced.get(name, (0, 0))
+            hits, misses = cache.hits, cache.misses
+            self.hits.labels(name).inc(max(0, hits - synced_hits))
+            self.misses.labels(name).inc(max(0, misses - synced_misses))
+            self.synced[name] = (hits, misses)
+
+
+if MULTIPROCESS:
+    cache_collector = CacheCounters()
+else:
+    cache_collector = CacheCollector()
+    REGISTRY.register(cache_collector)
+
+
+def track_cache(name: str, cache):
+    if cache is not None:
+        cache_collector.caches[name] = cache
+
+
+def sync_process_metrics():
+    # cache counters and queue depths only change while requests are served,
+    # so each worker writes them out when a request finishes
+    if not MULTIPROCESS:
+        return
+    cache_collector.sync()
+    for name, size_func in queue_sizes.items():
+        QUEUE_DEPTH.labels(name).set(size_func())
+
+
+def pid_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def metrics_app():
+    if not MULTIPROCESS:
+        return make_asgi_app()
+    # live gauges of a worker that died (and was replaced) would still count
+    for db_file in Path(os.environ['PROMETHEUS_MULTIPROC_DIR']).glob(
+            'gauge_live*.db'):
+        pid = int(db_file.stem.rsplit('_', 1)[1])
+        if not pid_alive(pid):
+            multiprocess.mark_process_dead(pid)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return make_asgi_app(registry)
+
+
+def instrument_app(app: FastAPI, service: str):
+    app.mount('/metrics', metrics_app())
+
+    @app.middleware('http')
+    async def trace_request(request: Request, call_next):
+        if request.url.path.startswith(UNTRACED_PATHS):
+            if request.url.path.startswith('/metrics'):
+                sync_process_metrics()
+            return await call_next(request)
+        # a trace id from the caller is kept so one search can be followed
+        # through the Django app, the recommender and the embedding service
+        trace_id = request.headers.get(TRACE_HEADER) or uuid.uuid4().hex
+        token = trace_id_var.set(trace_id)
+        start = time.perf_counter()
+        status = 500
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            response.headers[TRACE_HEADER] = trace_id
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            sync_process_metrics()
+            route = request.scope.get('route')
+            REQUEST_LATENCY.labels(request.method,
+                                   getattr(route, 'path', 'unmatched'),
+                                   status).observe(elapsed)
+            logger.info(f'[{service}] trace={trace_id} {request.method} '
+                        f'{request.url.path} {status} {elapsed * 1000:.1f}ms')
+            trace_id_var.reset(token)
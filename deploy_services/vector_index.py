@@ -0,0 +1,946 @@
+import heapq
+import itertools
+import json
+import os
+import shutil
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+
+from focus_search import search_patch_hits
+from patch_codec import PATCH_CODEC_FILE, build_codec, load_codec, save_codec
+
+if TYPE_CHECKING:
+    from pymilvus import MilvusClient
+
+IMAGE_IDS_FILE = 'image_ids.npy'
+IMAGE_EMBEDDINGS_FILE = 'image_embeddings.npy'
+PATCH_IMAGE_INDEX_FILE = 'patch_image_index.npy'
+PATCH_EMBEDDINGS_FILE = 'patch_embeddings.npy'
+IMAGE_META_FILE = 'image_meta.npy'
+IMAGE_HASHES_FILE = 'image_hashes.npy'
+PATCH_GRID_FILE = 'patch_grid.npy'
+PATCH_CENTROIDS_FILE = 'patch_centroids.npy'
+IMAGE_SORTER_FILE = 'image_sorter.npy'
+FG_MODEL_FILE = 'fg_model.npz'
+INDEX_VERSION_FILE = 'index_version'
+SHARD_MANIFEST_FILE = 'shards-{version}.json'
+# published versions kept next to the current one, for readers that read the
+# version file just before a newer version was published
+KEEP_INDEX_VERSIONS = 2
+IMAGE_META_FIELDS = ('image_height', 'image_width', 'patch_size')
+PATCH_GRID_FIELDS = ('grid_y', 'grid_x')
+# content hash of the embedded image, so the indexer re-embeds changed images
+IMAGE_HASH_FIELD = 'md5_hash'
+# Milvus Lite only builds FLAT, IVF_FLAT and AUTOINDEX; the other types need a
+# Milvus server (pass its URI as the db file)
+INDEX_TYPES = ('AUTOINDEX', 'FLAT', 'IVF_FLAT', 'IVF_SQ8', 'IVF_PQ', 'HNSW')
+
+
+def load_db(db_file: str):
+    # pymilvus takes about a second to import; numpy-backed services never
+    # pay for it
+    from pymilvus import MilvusClient
+    logger.info(f'Load db: {db_file}')
+    if Path(f'.{db_file}.lock').exists():
+        os.remove(f'.{db_file}.lock')
+    return MilvusClient(db_file)
+
+
+def collection_fields(db: 'MilvusClient', collection_name: str):
+    return {
+        field['name']: field['type']
+        for field in db.describe_collection(collection_name)['fields']
+    }
+
+
+def query_rows(db: 'MilvusClient',
+               collection_name: str,
+               output_fields: List[str],
+               row_filter: str = '',
+               batch_size: int = 16384):
+    # pages in primary key order: a query with a limit returns any matching
+    # rows, so paging it by `id > max(id)` can skip some
+    from pymilvus import Collection
+    iterator = Collection(collection_name,
+                          using=db._using).query_iterator(
+                              batch_size=batch_size,
+                              expr=row_filter,
+                              output_fields=output_fields)
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                return
+            yield rows
+    finally:
+        iterator.close()
+
+
+def parse_index_params(values: Optional[List[str]]):
+    # ['nlist=1024', 'm=16'] -> {'nlist': 1024, 'm': 16}
+    params = {}
+    for value in values or []:
+        key, value = value.split('=', 1)
+        params[key] = json.loads(value)
+    return params
+
+
+def build_index_params(index_type: str = 'AUTOINDEX',
+                       params: Optional[dict] = None):
+    from pymilvus import MilvusClient
+    assert index_type in INDEX_TYPES
+    index_params = MilvusClient.prepare_index_params()
+    index_params.add_index(field_name='embedding',
+                           metric_type='COSINE',
+                           index_type=index_type,
+                           index_name='embedding_index',
+                           params=params or {})
+    return index_params
+
+
+def build_search_params(limit: int,
+                        nprobe: Optional[int] = None,
+                        ef: Optional[int] = None):
+    # IVF_* indexes read nprobe, HNSW reads ef (which must be >= limit);
+    # parameters of other index types are ignored by Milvus
+    params = {}
+    if nprobe:
+        params['nprobe'] = nprobe
+    if ef:
+        params['ef'] = max(ef, limit)
+    return {'metric_type': 'COSINE', 'params': params}
+
+
+def is_server_uri(db_file: str):
+    return db_file.startswith(('http://', 'https://'))
+
+
+def read_index_version(version_file: Optional[str]):
+    if version_file is None:
+        return ''
+    try:
+        return Path(version_file).read_text().strip()
+    except FileNotFoundError:
+        return ''
+
+
+def new_index_version():
+    return str(time.time_ns())
+
+
+def write_index_version(version_file: Optional[str],
+                        version: Optional[str] = None):
+    # written by the indexer after new vectors are visible; the recommender
+    # drops cached results computed under another version
+    version = version or new_index_version()
+    if version_file is None:
+        return version
+    tmp_file = Path(f'{version_file}.tmp')
+    tmp_file.write_text(version)
+    tmp_file.replace(version_file)
+    logger.info(f'Index version: {version} ({version_file})')
+    return version
+
+
+def index_version_file(backend: str,
+                       db_file: Optional[str] = None,
+                       index_dir: Optional[str] = None,
+                       version_file: Optional[str] = None):
+    if backend == 'milvus':
+        # a Milvus server URI has no local path to put the version next to;
+        # its indexer and recommenders share an explicit version file
+        if version_file or is_server_uri(db_file):
+            return version_file
+        return f'{db_file}.version'
+    return str(Path(index_dir) / INDEX_VERSION_FILE)
+
+
+def resolve_index_dir(index_dir: str):
+    # a numpy index publishes each version into index_dir/<version>/ and
+    # then points the version file at it; indexes written before versioned
+    # directories keep their files in index_dir itself
+    index_dir = Path(index_dir)
+    version = read_index_version(index_dir / INDEX_VERSION_FILE)
+    if version and (index_dir / version).is_dir():
+        return index_dir / version, version
+    return index_dir, version
+
+
+def write_shard_manifest(index_dir: str, shard_versions: List[str]):
+    # the top-level version of a sharded numpy index pins one version of
+    # every shard: the manifest is written first and published with the
+    # version file, so readers never load shard versions of two runs
+    index_dir = Path(index_dir)
+    version = new_index_version()
+    manifest_file = index_dir / SHARD_MANIFEST_FILE.format(version=version)
+    tmp_file = Path(f'{manifest_file}.tmp')
+    tmp_file.write_text(json.dumps(shard_versions))
+    tmp_file.replace(manifest_file)
+    write_index_version(index_dir / INDEX_VERSION_FILE, version)
+    manifests = sorted(index_dir.glob(SHARD_MANIFEST_FILE.format(version='*')),
+                       key=lambda path: int(path.stem.split('-')[1]))
+    for path in manifests[:-(KEEP_INDEX_VERSIONS + 1)]:
+        path.unlink()
+    return version
+
+
+def read_shard_manifest(index_dir: str, version: str):
+    # None for sharded indexes published before manifests existed
+    manifest_file = Path(index_dir) / SHARD_MANIFEST_FILE.format(
+        version=version)
+    if not version or not manifest_file.exists():
+        return None
+    return json.loads(manifest_file.read_text())
+
+
+def shard_of(image_ids: List[str], num_shards: int):
+    # crc32 rather than the salted built-in hash: every process and every
+    # run has to agree on the shard of an image
+    return np.asarray(
+        [zlib.crc32(image_id.encode()) % num_shards for image_id in image_ids],
+        dtype=np.int64)
+
+
+def shard_db_file(db_file: str, shard: int, num_shards: int):
+    # shard 0 of 4 of embedding.db is embedding.shard0.db
+    if num_shards == 1:
+        return db_file
+    path = Path(db_file)
+    return str(path.with_name(f'{path.stem}.shard{shard}{path.suffix}'))
+
+
+def shard_index_dir(index_dir: str, shard: int, num_shards: int):
+    if num_shards == 1:
+        return index_dir
+    return str(Path(index_dir) / f'shard{shard}')
+
+
+def l2_normalize(embedding: np.ndarray):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding, axis=-1, keepdims=True)
+    return embedding / np.maximum(norm, np.finfo(np.float32).tiny)
+
+
+def top_k_indices(scores: np.ndarray, k: int):
+    k = min(k, scores.shape[-1])
+    if k < scores.shape[-1]:
+        indices = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[-1]),
+                                  scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, indices, axis=-1),
+                       axis=-1,
+                       kind='stable')
+    return np.take_along_axis(indices, order, axis=-1)
+
+
+class MilvusIndex:
+
+    def __init__(self,
+                 db: 'MilvusClient',
+                 nprobe: Optional[int] = None,
+                 ef: Optional[int] = None):
+        from pymilvus import DataType
+        self.db = db
+        self.nprobe = nprobe
+        self.ef = ef
+        patch_fields = collection_fields(db, 'patch_embeddings')
+        self.has_patch_grid = set(PATCH_GRID_FIELDS) <= set(patch_fields)
+        # collections written by older versions have no image hashes
+        self.has_image_hash = IMAGE_HASH_FIELD in collection_fields(
+            db, 'image_embeddings')
+        # a FLOAT16_VECTOR collection only accepts float16 query vectors
+        self.patch_dtype = np.float16 if patch_fields['embedding'] == (
+            DataType.FLOAT16_VECTOR) else np.float32
+        self.has_patch_centroids = False
+
+    def search_images(self, embedding: np.ndarray, limit: int):
+        results = self.db.search('image_embeddings',
+                                 data=[embedding],
+                                 output_fields=['image_id'],
+                                 search_params=build_search_params(
+                                     limit, nprobe=self.nprobe, ef=self.ef),
+                                 limit=limit)[0]
+        return ([info['entity']['image_id'] for info in results],
+                [info['distance'] for info in results])
+
+    def get_image_embedding(self, image_id: str):
+        results = self.db.query('image_embeddings',
+                                filter=f'image_id == "{image_id}"',
+                                output_fields=['embedding'],
+                                limit=1)
+        if not results:
+            return None
+        return np.asarray(results[0]['embedding'], dtype=np.float32)
+
+    def _patch_vectors(self, patch_rows: List[dict]):
+        embedding = np.asarray([
+            np.frombuffer(row['embedding'][0], dtype=np.float16) if
+            self.patch_dtype == np.float16 else row['embedding']
+            for row in patch_rows
+        ],
+                               dtype=np.float32)
+        return embedding.reshape(len(patch_rows), -1)
+
+    def get_patches(self, image_ids: List[str]):
+        patch_image_ids, embeddings = [], []
+        image_filter = f'image_id in {json.dumps(list(image_ids))}'
+        # one filtered query, paged past the topk limit
+        for patch_rows in query_rows(self.db,
+                                     'patch_embeddings',
+                                     ['image_id', 'embedding'],
+                                     row_filter=image_filter):
+            patch_image_ids.extend(row['image_id'] for row in patch_rows)
+            # rows come back as inserted; the COSINE metric normalizes them
+            embeddings.append(l2_normalize(self._patch_vectors(patch_rows)))
+        return np.asarray(patch_image_ids, dtype=str), (np.concatenate(
+            embeddings) if embeddings else np.empty((0, 0), dtype=np.float32))
+
+    def get_patch_grid(self, image_id: str):
+        if not self.has_patch_grid:
+            return None
+        image_filter = f'image_id == "{image_id}"'
+        image_rows = self.db.query('image_embeddings',
+                                   filter=image_filter,
+                                   output_fields=list(IMAGE_META_FIELDS),
+                                   limit=1)
+        if not image_rows:
+            return None
+        patch_rows = self.db.query('patch_embeddings',
+                                   filter=image_filter,
+                                   output_fields=[
+                                       'embedding', *PATCH_GRID_FIELDS
+                                   ],
+                                   limit=16384)
+        return dict(
+            embedding=self._patch_vectors(patch_rows),
+            grid=np.asarray([[row[field] for field in PATCH_GRID_FIELDS]
+                             for row in patch_rows],
+                            dtype=np.int16).reshape(-1, 2),
+            image_shape=[
+                image_rows[0]['image_height'], image_rows[0]['image_width']
+            ],
+            patch_size=image_rows[0]['patch_size'])
+
+    def search_patches(self,
+                       embedding: np.ndarray,
+                       limit: int,
+                       chunk_size: int = 256):
+        return search_patch_hits(self.db,
+                                 focus_embedding=np.asarray(
+                                     embedding, dtype=self.patch_dtype),
+                                 top_m=limit,
+                                 chunk_size=chunk_size,
+                                 search_params=build_search_params(
+                                     limit, nprobe=self.nprobe, ef=self.ef))
+
+
+class MilvusBulkInserter:
+
+    def __init__(self,
+                 db: 'MilvusClient',
+                 collection_name: str,
+                 batch_size: int = 100000,
+                 max_request_bytes: int = 2**20,
+                 vector_dtype=np.float32):
+        self.db = db
+        self.collection_name = collection_name
+        self.vector_dtype = vector_dtype
+        self.batch_size = batch_size
+        self.max_request_bytes = max_request_bytes
+        self.image_ids: List[str] = []
+        self.embeddings: List[np.ndarray] = []
+        self.fields: Dict[str, List[np.ndarray]] = {}
+        self.num_inserted = 0
+        self.insert_time = 0.0
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def add(self,
+            image_ids: List[str],
+            embedding: np.ndarray,
+            fields: Optional[Dict[str, np.ndarray]] = None):
+        assert len(image_ids) == len(embedding)
+        self.image_ids.extend(image_ids)
+        self.embeddings.append(embedding)
+        for name, values in (fields or {}).items():
+            assert len(values) == len(image_ids)
+            self.fields.setdefault(name, []).append(np.asarray(values))
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.image_ids:
+            return
+        start = time.perf_counter()
+        embedding = np.ascontiguousarray(np.concatenate(self.embeddings),
+                                         dtype=self.vector_dtype)
+        fields = {
+            name: np.concatenate(values).tolist()
+            for name, values in self.fields.items()
+        }
+        rows_per_request = max(1,
+                               self.max_request_bytes // embedding[0].nbytes)
+        for offset in range(0, len(embedding), rows_per_request):
+            end = offset + rows_per_request
+            rows = [{
+                'image_id': image_id,
+                'embedding': row
+            } for image_id, row in zip(self.image_ids[offset:end],
+                                       embedding[offset:end])]
+            for name, values in fields.items():
+                for row, value in zip(rows, values[offset:end]):
+                    row[name] = value
+            self.db.insert(self.collection_name, rows)
+        elapsed = time.perf_counter() - start
+        self.num_inserted += len(embedding)
+        self.insert_time += elapsed
+        logger.info(f'Insert {len(embedding)} rows into {self.collection_name}'
+                    f' ({len(embedding) / elapsed:.0f} rows/s, '
+                    f'{self.num_inserted} rows total)')
+        self.image_ids, self.embeddings, self.fields = [], [], {}
+
+
+class NumpyIndex:
+
+    def __init__(self,
+                 index_dir: str,
+                 mmap: bool = True,
+                 version: Optional[str] = None):
+        mmap_mode = 'r' if mmap else None
+        # files are read-only maps of the page cache, shared by every
+        # recommender worker that loads the same version; a shard loads the
+        # version pinned by the manifest rather than its latest one
+        if version:
+            index_dir, self.version = Path(index_dir) / version, version
+        else:
+            index_dir, self.version = resolve_index_dir(index_dir)
+        self.index_dir = index_dir
+        logger.info(f'Load numpy index: {index_dir} (mmap: {mmap})')
+        self.image_ids = np.load(index_dir / IMAGE_IDS_FILE,
+                                 mmap_mode=mmap_mode)
+        self.image_embeddings = np.load(index_dir / IMAGE_EMBEDDINGS_FILE,
+                                        mmap_mode=mmap_mode)
+        self.patch_image_index = np.load(index_dir / PATCH_IMAGE_INDEX_FILE,
+                                         mmap_mode=mmap_mode)
+        self.patch_embeddings = np.load(index_dir / PATCH_EMBEDDINGS_FILE,
+                                        mmap_mode=mmap_mode)
+        # grid and hash sidecars are missing in indexes written by older
+        # versions
+        self.image_meta, self.patch_grid, self.image_hashes = [
+            np.load(index_dir / file_name, mmap_mode=mmap_mode) if
+            (index_dir / file_name).exists() else None
+            for file_name in (IMAGE_META_FILE, PATCH_GRID_FILE,
+                              IMAGE_HASHES_FILE)
+        ]
+        self.patch_centroids = np.load(
+            index_dir / PATCH_CENTROIDS_FILE, mmap_mode=mmap_mode) if (
+                index_dir / PATCH_CENTROIDS_FILE).exists() else None
+        self.has_patch_centroids = self.patch_centroids is not None
+        self.patch_codec = load_codec(index_dir,
+                                      self.image_embeddings.shape[1])
+        self.scan_size = self.patch_codec.scan_size
+        self.image_sorter = np.load(
+            index_dir / IMAGE_SORTER_FILE, mmap_mode=mmap_mode) if (
+                index_dir / IMAGE_SORTER_FILE).exists() else np.argsort(
+                    self.image_ids)
+        self.fg_model_file = index_dir / FG_MODEL_FILE if (
+            index_dir / FG_MODEL_FILE).exists() else None
+
+    def image_rows(self, image_ids: np.ndarray):
+        image_ids = np.asarray(image_ids)
+        position = np.searchsorted(self.image_ids,
+                                   image_ids,
+                                   sorter=self.image_sorter)
+        position = np.minimum(position, len(self.image_ids) - 1)
+        rows = self.image_sorter[position]
+        return np.where(self.image_ids[rows] == image_ids, rows, -1)
+
+    def search_images(self, embedding: np.ndarray, limit: int):
+        scores = self.image_embeddings @ l2_normalize(embedding)
+        indices = top_k_indices(scores, limit)
+        return self.image_ids[indices].tolist(), scores[indices].tolist()
+
+    def get_image_embedding(self, image_id: str):
+        if not len(self.image_ids):
+            return None
+        row = self.image_rows([image_id])[0]
+        return None if row < 0 else np.asarray(self.image_embeddings[row])
+
+    def search_patch_centroids(self, embedding: np.ndarray, limit: int):
+        scores = self.patch_centroids @ l2_normalize(embedding)
+        indices = top_k_indices(scores, limit)
+        return self.image_ids[indices].tolist(), scores[indices].tolist()
+
+    def patch_rows(self, image_rows: np.ndarray):
+        # patch rows are written in the same order as their images
+        starts = np.searchsorted(self.patch_image_index, image_rows)
+        ends = np.searchsorted(self.patch_image_index, image_rows + 1)
+        return np.concatenate(
+            [np.arange(start, end) for start, end in zip(starts, ends)] +
+            [np.empty(0, dtype=np.int64)])
+
+    def get_patches(self, image_ids: List[str]):
+        image_rows = self.image_rows(image_ids) if len(
+            self.image_ids) else np.empty(0, dtype=np.int64)
+        rows = self.patch_rows(np.sort(image_rows[image_rows >= 0]))
+        # decoded rows are not renormalized: the dot product with a decoded
+        # unit row is the score the codec gives it in the full patch scan
+        return (self.image_ids[self.patch_image_index[rows]],
+                self.patch_codec.decode(self.patch_embeddings[rows]))
+
+    def get_patch_grid(self, image_id: str):
+        if self.image_meta is None or not len(self.image_ids):
+            return None
+        row = self.image_rows([image_id])[0]
+        if row < 0 or not self.image_meta[row, 2]:
+            return None
+        # patch rows are written in the same order as their images
+        start, end = np.searchsorted(self.patch_image_index, [row, row + 1])
+        return dict(embedding=self.patch_codec.decode(
+            self.patch_embeddings[start:end]),
+                    grid=np.asarray(self.patch_grid[start:end]),
+                    image_shape=self.image_meta[row, :2].tolist(),
+                    patch_size=int(self.image_meta[row, 2]))
+
+    def _search_patch_rows(self, query: np.ndarray, limit: int):
+        best_indices = np.empty((len(query), 0), dtype=np.int64)
+        best_scores = np.empty((len(query), 0), dtype=np.float32)
+        # scan patch rows in blocks and keep a running top-k per query
+        for start in range(0, len(self.patch_embeddings), self.scan_size):
+            scores = self.patch_codec.scores(
+                query, self.patch_embeddings[start:start + self.scan_size])
+            indices = top_k_indices(scores, limit)
+            best_scores = np.concatenate(
+                [best_scores,
+                 np.take_along_axis(scores, indices, axis=1)],
+                axis=1)
+            best_indices = np.concatenate([best_indices, indices + start],
+                                          axis=1)
+            keep = top_k_indices(best_scores, limit)
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            best_indices = np.take_along_axis(best_indices, keep, axis=1)
+        return best_indices, best_scores
+
+    def search_patches(self,
+                       embedding: np.ndarray,
+                       limit: int,
+                       chunk_size: int = 256):
+        query = l2_normalize(embedding)
+        hit_indices, hit_scores, hit_queries = [], [], []
+        for start in range(0, len(query), chunk_size):
+            best_indices, best_scores = self._search_patch_rows(
+                query[start:start + chunk_size], limit)
+            hit_indices.append(best_indices.ravel())
+            hit_scores.append(best_scores.ravel())
+            hit_queries.append(
+                np.repeat(np.arange(start, start + len(best_indices)),
+                          best_indices.shape[1]))
+        hit_indices = np.concatenate(hit_indices)
+        hit_image_ids = self.image_ids[self.patch_image_index[hit_indices]]
+        return hit_image_ids, np.concatenate(hit_scores), np.concatenate(
+            hit_queries)
+
+
+class NumpyIndexWriter:
+
+    def __init__(self,
+                 index_dir: str,
+                 embedding_size: int,
+                 resume: bool = False,
+                 append: bool = False,
+                 patch_storage: str = 'float32',
+                 pq_subvectors: int = 64,
+                 codec_sample_size: int = 65536):
+        self.index_dir = Path(index_dir)
+        self.embedding_size = embedding_size
+        self.append = append
+        self.patch_codec = build_codec(patch_storage,
+                                       embedding_size,
+                                       pq_subvectors=pq_subvectors)
+        self.codec_sample_size = codec_sample_size
+        self.encode_size = 65536
+        self.part_dir = self.index_dir / 'parts'
+        if self.part_dir.exists() and not resume:
+            shutil.rmtree(self.part_dir)
+        self.part_dir.mkdir(parents=True, exist_ok=True)
+        self.parts: List[Path] = sorted(self.part_dir.glob('part-*.npz'))
+        # column: (file name, dtype, row shape, fill value of missing rows);
+        # parts keep full precision patch embeddings, the patch codec only
+        # applies to the final file
+        self.columns = dict(
+            image=dict(image_embedding=(IMAGE_EMBEDDINGS_FILE, np.float32,
+                                        (embedding_size, ), 0),
+                       image_meta=(IMAGE_META_FILE, np.int32, (3, ), 0),
+                       image_hash=(IMAGE_HASHES_FILE, 'U32', (), '')),
+            patch=dict(patch_embedding=(PATCH_EMBEDDINGS_FILE, np.float32,
+                                        (embedding_size, ), 0),
+                       patch_grid=(PATCH_GRID_FILE, np.int16, (2, ), -1)))
+        self.buffer = dict(image_ids=[], patch_image_ids=[])
+        for columns in self.columns.values():
+            self.buffer.update({column: [] for column in columns})
+        if self.parts:
+            logger.info(f'Resume numpy index with {len(self.parts)} parts')
+
+    def _column_values(self, kind: str, column: str, size: int,
+                       values: Optional[np.ndarray]):
+        _, dtype, shape, fill_value = self.columns[kind][column]
+        if values is None:
+            return np.full((size, *shape), fill_value, dtype=dtype)
+        values = np.asarray(values, dtype=dtype)
+        assert values.shape == (size, *shape)
+        return values
+
+    def add_images(self,
+                   image_ids: List[str],
+                   embedding: np.ndarray,
+                   image_meta: Optional[np.ndarray] = None,
+                   image_hashes: Optional[List[str]] = None):
+        embedding = l2_normalize(embedding)
+        assert embedding.shape == (len(image_ids), self.embedding_size)
+        self.buffer['image_ids'].extend(image_ids)
+        self.buffer['image_embedding'].append(embedding)
+        self.buffer['image_meta'].append(
+            self._column_values('image', 'image_meta', len(image_ids),
+                                image_meta))
+        self.buffer['image_hash'].append(
+            self._column_values('image', 'image_hash', len(image_ids),
+                                image_hashes))
+
+    def add_patches(self,
+                    image_ids: List[str],
+                    embedding: np.ndarray,
+                    grid: Optional[np.ndarray] = None):
+        embedding = l2_normalize(embedding)
+        assert embedding.shape == (len(image_ids), self.embedding_size)
+        self.buffer['patch_image_ids'].extend(image_ids)
+        self.buffer['patch_embedding'].append(embedding)
+        self.buffer['patch_grid'].append(
+            self._column_values('patch', 'patch_grid', len(image_ids), grid))
+
+    def flush(self):
+        if not self.buffer['image_ids']:
+            return
+        part_file = self.part_dir / f'part-{len(self.parts):06d}.npz'
+        tmp_file = self.part_dir / f'.{part_file.stem}.tmp.npz'
+        part = dict(image_ids=np.asarray(self.buffer['image_ids']),
+                    patch_image_ids=np.asarray(self.buffer['patch_image_ids'],
+                                               dtype=str))
+        for kind, columns in self.columns.items():
+            for column in columns:
+                part[column] = np.concatenate(self.buffer[column]) if (
+                    self.buffer[column]) else self._column_values(
+                        kind, column, 0, None)
+        np.savez(tmp_file, **part)
+        # the part only becomes visible to a resumed run once complete
+        os.replace(tmp_file, part_file)
+        self.parts.append(part_file)
+        for values in self.buffer.values():
+            values.clear()
+
+    def _sources(self):
+        # newest data first: a re-embedded image replaces older rows. Yields
+        # (source, codec of its stored patch embeddings or None)
+        for part in reversed(self.parts):
+            with np.load(part) as data:
+                source = {k: data[k] for k in data.files}
+            # row of each patch's image within the part; -1 for patches
+            # whose image is not in the same part, which are dropped
+            image_ids = source['image_ids']
+            sorter = np.argsort(image_ids)
+            position = np.minimum(
+                np.searchsorted(image_ids,
+                                source['patch_image_ids'],
+                                sorter=sorter), len(image_ids) - 1)
+            patch_image_index = sorter[position]
+            patch_image_index[image_ids[patch_image_index] !=
+                              source['patch_image_ids']] = -1
+            source['patch_image_index'] = patch_image_index
+            yield source, None
+        if self.append and (resolve_index_dir(self.index_dir)[0] /
+                            IMAGE_IDS_FILE).exists():
+            # the existing index stays memory-mapped and is copied in row
+            # blocks, so appending never loads the whole catalog
+            index = NumpyIndex(self.index_dir)
+            source = dict(image_ids=index.image_ids,
+                          image_embedding=index.image_embeddings,
+                          patch_image_index=index.patch_image_index,
+                          patch_embedding=index.patch_embeddings)
+            for column, values in (('image_meta', index.image_meta),
+                                   ('image_hash', index.image_hashes),
+                                   ('patch_grid', index.patch_grid)):
+                if values is not None:
+                    source[column] = values
+            yield source, index.patch_codec
+
+    def _fit_patch_codec(self, patch_masks: List[np.ndarray]):
+        samples, num_samples = [], 0
+        for (source, codec), mask in zip(self._sources(), patch_masks):
+            if num_samples >= self.codec_sample_size:
+                break
+            rows = np.flatnonzero(mask)[:self.codec_sample_size - num_samples]
+            values = np.asarray(source['patch_embedding'][rows])
+            samples.append(codec.decode(values) if codec else values)
+            num_samples += len(rows)
+        if num_samples:
+            self.patch_codec.fit(np.concatenate(samples))
+
+    def _write(self, kind: str, masks: List[np.ndarray]):
+        total = int(sum(mask.sum() for mask in masks))
+        columns = dict(self.columns[kind])
+        if kind == 'patch':
+            columns['patch_embedding'] = (PATCH_EMBEDDINGS_FILE,
+                                          self.patch_codec.dtype,
+                                          self.patch_codec.code_shape, 0)
+        tmp_files, outputs = {}, {}
+        for column, (file_name, dtype, shape, _) in columns.items():
+            tmp_files[file_name] = self.index_dir / f'.{file_name}.tmp.npy'
+            outputs[column] = np.lib.format.open_memmap(tmp_files[file_name],
+                                                        mode='w+',
+                                                        dtype=dtype,
+                                                        shape=(total, *shape))
+        offset = 0
+        for (source, codec), mask in zip(self._sources(), masks):
+            for start in range(0, len(mask), self.encode_size):
+                end = start + self.encode_size
+                block_mask = mask[start:end]
+                size = int(block_mask.sum())
+                if not size:
+                    continue
+                for column, output in outputs.items():
+                    if column not in source:
+                        values = self._column_values(kind, column, size, None)
+                    else:
+                        values = np.asarray(
+                            source[column][start:end])[block_mask]
+                    if column == 'patch_embedding':
+                        values = self.patch_codec.encode(
+                            codec.decode(values) if codec else values)
+                    output[offset:offset + size] = values
+                offset += size
+        for output in outputs.values():
+            output.flush()
+        del outputs
+        return tmp_files
+
+    def _patch_centroids(self, patch_file: Path,
+                         patch_image_index: np.ndarray, num_images: int):
+        # normalized mean patch per image, the coarse stage of two-stage
+        # focus search; each image's patch rows are contiguous
+        patch_embedding = np.load(patch_file, mmap_mode='r')
+        centroids = np.zeros((num_images, self.embedding_size),
+                             dtype=np.float32)
+        for start in range(0, len(patch_image_index), self.encode_size):
+            end = start + self.encode_size
+            images, starts = np.unique(patch_image_index[start:end],
+                                       return_index=True)
+            centroids[images] += np.add.reduceat(self.patch_codec.decode(
+                patch_embedding[start:end]),
+                                                 starts,
+                                                 axis=0)
+        return l2_normalize(centroids)
+
+    def _remove_old_versions(self):
+        # maps of removed files stay valid, so workers still serving an older
+        # version are unaffected until they swap
+        versions = sorted(
+            (path for path in self.index_dir.iterdir()
+             if path.is_dir() and path.name.isdigit()),
+            key=lambda path: int(path.name))
+        for path in versions[:-(KEEP_INDEX_VERSIONS + 1)]:
+            shutil.rmtree(path)
+        for file_name in (IMAGE_IDS_FILE, IMAGE_EMBEDDINGS_FILE,
+                          PATCH_IMAGE_INDEX_FILE, PATCH_EMBEDDINGS_FILE,
+                          IMAGE_META_FILE, IMAGE_HASHES_FILE, PATCH_GRID_FILE,
+                          PATCH_CENTROIDS_FILE, PATCH_CODEC_FILE,
+                          'patch_fg_score.npy'):
+            (self.index_dir / file_name).unlink(missing_ok=True)
+
+    def close(self, fg_model_file: Optional[str] = None):
+        self.flush()
+        seen = set()
+        image_masks, patch_masks = [], []
+        image_ids, patch_image_index, num_images = [], [], 0
+        for source, _ in self._sources():
+            image_mask = np.asarray(
+                [image_id not in seen for image_id in source['image_ids']],
+                dtype=bool)
+            kept_ids = source['image_ids'][image_mask]
+            seen.update(kept_ids.tolist())
+            # patches are kept with their image; the row of a kept image in
+            # the written index is its rank among the kept images
+            index = np.asarray(source['patch_image_index'])
+            patch_mask = (index >= 0) & image_mask[index]
+            image_rows = np.cumsum(image_mask) - 1 + num_images
+            patch_image_index.append(image_rows[index[patch_mask]])
+            image_ids.append(kept_ids)
+            image_masks.append(image_mask)
+            patch_masks.append(patch_mask)
+            num_images += len(kept_ids)
+        image_ids = np.concatenate(image_ids) if image_ids else np.asarray(
+            [], dtype=str)
+        patch_image_index = np.concatenate(
+            patch_image_index) if patch_image_index else np.empty(
+                0, dtype=np.int64)
+
+        tmp_files = self._write('image', image_masks)
+        self._fit_patch_codec(patch_masks)
+        tmp_files.update(self._write('patch', patch_masks))
+        tmp_files[PATCH_CODEC_FILE] = self.index_dir / '.patch_codec.tmp.npz'
+        save_codec(self.patch_codec, tmp_files[PATCH_CODEC_FILE])
+        sorter = np.argsort(image_ids)
+        patch_centroids = self._patch_centroids(
+            tmp_files[PATCH_EMBEDDINGS_FILE], patch_image_index,
+            len(image_ids))
+        for file_name, values in ((IMAGE_IDS_FILE, image_ids),
+                                  (PATCH_IMAGE_INDEX_FILE,
+                                   patch_image_index.astype(np.int64)),
+                                  (PATCH_CENTROIDS_FILE, patch_centroids),
+                                  (IMAGE_SORTER_FILE,
+                                   sorter.astype(np.int64))):
+            tmp_files[file_name] = self.index_dir / f'.{file_name}.tmp.npy'
+            np.save(tmp_files[file_name], values)
+        # a version is written to its own directory and published by
+        # replacing the version file, so readers never mix two versions
+        version = new_index_version()
+        version_dir = self.index_dir / version
+        version_dir.mkdir()
+        for file_name, tmp_file in tmp_files.items():
+            os.replace(tmp_file, version_dir / file_name)
+        if fg_model_file is not None and Path(fg_model_file).exists():
+            shutil.copyfile(fg_model_file, version_dir / FG_MODEL_FILE)
+        shutil.rmtree(self.part_dir)
+        write_index_version(self.index_dir / INDEX_VERSION_FILE, version)
+        self._remove_old_versions()
+        logger.info(f'Write numpy index: {self.index_dir} images: '
+                    f'{len(image_ids)} patches: {len(patch_image_index)} '
+                    f'({self.patch_codec.name})')
+        return version
+
+
+class ShardedIndex:
+    # the same interface as one index: queries are scattered to every shard
+    # on a thread pool (NumPy scans and Milvus calls release the GIL) and the
+    # per-shard results merged; exact per-shard top-k merge to the exact
+    # global top-k
+
+    def __init__(self, shards: list, version: str = ''):
+        self.shards = shards
+        self.num_shards = len(shards)
+        self.version = version
+        self.has_patch_centroids = all(shard.has_patch_centroids
+                                       for shard in shards)
+        self.fg_model_file = getattr(shards[0], 'fg_model_file', None)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_shards,
+                                           thread_name_prefix='shard')
+
+    def _scatter(self, method: str, *args, **kwargs):
+        return list(
+            self.executor.map(
+                lambda shard: getattr(shard, method)(*args, **kwargs),
+                self.shards))
+
+    def _shard(self, image_id: str):
+        return self.shards[shard_of([image_id], self.num_shards)[0]]
+
+    @staticmethod
+    def _merge_top_k(results: list, limit: int):
+        # every shard returns its hits best first
+        hits = heapq.merge(*[zip(scores, image_ids)
+                             for image_ids, scores in results],
+                           key=lambda hit: -hit[0])
+        top = list(itertools.islice(hits, limit))
+        return [image_id for _, image_id in top], [score for score, _ in top]
+
+    def search_images(self, embedding: np.ndarray, limit: int):
+        return self._merge_top_k(
+            self._scatter('search_images', embedding, limit), limit)
+
+    def search_patch_centroids(self, embedding: np.ndarray, limit: int):
+        return self._merge_top_k(
+            self._scatter('search_patch_centroids', embedding, limit), limit)
+
+    def get_image_embedding(self, image_id: str):
+        return self._shard(image_id).get_image_embedding(image_id)
+
+    def get_patch_grid(self, image_id: str):
+        return self._shard(image_id).get_patch_grid(image_id)
+
+    def get_patches(self, image_ids: List[str]):
+        image_ids = np.asarray(list(image_ids), dtype=str)
+        shards = shard_of(image_ids.tolist(), self.num_shards)
+        requests = [(self.shards[shard], image_ids[shards == shard].tolist())
+                    for shard in np.unique(shards)]
+        results = [
+            result for result in self.executor.map(
+                lambda request: request[0].get_patches(request[1]), requests)
+            if len(result[0])
+        ]
+        if not results:
+            return np.asarray([], dtype=str), np.empty((0, 0),
+                                                       dtype=np.float32)
+        patch_image_ids, embeddings = zip(*results)
+        return np.concatenate(patch_image_ids), np.concatenate(embeddings)
+
+    def search_patches(self,
+                       embedding: np.ndarray,
+                       limit: int,
+                       chunk_size: int = 256):
+        hit_image_ids, hit_scores, hit_queries = [
+            np.concatenate(values) for values in zip(*self._scatter(
+                'search_patches', embedding, limit, chunk_size=chunk_size))
+        ]
+        # keep each query's best `limit` hits over all shards, the hits a
+        # single index would have returned
+        order = np.lexsort((-hit_scores, hit_queries))
+        sorted_queries = hit_queries[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_queries,
+                                                       sorted_queries)
+        keep = order[rank < limit]
+        return hit_image_ids[keep], hit_scores[keep], hit_queries[keep]
+
+
+def load_index(backend: str,
+               db_file: Optional[str] = None,
+               index_dir: Optional[str] = None,
+               nprobe: Optional[int] = None,
+               ef: Optional[int] = None,
+               num_shards: int = 1,
+               version: Optional[str] = None):
+    assert backend in ('milvus', 'numpy')
+    if num_shards > 1:
+        # the top-level version is published after all shards, and a numpy
+        # version pins the version of every shard; a version published while
+        # the shards load is picked up by the next check
+        version = read_index_version(
+            index_version_file(backend, db_file=db_file,
+                               index_dir=index_dir))
+        shard_versions = read_shard_manifest(
+            index_dir, version) if backend == 'numpy' else None
+        assert shard_versions is None or len(shard_versions) == num_shards, (
+            f'index version {version} has {len(shard_versions)} shards')
+        with ThreadPoolExecutor(max_workers=num_shards) as executor:
+            shards = list(
+                executor.map(
+                    lambda shard: load_index(
+                        backend,
+                        db_file=shard_db_file(db_file, shard, num_shards)
+                        if db_file else None,
+                        index_dir=shard_index_dir(index_dir, shard,
+                                                  num_shards)
+                        if index_dir else None,
+                        nprobe=nprobe,
+                        ef=ef,
+                        version=shard_versions[shard]
+                        if shard_versions else None), range(num_shards)))
+        return ShardedIndex(shards, version=version)
+    if backend == 'milvus':
+        return MilvusIndex(load_db(db_file=db_file), nprobe=nprobe, ef=ef)
+    return NumpyIndex(index_dir=index_dir, version=version)
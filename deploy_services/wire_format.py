@@ -0,0 +1,181 @@
+import json
+from typing import Mapping, Optional
+
+import msgpack
+import numpy as np
+
+JSON_MEDIA_TYPE = 'application/json'
+NDARRAY_MEDIA_TYPE = 'application/x-ndarray'
+MSGPACK_MEDIA_TYPE = 'application/x-msgpack'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+MSGPACK_STREAM_MEDIA_TYPE = 'application/x-msgpack-stream'
+MEDIA_TYPES = {
+    'json': JSON_MEDIA_TYPE,
+    'ndarray': NDARRAY_MEDIA_TYPE,
+    'msgpack': MSGPACK_MEDIA_TYPE,
+}
+DTYPES = {'float32': '<f4', 'float16': '<f2'}
+
+
+def accept_header(embedding_format: str, dtype: str = 'float32'):
+    assert embedding_format in MEDIA_TYPES and dtype in DTYPES
+    if embedding_format == 'json':
+        return JSON_MEDIA_TYPE
+    return f'{MEDIA_TYPES[embedding_format]}; dtype={dtype}'
+
+
+def negotiate(accept: Optional[str]):
+    for media_range in (accept or JSON_MEDIA_TYPE).split(','):
+        media_type, *params = [p.strip() for p in media_range.split(';')]
+        if media_type in (NDARRAY_MEDIA_TYPE, MSGPACK_MEDIA_TYPE):
+            params = dict(p.split('=', 1) for p in params if '=' in p)
+            dtype = params.get('dtype', 'float32')
+            return media_type, dtype if dtype in DTYPES else 'float32'
+    return JSON_MEDIA_TYPE, 'float32'
+
+
+def split_arrays(embedding_info: dict):
+    # 'embedding' first, then any other array fields (e.g. image_embedding
+    # of a combined response)
+    arrays = {'embedding': np.asarray(embedding_info['embedding'])}
+    arrays.update({
+        k: v
+        for k, v in embedding_info.items()
+        if k != 'embedding' and isinstance(v, np.ndarray)
+    })
+    metadata = {k: v for k, v in embedding_info.items() if k not in arrays}
+    return arrays, metadata
+
+
+def to_json_dict(embedding_info: dict):
+    arrays, metadata = split_arrays(embedding_info)
+    return dict(**{k: v.tolist()
+                   for k, v in arrays.items()},
+                array_fields=list(arrays),
+                **metadata)
+
+
+def from_json_dict(embedding_info: dict):
+    for name in embedding_info.pop('array_fields', ['embedding']):
+        embedding_info[name] = np.asarray(embedding_info[name],
+                                          dtype=np.float32)
+    return embedding_info
+
+
+def to_msgpack_dict(embedding_info: dict, dtype: str = 'float32'):
+    arrays, metadata = split_arrays(embedding_info)
+    arrays = {
+        k: np.ascontiguousarray(v, dtype=DTYPES[dtype])
+        for k, v in arrays.items()
+    }
+    embedding = arrays.pop('embedding')
+    if arrays:
+        metadata['extra_arrays'] = [[k, v.tobytes(),
+                                     list(v.shape)]
+                                    for k, v in arrays.items()]
+    return dict(embedding=embedding.tobytes(),
+                dtype=dtype,
+                array_shape=list(embedding.shape),
+                **metadata)
+
+
+def from_msgpack_dict(embedding_info: dict):
+    dtype = DTYPES[embedding_info.pop('dtype')]
+    embedding_info['embedding'] = np.frombuffer(
+        embedding_info['embedding'],
+        dtype=dtype).reshape(embedding_info.pop('array_shape'))
+    for name, data, shape in embedding_info.pop('extra_arrays', []):
+        embedding_info[name] = np.frombuffer(data, dtype=dtype).reshape(shape)
+    return embedding_info
+
+
+def encode_embedding(embedding_info: dict, media_type: str,
+                     dtype: str = 'float32'):
+    if media_type == JSON_MEDIA_TYPE:
+        return json.dumps(to_json_dict(embedding_info)).encode(), {}
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return msgpack.packb(to_msgpack_dict(embedding_info, dtype)), {}
+
+    assert media_type == NDARRAY_MEDIA_TYPE
+    arrays, metadata = split_arrays(embedding_info)
+    arrays = {
+        k: np.ascontiguousarray(v, dtype=DTYPES[dtype])
+        for k, v in arrays.items()
+    }
+    embedding = arrays.pop('embedding')
+    headers = {
+        'X-Array-Dtype': dtype,
+        'X-Array-Shape': ','.join(map(str, embedding.shape)),
+        'X-Embedding-Metadata': json.dumps(metadata),
+    }
+    if arrays:
+        # extra arrays follow the embedding bytes in this order
+        headers['X-Extra-Arrays'] = json.dumps(
+            [[k, list(v.shape)] for k, v in arrays.items()])
+    return b''.join([embedding.tobytes()] +
+                    [v.tobytes() for v in arrays.values()]), headers
+
+
+def decode_embedding(content: bytes, content_type: str,
+                     headers: Mapping[str, str]):
+    media_type = content_type.split(';')[0].strip()
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return from_msgpack_dict(msgpack.unpackb(content))
+    if media_type != NDARRAY_MEDIA_TYPE:
+        return from_json_dict(json.loads(content))
+
+    embedding_info = json.loads(headers['X-Embedding-Metadata'])
+    dtype = np.dtype(DTYPES[headers['X-Array-Dtype']])
+    arrays = [[
+        'embedding', [int(s) for s in headers['X-Array-Shape'].split(',')]
+    ]] + json.loads(headers.get('X-Extra-Arrays', '[]'))
+    offset = 0
+    for name, shape in arrays:
+        count = int(np.prod(shape))
+        embedding_info[name] = np.frombuffer(content,
+                                             dtype=dtype,
+                                             count=count,
+                                             offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    return embedding_info
+
+
+def stream_media_type(media_type: str):
+    # raw ndarray bodies need per-item headers, so binary streams use msgpack
+    if media_type == JSON_MEDIA_TYPE:
+        return NDJSON_MEDIA_TYPE
+    return MSGPACK_STREAM_MEDIA_TYPE
+
+
+def encode_frame(frame: dict, media_type: str, dtype: str = 'float32'):
+    if media_type == NDJSON_MEDIA_TYPE:
+        if 'error' not in frame:
+            frame = to_json_dict(frame)
+        return json.dumps(frame).encode() + b'\n'
+    assert media_type == MSGPACK_STREAM_MEDIA_TYPE
+    return msgpack.packb(frame if 'error' in frame else to_msgpack_dict(
+        frame, dtype))
+
+
+class FrameDecoder:
+
+    def __init__(self, content_type: str):
+        self.media_type = content_type.split(';')[0].strip()
+        assert self.media_type in (NDJSON_MEDIA_TYPE,
+                                   MSGPACK_STREAM_MEDIA_TYPE)
+        self.buffer = b''
+        self.unpacker = msgpack.Unpacker()
+
+    def feed(self, data: bytes):
+        if self.media_type == NDJSON_MEDIA_TYPE:
+            self.buffer += data
+            *lines, self.buffer = self.buffer.split(b'\n')
+            frames = [json.loads(line) for line in lines if line.strip()]
+            decode = from_json_dict
+        else:
+            self.unpacker.feed(data)
+            frames = list(self.unpacker)
+            decode = from_msgpack_dict
+        return [
+            frame if 'error' in frame else decode(frame) for frame in frames
+        ]
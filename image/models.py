@@ -11,7 +11,15 @@ def custom_image_path(instance, filename):
     image_id = str(instance.id)
     timestamp = str(instance.created_date.timestamp())
     extension = Path(filename).suffix
-    return f'images/{image_id}-{timestamp}{extension}'
+    # a replaced image gets a new object name: the embedding service caches
+    # downloaded images by name
+    return f'images/{image_id}-{timestamp}-{instance.md5_hash[:8]}{extension}'
+
+
+def custom_thumbnail_path(instance, filename):
+    image_id = str(instance.id)
+    timestamp = str(instance.created_date.timestamp())
+    return f'thumbnails/{image_id}-{timestamp}.jpg'
 
 
 class Image(models.Model):
@@ -20,16 +28,20 @@ class Image(models.Model):
     modified_date = models.DateTimeField(auto_now=True)
     created_date = models.DateTimeField(auto_now_add=True)
     image = models.ImageField(blank=False, upload_to=custom_image_path)
+    thumbnail = models.ImageField(blank=True, upload_to=custom_thumbnail_path)
     source = models.CharField(max_length=200, default='example', blank=False)
 
     def __str__(self):
         return f'{self.id}'
 
     def generate_md5(self):
+        self.image.seek(0)
         return hashlib.md5(self.image.read()).hexdigest()
 
     def save(self, *args, **kwargs):
-        if not self.md5_hash:
+        # the hash follows a replaced image file, so the indexer re-embeds it
+        if not self.md5_hash or (not self._state.adding
+                                 and not self.image._committed):
             self.md5_hash = self.generate_md5()
         self.full_clean()
         super().save(*args, **kwargs)
@@ -39,5 +51,7 @@ class Image(models.Model):
             'image_id':
             str(self.id),
             'image_path':
-            self.image.name if settings.APPLY_GS else self.image.url[1:]
+            self.image.name if settings.APPLY_GS else self.image.url[1:],
+            'md5_hash':
+            self.md5_hash
         }
@@ -60,7 +60,7 @@ function initButton() {
                 'X-CSRFToken': $('meta[name="csrf-token"]').attr('content')
             },
             success: function (img_info) {
-                displayRecommendedImage(img_info.image_url);
+                displayRecommendedImage(img_info.image_url, img_info.thumbnail_url);
                 SearchBtnLoading(false);
             },
             error: function (_, error) {
@@ -90,27 +90,27 @@ function initButton() {
 
 
 
-function displayRecommendedImage(imageUrls) {
+function displayRecommendedImage(imageUrls, thumbnailUrls) {
     function displayTop1Recommendation(imgUrl) {
         $top1ImageContainer.empty().append($('<img>', {
             src: imgUrl
         }));
     }
     function imageClickEvent($img) {
-        displayTop1Recommendation($img.attr('src'));
+        displayTop1Recommendation($img.data('image-url'));
         $recommenderContainer.children().each((_, imgContiner) => {
             $(imgContiner).removeClass('active')
         });
         $img.parent().addClass('active');
     }
-    function createImageContainer(imgUrl) {
+    function createImageContainer(imgUrl, thumbnailUrl) {
         const $imgContainer = $('<div>', {
             class: 'img-container'
         });
         const $img = $('<img>', {
-            src: imgUrl,
+            src: thumbnailUrl,
             class: 'img-thumbnail recommendation'
-        }).on('click', () => {
+        }).data('image-url', imgUrl).on('click', () => {
             imageClickEvent($img)
         });
         $imgContainer.append($img);
@@ -119,7 +119,7 @@ function displayRecommendedImage(imageUrls) {
     function displayRecommendations(imageUrls) {
         $recommenderContainer.empty();
         imageUrls.forEach((imgUrl, index) => {
-            const $imgContainer = createImageContainer(imgUrl = imgUrl, isActive = index === 0)
+            const $imgContainer = createImageContainer(imgUrl, thumbnailUrls[index])
             if (index === 0) $imgContainer.addClass('active')
             $recommenderContainer.append($imgContainer)
         });
@@ -0,0 +1,71 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.http import HttpResponse
+from loguru import logger
+from prometheus_client import (CONTENT_TYPE_LATEST, Gauge, Histogram,
+                               generate_latest)
+
+TRACE_HEADER = 'X-Trace-Id'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram('django_request_duration_seconds',
+                            'Latency of Django requests',
+                            labelnames=('method', 'view', 'status'),
+                            buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram('django_stage_duration_seconds',
+                          'Latency of a processing stage within a request',
+                          labelnames=('stage', ),
+                          buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge('django_requests_in_flight',
+                           'Django requests being served')
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(name).observe(time.perf_counter() - start)
+
+
+def trace_headers(request):
+    return {TRACE_HEADER: getattr(request, 'trace_id', uuid.uuid4().hex)}
+
+
+class TraceMiddleware:
+    # every request gets a trace id, which views forward to the recommender
+    # and the recommender forwards to the embedding service
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path.startswith('/metrics'):
+            return self.get_response(request)
+        request.trace_id = request.headers.get(
+            TRACE_HEADER) or uuid.uuid4().hex
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        status = 500
+        try:
+            response = self.get_response(request)
+            status = response.status_code
+            response[TRACE_HEADER] = request.trace_id
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            match = request.resolver_match
+            REQUEST_LATENCY.labels(request.method,
+                                   match.view_name if match else 'unmatched',
+                                   status).observe(elapsed)
+            logger.info(f'[django] trace={request.trace_id} {request.method} '
+                        f'{request.path} {status} {elapsed * 1000:.1f}ms')
+
+
+def metrics(request):
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
@@ -1,8 +1,9 @@
 from django.urls import path
 
-from . import views
+from . import telemetry, views
 
 urlpatterns = [
     path('', views.home, name='home'),
     path('recommend-imgs/', views.recommend_imgs, name='recommend'),
+    path('metrics/', telemetry.metrics, name='metrics'),
 ]
@@ -2,11 +2,32 @@ import json
 from typing import Optional
 
 import requests
+from django.conf import settings
 from django.db.models import Case, When
 from django.http import JsonResponse
 from django.shortcuts import render
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .models import Image
+from .telemetry import stage, trace_headers
+
+
+def build_session(pool_size: int, retries: int):
+    # recommendations are read-only, so POST requests are safe to retry
+    adapter = HTTPAdapter(pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries,
+                                            backoff_factor=0.2,
+                                            status_forcelist=(502, 503, 504),
+                                            allowed_methods=None))
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+recommender_session = build_session(pool_size=settings.RECOMMENDER_POOL_SIZE,
+                                    retries=settings.RECOMMENDER_RETRIES)
 
 
 # Create your views here.
@@ -15,13 +36,22 @@ def home(request):
 
 
 def get_recommendations(query_image: Image,
-                        coords_info: Optional[dict] = None):
+                        coords_info: Optional[dict] = None,
+                        headers: Optional[dict] = None):
+    query_info = query_image.to_query()
     data = {
-        'image_path': query_image.to_query()['image_path'],
+        'image_path': query_info['image_path'],
+        'image_id': query_info['image_id'],
+        'image_hash': query_image.md5_hash,
         'coords_info': coords_info
     }
-    response = requests.post(url='http://127.0.0.1:8002/recommend-image/',
-                             json=data)
+    with stage('recommender_request'):
+        response = recommender_session.post(
+            url=settings.RECOMMENDER_API,
+            json=data,
+            headers=headers,
+            timeout=(settings.RECOMMENDER_CONNECT_TIMEOUT,
+                     settings.RECOMMENDER_READ_TIMEOUT))
 
     response.raise_for_status()
     image_results = response.json()
@@ -31,21 +61,32 @@ def get_recommendations(query_image: Image,
 def recommend_imgs(request):
     if request.method == 'POST':
         image_file = request.FILES.get('image')
-        image = Image(source='user', image=image_file)
-        md5_hash = image.generate_md5()
-        if not Image.objects.filter(md5_hash=md5_hash).exists():
-            image = Image(source='user', image=image_file, md5_hash=md5_hash)
-            image.save()
-        else:
-            image = Image.objects.get(md5_hash=md5_hash)
+        with stage('image_upload'):
+            image = Image(source='user', image=image_file)
+            md5_hash = image.generate_md5()
+            if not Image.objects.filter(md5_hash=md5_hash).exists():
+                image = Image(source='user',
+                              image=image_file,
+                              md5_hash=md5_hash)
+                image.save()
+            else:
+                image = Image.objects.get(md5_hash=md5_hash)
 
         coords_info = request.POST.get('coords')
         coords_info = json.loads(coords_info) if coords_info else None
-        recommendation_img_ids = get_recommendations(image, coords_info)
-        recommendation_imgs = Image.objects.filter(
-            id__in=recommendation_img_ids).annotate(order=Case(*[
-                When(id=img_id, then=ord)
-                for ord, img_id in enumerate(recommendation_img_ids)
-            ])).order_by('order')
-        return JsonResponse(
-            data={'image_url': [img.image.url for img in recommendation_imgs]})
+        recommendation_img_ids = get_recommendations(
+            image, coords_info, headers=trace_headers(request))
+        with stage('result_images'):
+            recommendation_imgs = Image.objects.filter(
+                id__in=recommendation_img_ids).annotate(order=Case(*[
+                    When(id=img_id, then=ord)
+                    for ord, img_id in enumerate(recommendation_img_ids)
+                ])).order_by('order')
+            image_urls = [img.image.url for img in recommendation_imgs]
+            # images uploaded before thumbnails existed show the full image
+            thumbnail_urls = [(img.thumbnail or img.image).url
+                              for img in recommendation_imgs]
+        return JsonResponse(data={
+            'image_url': image_urls,
+            'thumbnail_url': thumbnail_urls
+        })
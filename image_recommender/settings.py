@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'image.telemetry.TraceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -135,4 +136,13 @@ if APPLY_GS:
         os.environ['GS_CREDENTIAL'])
 else:
     MEDIA_URL = '/media/'
-    MEDIA_ROOT = BASE_DIR / 'media'
\ No newline at end of file
+    MEDIA_ROOT = BASE_DIR / 'media'
+# recommender service client: one pooled keep-alive session per process
+RECOMMENDER_API = os.environ.get('RECOMMENDER_API',
+                                 'http://127.0.0.1:8002/recommend-image/')
+RECOMMENDER_CONNECT_TIMEOUT = float(
+    os.environ.get('RECOMMENDER_CONNECT_TIMEOUT', 5))
+RECOMMENDER_READ_TIMEOUT = float(os.environ.get('RECOMMENDER_READ_TIMEOUT',
+                                                60))
+RECOMMENDER_RETRIES = int(os.environ.get('RECOMMENDER_RETRIES', 2))
+RECOMMENDER_POOL_SIZE = int(os.environ.get('RECOMMENDER_POOL_SIZE', 32))
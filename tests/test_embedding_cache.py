@@ -0,0 +1,80 @@
+import asyncio
+import threading
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, entry_size
+
+
+def make_entry(value: float):
+    return dict(embedding=np.full(64, value, dtype=np.float32), model='m')
+
+
+def test_evicted_entries_spill_to_disk(tmp_path):
+    size = entry_size(make_entry(0))
+    cache = EmbeddingCache(max_bytes=2 * size,
+                           spill_dir=str(tmp_path),
+                           spill_max_bytes=100 * size)
+
+    async def run():
+        for i in range(4):
+            await cache.put(f'k{i}', make_entry(i))
+        assert list(cache.entries) == ['k2', 'k3']
+        assert sorted(cache.spill.files) == ['k0', 'k1']
+        # a spill hit comes back into memory
+        entry = await cache.get('k0')
+        assert entry['model'] == 'm'
+        np.testing.assert_array_equal(entry['embedding'], 0)
+        assert 'k0' in cache.entries
+        assert await cache.get('missing') is None
+
+    asyncio.run(run())
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_spill_io_runs_off_the_event_loop(tmp_path, monkeypatch):
+    size = entry_size(make_entry(0))
+    cache = EmbeddingCache(max_bytes=size,
+                           spill_dir=str(tmp_path),
+                           spill_max_bytes=100 * size)
+    threads = set()
+    spill_put, spill_get = cache.spill.put, cache.spill.get
+
+    def put(*put_args):
+        threads.add(threading.get_ident())
+        assert not cache.lock.locked()
+        return spill_put(*put_args)
+
+    def get(*get_args):
+        threads.add(threading.get_ident())
+        assert not cache.lock.locked()
+        return spill_get(*get_args)
+
+    monkeypatch.setattr(cache.spill, 'put', put)
+    monkeypatch.setattr(cache.spill, 'get', get)
+
+    async def run():
+        await cache.put('a', make_entry(1))
+        await cache.put('b', make_entry(2))
+        assert (await cache.get('a'))['model'] == 'm'
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert threads and loop_thread not in threads
+
+
+def test_spill_evicts_oldest_files(tmp_path):
+    size = entry_size(make_entry(0))
+    cache = EmbeddingCache(max_bytes=size,
+                           spill_dir=str(tmp_path),
+                           spill_max_bytes=1)
+
+    async def run():
+        for i in range(3):
+            await cache.put(f'k{i}', make_entry(i))
+
+    asyncio.run(run())
+    # the spill keeps at least the newest file
+    assert list(cache.spill.files) == ['k1']
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['k1.npz']
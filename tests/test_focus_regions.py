@@ -0,0 +1,108 @@
+import asyncio
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import recommender
+from patch_grid import parse_regions, resize_points, select_grid_rows
+
+# 4 x 4 grid of 14 px patches, shown at twice the model input size
+PATCH_SIZE = 14
+IMAGE_SHAPE = [56, 56]
+DISPLAY = dict(width=112, height=112)
+# display coordinates: the top-left 2 x 2 patches and the bottom-right one
+TOP_LEFT_SQUARE = [[0, 0], [56, 0], [56, 56], [0, 56]]
+BOTTOM_RIGHT_BOX = dict(x1=84, y1=84, x2=111, y2=111)
+
+
+def test_resize_points_without_boxes():
+    boxes, polygons = parse_regions(dict(polygons=[TOP_LEFT_SQUARE]))
+    assert boxes.shape == (0, 4)
+    assert resize_points(boxes, (112, 112), (56, 56)).shape == (0, 4)
+    np.testing.assert_allclose(
+        resize_points(polygons[0], (112, 112), (56, 56)),
+        np.asarray(TOP_LEFT_SQUARE) / 2)
+
+
+def test_resize_points_scales_x_and_y():
+    boxes = np.asarray([[10, 20, 30, 40]], dtype=np.float32)
+    np.testing.assert_allclose(resize_points(boxes, (100, 200), (50, 50)),
+                               [[2.5, 10, 7.5, 20]])
+
+
+def test_select_grid_rows_polygon_only():
+    grid = np.stack(np.divmod(np.arange(16), 4), axis=1)
+    polygon = resize_points(np.asarray(TOP_LEFT_SQUARE), (112, 112),
+                            IMAGE_SHAPE)
+    selected = select_grid_rows(grid, np.zeros((0, 4), dtype=np.float32),
+                                [polygon], PATCH_SIZE, IMAGE_SHAPE)
+    assert np.flatnonzero(selected).tolist() == [0, 1, 4, 5]
+
+
+class FakeIndex:
+
+    def __init__(self):
+        self.queries = []
+
+    def search_patches(self, embedding, limit, chunk_size):
+        self.queries.append(embedding)
+        hit_queries = np.arange(len(embedding))
+        return (np.asarray(['img-a'] * len(embedding)),
+                np.ones(len(embedding), dtype=np.float32), hit_queries)
+
+
+@pytest.fixture
+def service(monkeypatch):
+    # row i of the patch embedding holds i in every dimension
+    embedding = np.repeat(np.arange(16, dtype=np.float32)[:, None], 8, axis=1)
+    index = FakeIndex()
+    monkeypatch.setattr(
+        recommender, 'args',
+        Namespace(top_k=5,
+                  focus_candidates=0,
+                  focus_top_m=8,
+                  focus_chunk_size=256))
+    monkeypatch.setattr(recommender, 'index', index)
+    monkeypatch.setattr(recommender, 'result_cache', None)
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(recommender, 'index_executor', executor)
+    yield index, embedding
+    executor.shutdown()
+
+
+def embedding_info(embedding: np.ndarray, stored: bool):
+    info = dict(embedding=embedding,
+                image_shape=IMAGE_SHAPE,
+                patch_size=PATCH_SIZE)
+    if stored:
+        # catalog image: only the stored rows with their grid positions
+        return dict(info, grid=np.stack(np.divmod(np.arange(16), 4), axis=1))
+    return dict(info,
+                fg_mask=np.ones(16, dtype=bool),
+                embedding_shape=(4, 4, embedding.shape[1]))
+
+
+@pytest.mark.parametrize('stored', [False, True])
+@pytest.mark.parametrize('coords_info, expected', [
+    (dict(polygons=[TOP_LEFT_SQUARE]), [0, 1, 4, 5]),
+    (dict(BOTTOM_RIGHT_BOX, polygons=[TOP_LEFT_SQUARE]), [0, 1, 4, 5, 15]),
+    (dict(boxes=[BOTTOM_RIGHT_BOX], polygons=[TOP_LEFT_SQUARE]),
+     [0, 1, 4, 5, 15]),
+])
+def test_focus_search_polygon_regions(service, monkeypatch, stored,
+                                      coords_info, expected):
+    index, embedding = service
+
+    async def get_embedding(query_img, embedding_type):
+        assert embedding_type == 'patch'
+        return embedding_info(embedding, stored)
+
+    monkeypatch.setattr(recommender, 'get_embedding', get_embedding)
+    query_img = recommender.QueryImage(image_path='query.jpg',
+                                       coords_info=dict(coords_info,
+                                                        **DISPLAY))
+    image_ids = asyncio.run(recommender.recommend_imgs(query_img))
+    assert image_ids == ['img-a']
+    assert index.queries[0][:, 0].tolist() == expected
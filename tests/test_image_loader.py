@@ -0,0 +1,77 @@
+import threading
+from collections import Counter
+
+from image_loader import DirectoryBucket, ImageLoader
+
+
+class CountingBucket(DirectoryBucket):
+
+    def __init__(self, root: str):
+        super().__init__(root)
+        self.requests = Counter()
+
+    def get_blob(self, name: str):
+        self.requests[name] += 1
+        return super().get_blob(name)
+
+
+def make_loader(tmp_path, num_images: int = 4, **kwargs):
+    bucket_dir = tmp_path / 'bucket'
+    bucket_dir.mkdir()
+    names = [f'img{i}.jpg' for i in range(num_images)]
+    for i, name in enumerate(names):
+        (bucket_dir / name).write_bytes(bytes([i]) * 100)
+    loader = ImageLoader(fake_bucket_dir=str(bucket_dir),
+                         pool_size=2,
+                         cache_dir=str(tmp_path / 'cache'),
+                         **kwargs)
+    loader.bucket = CountingBucket(str(bucket_dir))
+    return loader, names
+
+
+def test_disk_cache_hit_skips_bucket_requests(tmp_path):
+    loader, names = make_loader(tmp_path)
+    assert [loader.read(name) for name in names] == [
+        bytes([i]) * 100 for i in range(len(names))
+    ]
+    assert loader.bucket.requests == Counter(names)
+    assert [loader.read(name)[0] for name in names] == list(range(len(names)))
+    assert loader.bucket.requests == Counter(names)
+    loader.close()
+
+
+def test_release_keeps_prefetch_of_other_batches(tmp_path):
+    loader, names = make_loader(tmp_path)
+    gate = threading.Event()
+    fetch = loader.fetch
+
+    def blocked_fetch(img_file):
+        gate.wait(5)
+        return fetch(img_file)
+
+    loader.fetch = blocked_fetch
+    loader.prefetch(names[:2])
+    loader.prefetch(names[1:])
+    shared = loader.futures[names[1]]
+    # the first batch ends (e.g. its client disconnected) before any read
+    loader.release_prefetch(names[:2])
+    assert names[0] not in loader.futures
+    assert loader.futures[names[1]] is shared and not shared.cancelled()
+    gate.set()
+    assert loader.read(names[1]) == bytes([1]) * 100
+    assert shared.done() and not shared.cancelled()
+    loader.release_prefetch(names[1:])
+    assert not loader.futures and not loader.refs and not loader.consumed
+    loader.close()
+
+
+def test_shared_prefetch_is_read_by_both_batches(tmp_path):
+    loader, names = make_loader(tmp_path)
+    loader.prefetch(names)
+    loader.prefetch(names[:1])
+    assert loader.read(names[0]) == loader.read(names[0])
+    assert loader.bucket.requests[names[0]] == 1
+    loader.release_prefetch(names)
+    loader.release_prefetch(names[:1])
+    assert not loader.futures and not loader.refs
+    loader.close()
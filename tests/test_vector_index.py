@@ -0,0 +1,30 @@
+import numpy as np
+
+from vector_index import NumpyIndex, NumpyIndexWriter
+
+
+def write_index(index_dir, image_ids, image_hashes, append=False):
+    rng = np.random.default_rng(len(image_ids))
+    writer = NumpyIndexWriter(str(index_dir), embedding_size=4, append=append)
+    writer.add_images(image_ids,
+                      rng.standard_normal((len(image_ids), 4)),
+                      image_hashes=image_hashes)
+    writer.add_patches(image_ids, rng.standard_normal((len(image_ids), 4)))
+    writer.close()
+    return NumpyIndex(str(index_dir))
+
+
+def test_image_hashes_follow_replaced_images(tmp_path):
+    index = write_index(tmp_path, ['a', 'b'], ['hash-a', 'hash-b'])
+    assert index.image_hashes.tolist() == ['hash-a', 'hash-b']
+    # an incremental run re-embeds b with new content and adds c
+    index = write_index(tmp_path, ['b', 'c'], ['hash-b2', 'hash-c'],
+                        append=True)
+    hashes = dict(zip(index.image_ids.tolist(), index.image_hashes.tolist()))
+    assert hashes == dict(a='hash-a', b='hash-b2', c='hash-c')
+    assert len(index.patch_image_index) == 3
+
+
+def test_images_without_hashes(tmp_path):
+    index = write_index(tmp_path, ['a'], None)
+    assert index.image_hashes.tolist() == ['']
@@ -0,0 +1,172 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from loguru import logger
+from pymilvus import (CollectionSchema, DataType, FieldSchema, MilvusClient,
+                      MilvusException)
+
+from vector_index import (build_index_params, build_search_params,
+                          l2_normalize, load_db, parse_index_params,
+                          query_rows, top_k_indices)
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--db-file',
+                        type=str,
+                        default=None,
+                        help='indexed catalog to sample; synthetic if unset')
+    parser.add_argument('--collection',
+                        type=str,
+                        default='patch_embeddings',
+                        choices=['image_embeddings', 'patch_embeddings'])
+    parser.add_argument('--max-rows', type=int, default=200000)
+    parser.add_argument('--num-rows', type=int, default=100000)
+    parser.add_argument('--embedding-size', type=int, default=128)
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--index-configs',
+                        type=str,
+                        nargs='+',
+                        default=['FLAT', 'IVF_FLAT:nlist=1024', 'AUTOINDEX'],
+                        help='INDEX_TYPE[:key=value,...], e.g. '
+                        'HNSW:M=16,efConstruction=200')
+    parser.add_argument('--nprobe',
+                        type=int,
+                        nargs='+',
+                        default=[1, 8, 32, 128])
+    parser.add_argument('--ef', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--uri',
+                        type=str,
+                        default=None,
+                        help='Milvus server for HNSW / IVF_PQ / IVF_SQ8; '
+                        'a temporary Milvus Lite file otherwise')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def load_catalog_embeddings(db_file: str, collection_name: str,
+                            max_rows: int):
+    db = load_db(db_file)
+    embeddings = []
+    for results in query_rows(db, collection_name, ['embedding']):
+        embeddings.append(
+            np.asarray([r['embedding'] for r in results], dtype=np.float32))
+        if sum(map(len, embeddings)) >= max_rows:
+            break
+    db.close()
+    return np.concatenate(embeddings)[:max_rows]
+
+
+def synthetic_embeddings(num_rows: int, embedding_size: int,
+                         rng: np.random.Generator):
+    # clustered data: ANN recall on isotropic noise is not informative
+    centers = rng.standard_normal((256, embedding_size), dtype=np.float32)
+    labels = rng.integers(0, len(centers), num_rows)
+    return centers[labels] + 0.5 * rng.standard_normal(
+        (num_rows, embedding_size), dtype=np.float32)
+
+
+def create_collection(client: MilvusClient, embedding: np.ndarray):
+    collection_name = 'ann_benchmark'
+    if client.has_collection(collection_name):
+        client.drop_collection(collection_name)
+    client.create_collection(
+        collection_name,
+        schema=CollectionSchema(fields=[
+            FieldSchema(name='id', dtype=DataType.INT64, is_primary=True),
+            FieldSchema(name='embedding',
+                        dtype=DataType.FLOAT_VECTOR,
+                        dim=embedding.shape[1])
+        ]))
+    rows_per_request = max(1, 2**20 // embedding[0].nbytes)
+    for start in range(0, len(embedding), rows_per_request):
+        client.insert(collection_name, [{
+            'id': start + i,
+            'embedding': row
+        } for i, row in enumerate(embedding[start:start + rows_per_request])])
+    return collection_name
+
+
+def search_settings(index_type: str):
+    if index_type.startswith('IVF'):
+        return [dict(nprobe=nprobe) for nprobe in args.nprobe]
+    if index_type in ('HNSW', 'AUTOINDEX'):
+        return [dict(ef=ef) for ef in args.ef]
+    return [{}]
+
+
+def run_config(client: MilvusClient, collection_name: str, config: str,
+               queries: np.ndarray, exact: np.ndarray):
+    index_type, _, params = config.partition(':')
+    index_params = parse_index_params(params.split(',') if params else [])
+    if client.list_indexes(collection_name):
+        client.release_collection(collection_name)
+        client.drop_index(collection_name, index_name='embedding_index')
+    start = time.perf_counter()
+    try:
+        client.create_index(collection_name,
+                            build_index_params(index_type, index_params))
+    except MilvusException as error:
+        logger.warning(f'Skip {config}: {error.message}')
+        return
+    client.load_collection(collection_name)
+    build_time = time.perf_counter() - start
+
+    for setting in search_settings(index_type):
+        search_params = build_search_params(args.top_k, **setting)
+        latencies, recalls = [], []
+        for query, exact_ids in zip(queries, exact):
+            start = time.perf_counter()
+            hits = client.search(collection_name,
+                                 data=[query],
+                                 limit=args.top_k,
+                                 search_params=search_params)[0]
+            latencies.append(time.perf_counter() - start)
+            recalls.append(
+                len(set(hit['id'] for hit in hits) & set(exact_ids.tolist()))
+                / args.top_k)
+        logger.info(
+            f'{config:32s} build: {build_time:6.1f}s '
+            f'{str(setting or "-"):14s} recall@{args.top_k}: '
+            f'{np.mean(recalls):.3f} latency p50: '
+            f'{np.percentile(latencies, 50) * 1000:7.2f} ms '
+            f'p99: {np.percentile(latencies, 99) * 1000:7.2f} ms')
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    if args.db_file:
+        embedding = load_catalog_embeddings(args.db_file, args.collection,
+                                            args.max_rows)
+    else:
+        embedding = synthetic_embeddings(args.num_rows, args.embedding_size,
+                                         rng)
+    # held-out queries are catalog rows that are not indexed
+    order = rng.permutation(len(embedding))
+    queries = embedding[order[:args.num_queries]]
+    base = embedding[order[args.num_queries:]]
+    logger.info(f'{len(base)} indexed rows, {len(queries)} held-out queries, '
+                f'dim {embedding.shape[1]}')
+    exact = top_k_indices(l2_normalize(queries) @ l2_normalize(base).T,
+                          args.top_k)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = MilvusClient(args.uri or os.path.join(tmp_dir, 'ann.db'))
+        collection_name = create_collection(client, base)
+        for config in args.index_configs:
+            run_config(client, collection_name, config, queries, exact)
+        client.drop_collection(collection_name)
+        client.close()
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
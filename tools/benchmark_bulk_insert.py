@@ -0,0 +1,120 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from loguru import logger
+from pymilvus import CollectionSchema, DataType, FieldSchema, MilvusClient
+
+from vector_index import MilvusBulkInserter
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--num-images', type=int, default=50000)
+    parser.add_argument('--patches-per-image', type=int, default=500)
+    parser.add_argument('--embedding-size', type=int, default=64)
+    parser.add_argument('--insert-batch-size', type=int, default=100000)
+    parser.add_argument('--legacy-images', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def create_collections(client: MilvusClient, embedding_size: int,
+                       with_index: bool):
+    schemas = [
+        FieldSchema(name="id",
+                    dtype=DataType.INT64,
+                    is_primary=True,
+                    auto_id=True),
+        FieldSchema(name="image_id", dtype=DataType.VARCHAR, max_length=200),
+        FieldSchema(name="embedding",
+                    dtype=DataType.FLOAT_VECTOR,
+                    dim=embedding_size)
+    ]
+    for collection_name in ('image_embeddings', 'patch_embeddings'):
+        client.create_collection(collection_name=collection_name,
+                                 schema=CollectionSchema(fields=schemas))
+        if with_index:
+            build_index(client, collection_name)
+
+
+def build_index(client: MilvusClient, collection_name: str):
+    index_params = MilvusClient.prepare_index_params()
+    index_params.add_index(field_name="embedding",
+                           metric_type="COSINE",
+                           index_name="embedding_index")
+    client.create_index(collection_name=collection_name,
+                        index_params=index_params)
+
+
+def synthetic_image(rng: np.random.Generator, args):
+    return (rng.standard_normal(args.embedding_size, dtype=np.float32),
+            rng.standard_normal((args.patches_per_image, args.embedding_size),
+                                dtype=np.float32))
+
+
+def legacy_load(db: MilvusClient, num_images: int, rng: np.random.Generator,
+                args):
+    create_collections(db, args.embedding_size, with_index=True)
+    for i in range(num_images):
+        image_id = f'image-{i:07d}'
+        image_embedding, patch_embedding = synthetic_image(rng, args)
+        db.insert('image_embeddings', {
+            'embedding': image_embedding.tolist(),
+            'image_id': image_id
+        })
+        db.insert('patch_embeddings', [{
+            'embedding': embedding,
+            'image_id': image_id
+        } for embedding in patch_embedding.tolist()])
+
+
+def bulk_load(db: MilvusClient, num_images: int, rng: np.random.Generator,
+              args):
+    create_collections(db, args.embedding_size, with_index=False)
+    inserters = [
+        MilvusBulkInserter(db,
+                           'image_embeddings',
+                           batch_size=args.insert_batch_size),
+        MilvusBulkInserter(db,
+                           'patch_embeddings',
+                           batch_size=args.insert_batch_size)
+    ]
+    for i in range(num_images):
+        image_id = f'image-{i:07d}'
+        image_embedding, patch_embedding = synthetic_image(rng, args)
+        inserters[0].add([image_id], image_embedding[None])
+        inserters[1].add([image_id] * len(patch_embedding), patch_embedding)
+    for inserter in inserters:
+        inserter.flush()
+    for collection_name in ('image_embeddings', 'patch_embeddings'):
+        build_index(db, collection_name)
+
+
+def main():
+    args = arg_parse()
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, load, num_images in (('legacy', legacy_load,
+                                        args.legacy_images),
+                                       ('bulk', bulk_load, args.num_images)):
+            if not num_images:
+                continue
+            db = MilvusClient(os.path.join(tmp_dir, f'{name}.db'))
+            start = time.perf_counter()
+            load(db, num_images, rng, args)
+            elapsed = time.perf_counter() - start
+            num_rows = num_images * (args.patches_per_image + 1)
+            logger.info(f'{name:>6s}: {num_images} images {num_rows} rows in '
+                        f'{elapsed:.1f}s ({num_rows / elapsed:.0f} rows/s)')
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import shlex
+import statistics
+import subprocess
+import time
+from argparse import ArgumentParser
+
+import requests
+from loguru import logger
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--command',
+                        type=str,
+                        required=True,
+                        help='service command line, e.g. "python '
+                        'deploy_services/recommender.py --port 8002 ..."')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8002')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--poll-interval-ms', type=float, default=5.0)
+    return parser.parse_args()
+
+
+def probe(url: str):
+    try:
+        return requests.get(url, timeout=1.0).status_code
+    except requests.RequestException:
+        return None
+
+
+def cold_start():
+    # bound: the first HTTP answer of any kind; ready: /readyz is 200.
+    # Services without probes only bind once loaded, so bound == ready
+    start = time.perf_counter()
+    process = subprocess.Popen(shlex.split(args.command),
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    bound = ready = None
+    try:
+        while ready is None:
+            elapsed = time.perf_counter() - start
+            assert elapsed < args.timeout, 'service did not get ready'
+            assert process.poll() is None, 'service exited'
+            if bound is None:
+                status = probe(f'{args.url}/healthz')
+                if status is not None:
+                    bound = elapsed
+                    if status == 404:
+                        ready = bound
+                    continue
+            elif probe(f'{args.url}/readyz') == 200:
+                ready = elapsed
+                continue
+            time.sleep(args.poll_interval_ms / 1000)
+    finally:
+        process.terminate()
+        process.wait()
+    return bound, ready
+
+
+def main():
+    results = []
+    for run in range(args.runs):
+        bound, ready = cold_start()
+        logger.info(f'run {run}: bound {bound * 1e3:8.1f} ms '
+                    f'ready {ready * 1e3:8.1f} ms')
+        results.append((bound, ready))
+    bound, ready = zip(*results)
+    logger.info(f'median over {args.runs} runs: '
+                f'bound {statistics.median(bound) * 1e3:8.1f} ms '
+                f'ready {statistics.median(ready) * 1e3:8.1f} ms')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
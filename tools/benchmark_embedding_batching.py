@@ -0,0 +1,113 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import asyncio
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from typing import List
+
+import numpy as np
+import torch
+from loguru import logger
+from PIL import Image
+
+from batching import BatchQueue
+from embedding_model import (batch_key, build_embedder, build_transform,
+                             configure_threads, forward_batch, load_model,
+                             preprocess)
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--model', type=str, default='dinov2_vits14')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--num-requests', type=int, default=128)
+    parser.add_argument('--max-batch-sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1, 4, 8, 16])
+    parser.add_argument('--max-batch-wait-ms', type=float, default=5.0)
+    parser.add_argument('--embedding-type',
+                        type=str,
+                        default='image',
+                        choices=['image', 'patch'])
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_images(num_images: int, rng: np.random.Generator):
+    # a few aspect ratios so that requests fall into several shape groups
+    sizes = [(640, 480), (480, 640), (512, 512)]
+    return [
+        Image.fromarray(
+            rng.integers(0, 255, (*sizes[i % len(sizes)][::-1], 3),
+                         dtype=np.uint8)) for i in range(num_images)
+    ]
+
+
+async def run_benchmark(model: torch.nn.Module, items: List[dict],
+                        max_batch_size: int, max_wait_ms: float):
+    batch_sizes = Counter()
+
+    def process_batch(batch: List[dict]):
+        batch_sizes[len(batch)] += 1
+        return forward_batch(model, batch, device=torch.device('cpu'))
+
+    queue = BatchQueue(process_batch=process_batch,
+                       group_key=batch_key,
+                       max_batch_size=max_batch_size,
+                       max_wait_ms=max_wait_ms,
+                       name=f'benchmark-{max_batch_size}')
+    queue.start()
+
+    latencies = []
+
+    async def request(item: dict):
+        start = time.perf_counter()
+        await queue.submit(item)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request(item) for item in items])
+    elapsed = time.perf_counter() - start
+    await queue.stop()
+    return elapsed, np.asarray(latencies), batch_sizes
+
+
+def main():
+    args = arg_parse()
+    configure_threads(num_threads=args.num_threads)
+    model = build_embedder(load_model(model_name=args.model,
+                                      device=torch.device('cpu')),
+                           device=torch.device('cpu'))
+    transform = build_transform(image_size=args.image_size)
+    rng = np.random.default_rng(args.seed)
+    items = [
+        preprocess(image,
+                   transform=transform,
+                   patch_size=model.patch_size,
+                   embedding_type=args.embedding_type)
+        for image in synthetic_images(args.num_requests, rng)
+    ]
+    # warm-up
+    forward_batch(model, items[:1], device=torch.device('cpu'))
+
+    for max_batch_size in args.max_batch_sizes:
+        elapsed, latencies, batch_sizes = asyncio.run(
+            run_benchmark(model, items, max_batch_size,
+                          args.max_batch_wait_ms))
+        histogram = ' '.join(f'{size}:{count}'
+                             for size, count in sorted(batch_sizes.items()))
+        logger.info(
+            f'max-batch-size: {max_batch_size:>3d} '
+            f'throughput: {len(items) / elapsed:7.1f} images/s '
+            f'latency p50: {np.percentile(latencies, 50) * 1000:8.1f} ms '
+            f'p99: {np.percentile(latencies, 99) * 1000:8.1f} ms '
+            f'batch-size histogram: {histogram}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from loguru import logger
+
+from embedding_model import (build_embedder, configure_threads, forward_batch,
+                             load_model)
+
+MODES = {
+    'fp32': dict(precision='fp32', compile_mode='none'),
+    'bf16': dict(precision='bf16', compile_mode='none'),
+    'int8': dict(precision='int8', compile_mode='none'),
+    'fp32-trace': dict(precision='fp32', compile_mode='trace'),
+    'fp32-compile': dict(precision='fp32', compile_mode='compile'),
+    'int8-trace': dict(precision='int8', compile_mode='trace'),
+}
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--model', type=str, default='dinov2_vitb14')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--num-batches', type=int, default=10)
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--modes',
+                        type=str,
+                        nargs='+',
+                        default=list(MODES),
+                        choices=list(MODES))
+    parser.add_argument('--embedding-type',
+                        type=str,
+                        default='image',
+                        choices=['image', 'patch'])
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray):
+    a = a / np.linalg.norm(a, axis=-1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=-1, keepdims=True)
+    return (a * b).sum(axis=-1)
+
+
+def run_mode(embedder: torch.nn.Module, batches: list, device: torch.device,
+             precision: str):
+    # the first batch also serves as warm-up (trace / compile happen here)
+    forward_batch(embedder, batches[0], device=device, precision=precision)
+    embeddings = []
+    start = time.perf_counter()
+    for items in batches:
+        embeddings.extend(
+            result['embedding'] for result in forward_batch(
+                embedder, items, device=device, precision=precision))
+    elapsed = time.perf_counter() - start
+    return elapsed, np.asarray(embeddings, dtype=np.float32)
+
+
+def main():
+    args = arg_parse()
+    configure_threads(num_threads=args.num_threads)
+    device = torch.device(args.device)
+    model = load_model(model_name=args.model, device=device)
+    patch_size = model.patch_size
+    size = (args.image_size // patch_size) * patch_size
+    generator = torch.Generator().manual_seed(args.seed)
+    batches = [[
+        dict(tensor=torch.randn(3, size, size, generator=generator),
+             image_shape=[size, size],
+             embedding_type=args.embedding_type)
+        for _ in range(args.batch_size)
+    ] for _ in range(args.num_batches)]
+    num_images = args.batch_size * args.num_batches
+
+    reference = None
+    for mode in ['fp32'] + [m for m in args.modes if m != 'fp32']:
+        config = MODES[mode]
+        if config['precision'] == 'int8' and device.type != 'cpu':
+            logger.warning(f'Skip {mode}: int8 dynamic quantization is CPU only')
+            continue
+        embedder = build_embedder(model, device=device, **config)
+        elapsed, embeddings = run_mode(embedder, batches, device,
+                                       config['precision'])
+        if reference is None:
+            reference = embeddings
+        similarity = cosine_similarity(embeddings, reference).ravel()
+        logger.info(f'mode: {mode:>12s} '
+                    f'throughput: {num_images / elapsed:7.2f} images/s '
+                    f'cosine vs fp32 mean: {similarity.mean():.5f} '
+                    f'min: {similarity.min():.5f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from loguru import logger
+from pymilvus import CollectionSchema, DataType, FieldSchema, MilvusClient
+
+from focus_search import (rank_images_by_max_sim, rank_images_by_patch_hits,
+                          search_patch_hits)
+from vector_index import MilvusIndex, l2_normalize
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--num-images',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--patches-per-image', type=int, default=4)
+    parser.add_argument('--embedding-size', type=int, default=128)
+    parser.add_argument('--num-focus-patches', type=int, default=16)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--top-m', type=int, default=2048)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--candidates', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--legacy-max-images', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def create_synthetic_db(db_file: str, num_images: int, patches_per_image: int,
+                        embedding_size: int, rng: np.random.Generator):
+    client = MilvusClient(db_file)
+    schemas = [
+        FieldSchema(name="id",
+                    dtype=DataType.INT64,
+                    is_primary=True,
+                    auto_id=True),
+        FieldSchema(name="image_id", dtype=DataType.VARCHAR, max_length=200),
+        FieldSchema(name="embedding",
+                    dtype=DataType.FLOAT_VECTOR,
+                    dim=embedding_size)
+    ]
+    index_params = MilvusClient.prepare_index_params()
+    index_params.add_index(field_name="embedding",
+                           metric_type="COSINE",
+                           index_name="embedding_index")
+    for collection_name in ('image_embeddings', 'patch_embeddings'):
+        client.create_collection(collection_name=collection_name,
+                                 schema=CollectionSchema(fields=schemas))
+        client.create_index(collection_name=collection_name,
+                            index_params=index_params)
+
+    image_ids = [f'image-{i:07d}' for i in range(num_images)]
+    batch_size = 10000
+    for start in range(0, num_images, batch_size):
+        batch_ids = image_ids[start:start + batch_size]
+        patch_embedding = rng.standard_normal(
+            (len(batch_ids) * patches_per_image, embedding_size),
+            dtype=np.float32)
+        # the image embedding summarizes its patches, as the coarse stage of
+        # two-stage search assumes
+        image_embedding = l2_normalize(patch_embedding).reshape(
+            len(batch_ids), patches_per_image, -1).mean(axis=1)
+        client.insert('image_embeddings', [{
+            'image_id': image_id,
+            'embedding': embedding
+        } for image_id, embedding in zip(batch_ids, image_embedding)])
+        client.insert('patch_embeddings', [{
+            'image_id': batch_ids[i // patches_per_image],
+            'embedding': embedding
+        } for i, embedding in enumerate(patch_embedding)])
+    return client
+
+
+def legacy_rank(db: MilvusClient, focus_embedding: np.ndarray, top_k: int):
+    distances = []
+    all_images = db.query(collection_name='image_embeddings',
+                          filter='id > 0',
+                          output_fields=['image_id'])
+    for image_in_db in all_images:
+        image_id = image_in_db['image_id']
+        results = db.search(collection_name='patch_embeddings',
+                            data=focus_embedding,
+                            filter=f'image_id == "{image_id}"',
+                            output_fields=['image_id'],
+                            limit=1)
+        mean_distances = [r[0]['distance'] for r in results]
+        distances.append({
+            'image_id': image_id,
+            'distance': np.mean(mean_distances)
+        })
+    sorted_distance = sorted(distances,
+                             key=lambda a: a['distance'],
+                             reverse=True)
+    return [i['image_id'] for i in sorted_distance][:top_k]
+
+
+def batched_rank(db: MilvusClient, focus_embedding: np.ndarray, top_k: int,
+                 top_m: int, chunk_size: int):
+    hit_image_ids, hit_scores, hit_queries = search_patch_hits(
+        db, focus_embedding=focus_embedding, top_m=top_m, chunk_size=chunk_size)
+    return rank_images_by_patch_hits(hit_image_ids,
+                                     hit_scores,
+                                     hit_queries,
+                                     num_queries=len(focus_embedding),
+                                     top_k=top_k)
+
+
+def two_stage_rank(index: MilvusIndex, focus_embedding: np.ndarray,
+                   top_k: int, candidates: int):
+    focus_embedding = l2_normalize(focus_embedding)
+    candidate_ids, _ = index.search_images(focus_embedding.mean(axis=0),
+                                           limit=candidates)
+    patch_image_ids, patch_embedding = index.get_patches(candidate_ids)
+    return rank_images_by_max_sim(focus_embedding, patch_image_ids,
+                                  patch_embedding,
+                                  top_k=top_k)
+
+
+def timeit(func, repeat: int):
+    latencies, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies)), result
+
+
+def main():
+    args = arg_parse()
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_images in args.num_images:
+            db_file = os.path.join(tmp_dir, f'bench-{num_images}.db')
+            db = create_synthetic_db(db_file=db_file,
+                                     num_images=num_images,
+                                     patches_per_image=args.patches_per_image,
+                                     embedding_size=args.embedding_size,
+                                     rng=rng)
+            # noisy copies of a catalog image's patches
+            target = db.query('patch_embeddings',
+                              filter='id > 0',
+                              output_fields=['embedding'],
+                              limit=args.patches_per_image)
+            focus_embedding = np.asarray(
+                [r['embedding'] for r in target], dtype=np.float32)[
+                    rng.integers(len(target), size=args.num_focus_patches)]
+            focus_embedding += 0.5 * rng.standard_normal(
+                focus_embedding.shape, dtype=np.float32)
+
+            batched_latency, batched_result = timeit(
+                lambda: batched_rank(db, focus_embedding, args.top_k, args.
+                                     top_m, args.chunk_size), args.repeat)
+            index = MilvusIndex(db)
+            two_stage_latency, two_stage_result = timeit(
+                lambda: two_stage_rank(index, focus_embedding, args.top_k,
+                                       args.candidates), args.repeat)
+            overlap = len(set(two_stage_result) & set(batched_result)) / max(
+                len(batched_result), 1)
+            message = (f'images: {num_images:>7d} '
+                       f'batched: {batched_latency * 1000:9.1f} ms '
+                       f'two-stage (C={args.candidates}): '
+                       f'{two_stage_latency * 1000:9.1f} ms '
+                       f'overlap@{args.top_k}: {overlap:.2f}')
+            if num_images <= args.legacy_max_images:
+                legacy_latency, legacy_result = timeit(
+                    lambda: legacy_rank(db, focus_embedding, args.top_k), 1)
+                covered = args.top_m >= num_images * args.patches_per_image
+                message += (f' legacy: {legacy_latency * 1000:9.1f} ms '
+                            f'speedup: {legacy_latency / batched_latency:6.1f}x '
+                            f'same-ranking: {legacy_result == batched_result} '
+                            f'(top-m covers catalog: {covered})')
+            logger.info(message)
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from image_loader import DirectoryBucket, ImageLoader
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--num-images', type=int, default=256)
+    parser.add_argument('--image-bytes', type=int, default=2 * 2**20)
+    parser.add_argument('--latency-ms', type=float, default=30.0)
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--readers', type=int, default=16)
+    parser.add_argument('--work-dir', type=str, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def create_bucket(root: Path, rng: np.random.Generator):
+    names = [f'images/{i:06d}.jpg' for i in range(args.num_images)]
+    (root / 'images').mkdir(parents=True, exist_ok=True)
+    for name in names:
+        (root / name).write_bytes(rng.bytes(args.image_bytes))
+    return names
+
+
+def run(loader: ImageLoader, names: list, prefetch: bool):
+    # readers stand in for the service's I/O threads consuming requests
+    start = time.perf_counter()
+    if prefetch:
+        loader.prefetch(names)
+    with ThreadPoolExecutor(max_workers=args.readers) as readers:
+        total = sum(len(content) for content in readers.map(loader.read, names))
+    if prefetch:
+        loader.release_prefetch(names)
+    elapsed = time.perf_counter() - start
+    assert total == len(names) * args.image_bytes
+    return len(names) / elapsed
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='image-loader-'))
+    names = create_bucket(work_dir / 'bucket', rng)
+    logger.info(f'Fake bucket: {len(names)} blobs of '
+                f'{args.image_bytes / 2**20:.1f} MiB, '
+                f'{args.latency_ms:.0f} ms simulated latency per request')
+
+    # previous behaviour: one synchronous download per request, no cache
+    bucket = DirectoryBucket(work_dir / 'bucket', latency_ms=args.latency_ms)
+    start = time.perf_counter()
+    for name in names:
+        bucket.get_blob(name).download_as_bytes()
+    logger.info(f'sequential, no cache:    '
+                f'{len(names) / (time.perf_counter() - start):8.1f} images/s')
+
+    for pool_size in args.pool_sizes:
+        cache_dir = work_dir / f'cache-{pool_size}'
+        loader = ImageLoader(fake_bucket_dir=str(work_dir / 'bucket'),
+                             pool_size=pool_size,
+                             cache_dir=str(cache_dir),
+                             cache_bytes=2 * args.num_images *
+                             args.image_bytes)
+        loader.bucket.latency = args.latency_ms / 1000
+        cold = run(loader, names, prefetch=True)
+        warm = run(loader, names, prefetch=True)
+        logger.info(f'pool: {pool_size:>3d} prefetch cold cache: {cold:8.1f} '
+                    f'images/s warm cache: {warm:8.1f} images/s '
+                    f'(hits: {loader.cache.hits} misses: '
+                    f'{loader.cache.misses})')
+        loader.close()
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
@@ -0,0 +1,186 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from loguru import logger
+
+from patch_grid import (extract_region_patches, polygon_mask, resize_points,
+                        select_grid_rows)
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--grid-sizes', type=int, nargs='+', default=[16, 37])
+    parser.add_argument('--patch-size', type=int, default=14)
+    parser.add_argument('--embedding-size', type=int, default=1024)
+    parser.add_argument('--num-cases', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def reference_resize_coords(coords: dict, coords_img_size: tuple,
+                            target_img_size: tuple):
+    height_ratio = target_img_size[0] / coords_img_size[0]
+    width_ratio = target_img_size[1] / coords_img_size[1]
+    return dict(x1=coords['x1'] * width_ratio,
+                y1=coords['y1'] * height_ratio,
+                x2=coords['x2'] * width_ratio,
+                y2=coords['y2'] * height_ratio)
+
+
+def reference_locate(embedding: list, fg_mask: np.ndarray, coords: dict,
+                     patch_size: int, image_shape: tuple,
+                     embedding_shape: tuple):
+    # the list-comprehension implementation this module replaces
+    x1, y1, x2, y2 = coords['x1'], coords['y1'], coords['x2'], coords['y2']
+    grid_size = (image_shape[0] // patch_size, image_shape[1] // patch_size)
+    grid_x = int(x1 // patch_size), min(int(x2 // patch_size),
+                                        grid_size[1] - 1)
+    grid_y = int(y1 // patch_size), min(int(y2 // patch_size),
+                                        grid_size[0] - 1)
+    grid_index = [(y, x) for x in range(grid_x[0], grid_x[1] + 1, 1)
+                  for y in range(grid_y[0], grid_y[1] + 1, 1)]
+    y_values, x_values = zip(*grid_index)
+    embedding_array = np.asarray(embedding)
+    embedding_array[~np.asarray(fg_mask).ravel(), :] = 0
+    focus_embedding = embedding_array.reshape(*embedding_shape)[y_values,
+                                                                x_values, :]
+    return focus_embedding[focus_embedding.any(axis=1), :]
+
+
+def reference_polygon_mask(polygon: np.ndarray, patch_size: int,
+                           shape: tuple):
+    mask = np.zeros(shape, dtype=bool)
+    for y in range(shape[0]):
+        for x in range(shape[1]):
+            py, px = (y + 0.5) * patch_size, (x + 0.5) * patch_size
+            inside = False
+            for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1,
+                                                           axis=0)):
+                if (y1 > py) != (y2 > py) and px < x1 + (py - y1) * (
+                        x2 - x1) / (y2 - y1):
+                    inside = not inside
+            mask[y, x] = inside
+    return mask
+
+
+def sorted_rows(rows: np.ndarray):
+    # the reference walks the box column by column, the slice row by row
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def random_case(rng: np.random.Generator, grid_size: int):
+    patch_size = args.patch_size
+    image_shape = (grid_size * patch_size, grid_size * patch_size)
+    embedding_shape = (grid_size, grid_size, args.embedding_size)
+    embedding = rng.standard_normal((grid_size**2, args.embedding_size),
+                                    dtype=np.float32)
+    fg_mask = rng.random(grid_size**2) < 0.6
+    display_size = tuple(rng.integers(200, 1200, 2))
+    x1, x2 = np.sort(rng.uniform(0, display_size[1], 2))
+    y1, y2 = np.sort(rng.uniform(0, display_size[0], 2))
+    coords = dict(x1=x1, y1=y1, x2=x2, y2=y2)
+    return (embedding, fg_mask, coords, display_size, patch_size,
+            image_shape, embedding_shape)
+
+
+def check_equivalence(rng: np.random.Generator, grid_size: int):
+    for _ in range(args.num_cases):
+        (embedding, fg_mask, coords, display_size, patch_size, image_shape,
+         embedding_shape) = random_case(rng, grid_size)
+        box = np.asarray([[coords[k] for k in ('x1', 'y1', 'x2', 'y2')]])
+        box = resize_points(box, display_size, image_shape)
+        reference_coords = reference_resize_coords(coords, display_size,
+                                                   image_shape)
+        assert np.allclose(box[0], list(reference_coords.values()),
+                           rtol=1e-5)
+        reference = reference_locate(embedding.tolist(), fg_mask,
+                                     reference_coords, patch_size,
+                                     image_shape, embedding_shape)
+        result = extract_region_patches(embedding, fg_mask, box, [],
+                                        patch_size, image_shape,
+                                        embedding_shape)
+        assert result.dtype == np.float32
+        assert np.array_equal(sorted_rows(result), sorted_rows(reference))
+
+        # stored foreground rows with their grid positions select the same
+        fg_index = np.flatnonzero(fg_mask)
+        grid = np.stack(divmod(fg_index, grid_size), axis=1)
+        stored = embedding[fg_index][select_grid_rows(grid, box, [],
+                                                      patch_size,
+                                                      image_shape)]
+        assert np.array_equal(sorted_rows(stored), sorted_rows(reference))
+
+        # several boxes select the union of their single-box selections
+        boxes = np.concatenate([box, box / 2])
+        union = extract_region_patches(embedding, fg_mask, boxes, [],
+                                       patch_size, image_shape,
+                                       embedding_shape)
+        singles = np.unique(np.concatenate([
+            extract_region_patches(embedding, fg_mask, b[None], [],
+                                   patch_size, image_shape, embedding_shape)
+            for b in boxes
+        ]),
+                            axis=0)
+        assert np.array_equal(np.unique(union, axis=0), singles)
+
+        polygon = rng.uniform(0, image_shape[0], (rng.integers(3, 9), 2))
+        assert np.array_equal(
+            polygon_mask(polygon.astype(np.float32), patch_size,
+                         (grid_size, grid_size)),
+            reference_polygon_mask(polygon.astype(np.float32), patch_size,
+                                   (grid_size, grid_size)))
+
+
+def timeit(func, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    for grid_size in args.grid_sizes:
+        check_equivalence(rng, grid_size)
+        (embedding, fg_mask, coords, display_size, patch_size, image_shape,
+         embedding_shape) = random_case(rng, grid_size)
+        embedding_list = embedding.tolist()
+        box = resize_points(
+            np.asarray([[coords[k] for k in ('x1', 'y1', 'x2', 'y2')]]),
+            display_size, image_shape)
+        polygon = resize_points(
+            np.asarray([[coords['x1'], coords['y1']],
+                        [coords['x2'], coords['y1']],
+                        [coords['x1'], coords['y2']]]), display_size,
+            image_shape)
+        reference_time = timeit(
+            lambda: reference_locate(
+                embedding_list, fg_mask,
+                reference_resize_coords(coords, display_size, image_shape),
+                patch_size, image_shape, embedding_shape), args.repeat)
+        box_time = timeit(
+            lambda: extract_region_patches(embedding, fg_mask, box, [],
+                                           patch_size, image_shape,
+                                           embedding_shape), args.repeat)
+        region_time = timeit(
+            lambda: extract_region_patches(embedding, fg_mask,
+                                           np.concatenate([box, box / 2]),
+                                           [polygon], patch_size,
+                                           image_shape, embedding_shape),
+            args.repeat)
+        logger.info(f'grid {grid_size}x{grid_size}: {args.num_cases} cases '
+                    f'equivalent; reference: {reference_time * 1e3:8.3f} ms '
+                    f'box slice: {box_time * 1e3:8.3f} ms '
+                    f'({reference_time / box_time:6.1f}x) '
+                    f'2 boxes + polygon: {region_time * 1e3:8.3f} ms')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
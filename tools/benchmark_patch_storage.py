@@ -0,0 +1,191 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from focus_search import rank_images_by_patch_hits
+from patch_codec import PATCH_CODEC_FILE, PATCH_STORAGES, pool_patches
+from vector_index import (PATCH_EMBEDDINGS_FILE, PATCH_GRID_FILE,
+                          PATCH_IMAGE_INDEX_FILE, NumpyIndex, NumpyIndexWriter,
+                          resolve_index_dir)
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--index-dir',
+                        type=str,
+                        default=None,
+                        help='float32 numpy index with patch grids; '
+                        'synthetic catalog if unset')
+    parser.add_argument('--num-images', type=int, default=2000)
+    parser.add_argument('--grid-size', type=int, default=16)
+    parser.add_argument('--embedding-size', type=int, default=256)
+    parser.add_argument('--num-queries', type=int, default=100)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--top-m', type=int, default=256)
+    parser.add_argument('--storages',
+                        type=str,
+                        nargs='+',
+                        default=list(PATCH_STORAGES),
+                        choices=PATCH_STORAGES)
+    parser.add_argument('--poolings', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--pq-subvectors', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_catalog(rng: np.random.Generator):
+    # each image shows one of a few object classes; neighbouring patches
+    # share a part embedding so that pooling has spatial structure to keep
+    grid_size, dim = args.grid_size, args.embedding_size
+    num_parts = (grid_size // 4)**2
+    centers = rng.standard_normal((64, dim), dtype=np.float32)
+    parts = rng.standard_normal((64, num_parts, dim), dtype=np.float32)
+    grid = np.stack(np.divmod(np.arange(grid_size**2), grid_size), axis=1)
+    part_index = (grid[:, 0] // 4) * (grid_size // 4) + grid[:, 1] // 4
+    catalog = dict(image_index=[], grid=[], embedding=[])
+    for image in range(args.num_images):
+        label = rng.integers(len(centers))
+        fg = rng.random(len(grid)) < 0.6
+        embedding = (centers[label] + 0.7 * parts[label, part_index] +
+                     0.6 * rng.standard_normal((len(grid), dim),
+                                               dtype=np.float32))
+        catalog['image_index'].append(np.full(fg.sum(), image))
+        catalog['grid'].append(grid[fg])
+        catalog['embedding'].append(embedding[fg])
+    catalog = {k: np.concatenate(v) for k, v in catalog.items()}
+    catalog['image_ids'] = np.asarray([f'img-{i}' for i in range(
+        args.num_images)])
+    catalog['image_meta'] = np.tile([grid_size * 14, grid_size * 14, 14],
+                                    (args.num_images, 1))
+    return catalog
+
+
+def load_catalog(index_dir: str):
+    index = NumpyIndex(index_dir, mmap=False)
+    assert index.patch_grid is not None, 'index has no patch grid sidecars'
+    assert index.patch_codec.name == 'float32', 'baseline must be float32'
+    return dict(image_ids=index.image_ids,
+                image_meta=index.image_meta,
+                image_index=index.patch_image_index,
+                grid=index.patch_grid,
+                embedding=index.patch_embeddings)
+
+
+def split_catalog(catalog: dict, rng: np.random.Generator):
+    # held-out query images are not written to the compared indexes
+    query_images = rng.choice(len(catalog['image_ids']),
+                              args.num_queries,
+                              replace=False)
+    is_query = np.isin(catalog['image_index'], query_images)
+    queries = []
+    for image in query_images:
+        rows = catalog['image_index'] == image
+        grid = catalog['grid'][rows]
+        # random focus box covering a quarter to half of each grid side
+        grid_size = grid.max(axis=0) + 1
+        box_size = np.maximum(
+            1, (grid_size * rng.uniform(0.25, 0.5, 2)).astype(int))
+        y1, x1 = (rng.integers(0, grid_size - box_size + 1))
+        in_box = ((grid[:, 0] >= y1) & (grid[:, 0] < y1 + box_size[0]) &
+                  (grid[:, 1] >= x1) & (grid[:, 1] < x1 + box_size[1]))
+        if in_box.any():
+            queries.append(catalog['embedding'][rows][in_box])
+    keep_images = np.setdiff1d(np.arange(len(catalog['image_ids'])),
+                               query_images)
+    return queries, keep_images, ~is_query
+
+
+def write_index(index_dir: str, catalog: dict, keep_images: np.ndarray,
+                keep_rows: np.ndarray, storage: str, pooling: int):
+    image_index, grid, embedding = pool_patches(
+        catalog['image_index'][keep_rows],
+        np.asarray(catalog['grid'][keep_rows]),
+        np.asarray(catalog['embedding'][keep_rows]), pooling)
+    # pooled rows are cells of a grid with pooling x larger patches
+    image_meta = catalog['image_meta'][keep_images] * [1, 1, pooling]
+    writer = NumpyIndexWriter(index_dir,
+                              embedding_size=embedding.shape[1],
+                              patch_storage=storage,
+                              pq_subvectors=args.pq_subvectors)
+    writer.add_images(catalog['image_ids'][keep_images].tolist(),
+                      np.zeros((len(keep_images), embedding.shape[1]),
+                               dtype=np.float32),
+                      image_meta=image_meta)
+    writer.add_patches(catalog['image_ids'][image_index].tolist(), embedding,
+                       grid)
+    writer.close()
+
+
+def patch_bytes(index_dir: str):
+    index_dir, _ = resolve_index_dir(index_dir)
+    return sum((index_dir / file_name).stat().st_size
+               for file_name in (PATCH_EMBEDDINGS_FILE, PATCH_GRID_FILE,
+                                 PATCH_IMAGE_INDEX_FILE, PATCH_CODEC_FILE))
+
+
+def rank_queries(index: NumpyIndex, queries):
+    rankings, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hit_image_ids, hit_scores, hit_queries = index.search_patches(
+            query, limit=args.top_m)
+        rankings.append(
+            rank_images_by_patch_hits(hit_image_ids,
+                                      hit_scores,
+                                      hit_queries,
+                                      num_queries=len(query),
+                                      top_k=args.top_k))
+        latencies.append(time.perf_counter() - start)
+    return rankings, latencies
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    catalog = load_catalog(args.index_dir) if args.index_dir else (
+        synthetic_catalog(rng))
+    queries, keep_images, keep_rows = split_catalog(catalog, rng)
+    logger.info(f'{len(keep_images)} images, {keep_rows.sum()} patches, '
+                f'{len(queries)} held-out focus queries')
+
+    baseline, baseline_bytes = None, None
+    variants = [('float32', 1)] + [(storage, pooling)
+                                   for pooling in args.poolings
+                                   for storage in args.storages
+                                   if (storage, pooling) != ('float32', 1)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for storage, pooling in variants:
+            index_dir = Path(tmp_dir) / f'{storage}-{pooling}'
+            write_index(index_dir, catalog, keep_images, keep_rows, storage,
+                        pooling)
+            index = NumpyIndex(index_dir)
+            rankings, latencies = rank_queries(index, queries)
+            size = patch_bytes(index_dir)
+            if baseline is None:
+                baseline, baseline_bytes = rankings, size
+            overlap = np.mean([
+                len(set(a) & set(b)) / max(len(b), 1)
+                for a, b in zip(rankings, baseline)
+            ])
+            top1 = np.mean([
+                bool(a) and bool(b) and a[0] == b[0]
+                for a, b in zip(rankings, baseline)
+            ])
+            logger.info(
+                f'{storage:8s} pool {pooling}x{pooling}: '
+                f'{len(index.patch_embeddings):8d} rows '
+                f'{size / 2**20:8.1f} MiB ({baseline_bytes / size:5.1f}x) '
+                f'overlap@{args.top_k}: {overlap:.3f} top-1: {top1:.3f} '
+                f'latency p50: {np.percentile(latencies, 50) * 1000:7.2f} ms')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
@@ -0,0 +1,84 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import io
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from preprocessing import build_preprocess_executor, decode_and_preprocess
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--num-images', type=int, default=64)
+    parser.add_argument('--source-size',
+                        type=int,
+                        nargs=2,
+                        default=[4032, 3024])
+    parser.add_argument('--image-size', type=int, default=448)
+    parser.add_argument('--patch-size', type=int, default=14)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--modes',
+                        type=str,
+                        nargs='+',
+                        default=['thread', 'process'],
+                        choices=['thread', 'process'])
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_jpegs(num_images: int, size: tuple, rng: np.random.Generator):
+    width, height = size
+    # smooth gradients plus noise compress like photos, unlike pure noise
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    contents = []
+    for _ in range(num_images):
+        noise = rng.normal(0, 20, (height, width, 3)).astype(np.float32)
+        array = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(array).save(buffer, format='JPEG', quality=90)
+        contents.append(buffer.getvalue())
+    return contents
+
+
+def run_benchmark(contents: list, mode: str, num_workers: int, draft: bool):
+    executor = build_preprocess_executor(mode=mode, num_workers=num_workers)
+    start = time.perf_counter()
+    items = list(
+        executor.map(decode_and_preprocess,
+                     contents,
+                     [args.image_size] * len(contents),
+                     [args.patch_size] * len(contents),
+                     ['image'] * len(contents),
+                     [draft] * len(contents),
+                     chunksize=1))
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    return elapsed, items
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    contents = synthetic_jpegs(args.num_images, tuple(args.source_size), rng)
+    logger.info(f'{len(contents)} JPEGs of {args.source_size[0]}x'
+                f'{args.source_size[1]}, mean '
+                f'{np.mean([len(c) for c in contents]) / 2**20:.1f} MiB')
+    for draft in (False, True):
+        for mode in args.modes:
+            for num_workers in args.workers:
+                elapsed, items = run_benchmark(contents, mode, num_workers,
+                                               draft)
+                logger.info(f'draft: {str(draft):5s} mode: {mode:7s} '
+                            f'workers: {num_workers:>2d} throughput: '
+                            f'{len(contents) / elapsed:7.1f} images/s '
+                            f'output: {tuple(items[0]["tensor"].shape)}')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
@@ -0,0 +1,129 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import asyncio
+import subprocess
+import time
+from argparse import ArgumentParser
+
+import aiohttp
+import numpy as np
+import requests
+from loguru import logger
+
+from vector_index import NumpyIndex
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--index-dir', type=str, required=True)
+    parser.add_argument('--fg-pipeline', type=str, default='fg-model.npz')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--port', type=int, default=8012)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--num-queries', type=int, default=1000)
+    parser.add_argument('--focus-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def build_queries(rng: np.random.Generator):
+    # catalog images, so no query needs the embedding service
+    index = NumpyIndex(args.index_dir)
+    queries = []
+    for row in rng.integers(0, len(index.image_ids), args.num_queries):
+        coords_info = None
+        if index.image_meta is not None and rng.random() < args.focus_ratio:
+            height, width = index.image_meta[row][:2]
+            x1, x2 = np.sort(rng.uniform(0, width, 2))
+            y1, y2 = np.sort(rng.uniform(0, height, 2))
+            coords_info = dict(x1=x1,
+                               y1=y1,
+                               x2=x2,
+                               y2=y2,
+                               width=int(width),
+                               height=int(height))
+        queries.append(
+            dict(image_path='',
+                 image_id=str(index.image_ids[row]),
+                 coords_info=coords_info))
+    return queries
+
+
+def start_service(workers: int):
+    # result caching is off so every request searches the index
+    process = subprocess.Popen([
+        sys.executable, 'deploy_services/recommender.py', '--index-backend',
+        'numpy', '--index-dir', args.index_dir, '--fg-pipeline',
+        args.fg_pipeline, '--port',
+        str(args.port), '--workers',
+        str(workers), '--result-cache-size', '0'
+    ],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    while True:
+        assert process.poll() is None, 'recommender exited'
+        try:
+            if requests.get(f'http://127.0.0.1:{args.port}/readyz',
+                            timeout=1.0).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+
+
+async def run_load(queries: list, duration: float):
+    url = f'http://127.0.0.1:{args.port}/recommend-image/'
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def client(session: aiohttp.ClientSession, offset: int):
+        nonlocal errors
+        position = offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                async with session.post(
+                        url, json=queries[position %
+                                          len(queries)]) as response:
+                    await response.read()
+                    errors += response.status != 200
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+            position += args.concurrency
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=args.concurrency)) as session:
+        await asyncio.gather(
+            *[client(session, offset) for offset in range(args.concurrency)])
+    return np.asarray(latencies), errors
+
+
+def main():
+    queries = build_queries(np.random.default_rng(args.seed))
+    base_qps = None
+    for workers in args.workers:
+        process = start_service(workers)
+        try:
+            # every worker loads the index on its own; warm all of them up
+            asyncio.run(run_load(queries, duration=min(2.0, args.duration)))
+            latencies, errors = asyncio.run(
+                run_load(queries, duration=args.duration))
+        finally:
+            process.terminate()
+            process.wait()
+        qps = len(latencies) / args.duration
+        base_qps = base_qps or qps
+        logger.info(f'workers {workers:2d}: {qps:8.1f} req/s '
+                    f'({qps / base_qps:4.2f}x) '
+                    f'p50 {np.percentile(latencies, 50) * 1e3:7.1f} ms '
+                    f'p99 {np.percentile(latencies, 99) * 1e3:7.1f} ms '
+                    f'errors {errors}')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
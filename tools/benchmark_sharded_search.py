@@ -0,0 +1,129 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from focus_search import rank_images_by_patch_hits
+from vector_index import (NumpyIndexWriter, load_index, shard_index_dir,
+                          shard_of, write_shard_manifest)
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--num-images', type=int, default=20000)
+    parser.add_argument('--patches-per-image', type=int, default=32)
+    parser.add_argument('--embedding-size', type=int, default=384)
+    parser.add_argument('--num-shards',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--num-queries', type=int, default=50)
+    parser.add_argument('--focus-patches', type=int, default=16)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--top-m', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_catalog(rng: np.random.Generator):
+    dim = args.embedding_size
+    centers = rng.standard_normal((256, dim), dtype=np.float32)
+    labels = rng.integers(len(centers), size=args.num_images)
+    image_embedding = centers[labels] + rng.standard_normal(
+        (args.num_images, dim), dtype=np.float32)
+    patch_image_index = np.repeat(np.arange(args.num_images),
+                                  args.patches_per_image)
+    patch_embedding = centers[labels[patch_image_index]] + 1.5 * (
+        rng.standard_normal((len(patch_image_index), dim), dtype=np.float32))
+    return dict(image_ids=np.asarray(
+        [f'img-{i}' for i in range(args.num_images)]),
+                image_embedding=image_embedding,
+                patch_image_index=patch_image_index,
+                patch_embedding=patch_embedding)
+
+
+def write_shards(index_dir: str, catalog: dict, num_shards: int):
+    image_shards = shard_of(catalog['image_ids'].tolist(), num_shards)
+    patch_shards = image_shards[catalog['patch_image_index']]
+    shard_versions = []
+    for shard in range(num_shards):
+        images = image_shards == shard
+        patches = patch_shards == shard
+        writer = NumpyIndexWriter(shard_index_dir(index_dir, shard,
+                                                  num_shards),
+                                  embedding_size=args.embedding_size)
+        writer.add_images(catalog['image_ids'][images].tolist(),
+                          catalog['image_embedding'][images])
+        writer.add_patches(
+            catalog['image_ids'][
+                catalog['patch_image_index'][patches]].tolist(),
+            catalog['patch_embedding'][patches])
+        shard_versions.append(writer.close())
+    if num_shards > 1:
+        write_shard_manifest(index_dir, shard_versions)
+
+
+def run_queries(index, queries: list):
+    results, image_latencies, patch_latencies = [], [], []
+    for image_query, patch_query in queries:
+        start = time.perf_counter()
+        image_ids, _ = index.search_images(image_query, args.top_k)
+        image_latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        hit_image_ids, hit_scores, hit_queries = index.search_patches(
+            patch_query, limit=args.top_m)
+        ranking = rank_images_by_patch_hits(hit_image_ids,
+                                            hit_scores,
+                                            hit_queries,
+                                            num_queries=len(patch_query),
+                                            top_k=args.top_k)
+        patch_latencies.append(time.perf_counter() - start)
+        results.append((image_ids, list(ranking)))
+    return results, np.median(image_latencies), np.median(patch_latencies)
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    catalog = synthetic_catalog(rng)
+    queries = [(rng.standard_normal(args.embedding_size, dtype=np.float32),
+                catalog['patch_embedding'][rng.choice(
+                    len(catalog['patch_embedding']), args.focus_patches)])
+               for _ in range(args.num_queries)]
+    logger.info(f'{args.num_images} images, '
+                f'{len(catalog["patch_embedding"])} patches, '
+                f'{os.cpu_count()} cpus')
+
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_shards in args.num_shards:
+            index_dir = str(Path(tmp_dir) / f'shards-{num_shards}')
+            write_shards(index_dir, catalog, num_shards)
+            index = load_index('numpy',
+                               index_dir=index_dir,
+                               num_shards=num_shards)
+            run_queries(index, queries[:2])
+            results, image_latency, patch_latency = run_queries(
+                index, queries)
+            if baseline is None:
+                baseline = results, image_latency, patch_latency
+            exact = all(result == expected
+                        for result, expected in zip(results, baseline[0]))
+            logger.info(f'shards {num_shards:2d}: '
+                        f'image search p50 {image_latency * 1e3:7.2f} ms '
+                        f'({baseline[1] / image_latency:4.2f}x) '
+                        f'patch search p50 {patch_latency * 1e3:7.2f} ms '
+                        f'({baseline[2] / patch_latency:4.2f}x) '
+                        f'same results as 1 shard: {exact}')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
@@ -0,0 +1,93 @@
+import os
+import sys
+
+sys.path.insert(0, '.')
+sys.path.insert(0, 'tools')
+
+import tempfile
+import time
+from argparse import ArgumentParser
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from loguru import logger
+from PIL import Image as PILImage
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'image_recommender.settings'
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--num-images', type=int, default=500)
+    parser.add_argument('--image-size', type=int, nargs=2, default=[1024, 768])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--io-workers', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--thumbnail-size', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def write_images(img_dir: Path, rng: np.random.Generator):
+    width, height = args.image_size
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    for image in range(args.num_images):
+        pixels = gradient * rng.uniform(0.2, 1.0, 3) + rng.normal(
+            0, 12, (height, width, 3))
+        sub_dir = img_dir / f'{image % 10}'
+        sub_dir.mkdir(parents=True, exist_ok=True)
+        PILImage.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(
+            sub_dir / f'{image}.{"png" if image % 5 == 0 else "jpg"}',
+            quality=90)
+
+
+def run(name: str, upload_func, img_dir: Path, media_dir: Path):
+    from django.test import override_settings
+    with override_settings(MEDIA_ROOT=media_dir):
+        start = time.perf_counter()
+        num_files = upload_func(img_dir)
+        elapsed = time.perf_counter() - start
+    logger.info(f'{name:22s}: {num_files:6d} files {elapsed:7.2f}s '
+                f'{num_files / elapsed:8.1f} files/s')
+    return num_files / elapsed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        # a scratch DB and media root, never the configured ones
+        settings.DATABASES['default']['NAME'] = tmp_dir / 'db.sqlite3'
+        import upload_img_django
+        from django.db import connection
+        from image.models import Image
+        # the image app ships without migrations (makemigrations runs at
+        # setup), so the scratch table is created directly
+        with connection.schema_editor() as editor:
+            editor.create_model(Image)
+
+        write_images(tmp_dir / 'images', np.random.default_rng(args.seed))
+        create_rate = run('create (per file)', upload_img_django.upload_images,
+                          tmp_dir / 'images', tmp_dir / 'media-create')
+        Image.objects.all().delete()
+        bulk_upload_images = partial(upload_img_django.bulk_upload_images,
+                                     workers=args.workers,
+                                     io_workers=args.io_workers,
+                                     batch_size=args.batch_size,
+                                     thumbnail_size=args.thumbnail_size)
+        bulk_rate = run('bulk', bulk_upload_images, tmp_dir / 'images',
+                        tmp_dir / 'media-bulk')
+        assert Image.objects.count() == args.num_images
+        rerun_rate = run('bulk (all known)', bulk_upload_images,
+                         tmp_dir / 'images', tmp_dir / 'media-bulk')
+        assert Image.objects.count() == args.num_images
+    logger.info(f'bulk vs create: {bulk_rate / create_rate:.2f}x, '
+                f're-run {rerun_rate / create_rate:.2f}x '
+                f'({args.workers} hashing workers, thumbnails '
+                f'{args.thumbnail_size or "off"})')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
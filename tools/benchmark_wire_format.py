@@ -0,0 +1,110 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import requests
+from loguru import logger
+
+from wire_format import (accept_header, decode_embedding, encode_embedding,
+                         negotiate)
+
+FORMATS = [('json', 'float32'), ('ndarray', 'float32'),
+           ('ndarray', 'float16'), ('msgpack', 'float32'),
+           ('msgpack', 'float16')]
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--embedding-size', type=int, default=768)
+    parser.add_argument('--image-size', type=int, default=448)
+    parser.add_argument('--patch-size', type=int, default=14)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--embedding-url', type=str, default=None)
+    parser.add_argument('--image-path', type=str, default=None)
+    return parser.parse_args()
+
+
+def synthetic_embedding_info(embedding_type: str, image_size: int,
+                             patch_size: int, embedding_size: int):
+    grid = image_size // patch_size
+    if embedding_type == 'image':
+        embedding = np.random.standard_normal(embedding_size)
+        embedding_shape = (1, embedding_size)
+    else:
+        embedding = np.random.standard_normal((grid * grid, embedding_size))
+        embedding_shape = (grid, grid, embedding_size)
+    return dict(embedding=embedding.astype(np.float32),
+                embedding_shape=embedding_shape,
+                image_shape=[image_size, image_size],
+                patch_size=patch_size)
+
+
+def benchmark_codec(embedding_info: dict, embedding_format: str, dtype: str,
+                    repeat: int):
+    media_type, dtype = negotiate(accept_header(embedding_format, dtype))
+    encode_time, decode_time = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        content, headers = encode_embedding(embedding_info, media_type, dtype)
+        encode_time.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        decoded = decode_embedding(content, media_type, headers)
+        decode_time.append(time.perf_counter() - start)
+    error = np.abs(decoded['embedding'].astype(np.float32) -
+                   embedding_info['embedding']).max()
+    return len(content), np.median(encode_time), np.median(decode_time), error
+
+
+def benchmark_service(url: str, image_path: str, embedding_format: str,
+                      dtype: str, repeat: int):
+    latencies, size = [], 0
+    with requests.Session() as session:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = session.post(
+                url,
+                json=dict(image_path=image_path),
+                headers={'Accept': accept_header(embedding_format, dtype)})
+            response.raise_for_status()
+            decode_embedding(response.content,
+                             content_type=response.headers['Content-Type'],
+                             headers=response.headers)
+            latencies.append(time.perf_counter() - start)
+            size = len(response.content)
+    return size, np.median(latencies)
+
+
+def main():
+    args = arg_parse()
+    for embedding_type in ('image', 'patch'):
+        embedding_info = synthetic_embedding_info(embedding_type,
+                                                  args.image_size,
+                                                  args.patch_size,
+                                                  args.embedding_size)
+        for embedding_format, dtype in FORMATS:
+            size, encode_time, decode_time, error = benchmark_codec(
+                embedding_info, embedding_format, dtype, args.repeat)
+            logger.info(f'{embedding_type:>5s} {embedding_format:>7s} '
+                        f'{dtype:>7s} payload: {size / 1024:9.1f} KiB '
+                        f'encode: {encode_time * 1000:7.2f} ms '
+                        f'decode: {decode_time * 1000:7.2f} ms '
+                        f'max-abs-error: {error:.2e}')
+
+    if args.embedding_url and args.image_path:
+        for embedding_type in ('image', 'patch'):
+            url = f'{args.embedding_url}/generate-{embedding_type}-embedding/'
+            for embedding_format, dtype in FORMATS:
+                size, latency = benchmark_service(url, args.image_path,
+                                                  embedding_format, dtype,
+                                                  args.repeat)
+                logger.info(f'{embedding_type:>5s} {embedding_format:>7s} '
+                            f'{dtype:>7s} payload: {size / 1024:9.1f} KiB '
+                            f'end-to-end: {latency * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import sys
+
+sys.path.insert(0, 'deploy_services')
+
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from loguru import logger
+
+from embedding_model import load_model, save_model_snapshot
+from patch_codec import PATCH_STORAGES
+from vector_index import (IMAGE_HASH_FIELD, IMAGE_META_FIELDS,
+                          PATCH_GRID_FIELDS, MilvusIndex, NumpyIndexWriter,
+                          load_db, query_rows)
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--model', type=str, default=None)
+    parser.add_argument('--weights-file', type=str, default=None)
+    parser.add_argument('--db-file', type=str, default=None)
+    parser.add_argument('--index-dir', type=str, default=None)
+    parser.add_argument('--patch-storage',
+                        type=str,
+                        default='float32',
+                        choices=PATCH_STORAGES)
+    parser.add_argument('--pq-subvectors', type=int, default=64)
+    parser.add_argument('--page-size', type=int, default=16384)
+    args = parser.parse_args()
+    if not ((args.model and args.weights_file) or
+            (args.db_file and args.index_dir)):
+        parser.error('export --model to --weights-file and/or '
+                     '--db-file to --index-dir')
+    return args
+
+
+def export_model():
+    model = load_model(model_name=args.model, device=torch.device('cpu'))
+    save_model_snapshot(model,
+                        model_name=args.model,
+                        weights_file=args.weights_file)
+
+
+def add_patch_rows(writer: NumpyIndexWriter, index: MilvusIndex,
+                   image_ids: list):
+    grid_fields = list(PATCH_GRID_FIELDS) if index.has_patch_grid else []
+    num_patches = 0
+    for rows in query_rows(index.db,
+                           'patch_embeddings',
+                           ['image_id', 'embedding', *grid_fields],
+                           row_filter=f'image_id in {json.dumps(image_ids)}',
+                           batch_size=args.page_size):
+        writer.add_patches(
+            [row['image_id'] for row in rows],
+            index._patch_vectors(rows),
+            grid=np.asarray([[row[field] for field in PATCH_GRID_FIELDS]
+                             for row in rows],
+                            dtype=np.int16) if grid_fields else None)
+        num_patches += len(rows)
+    return num_patches
+
+
+def export_index():
+    # the NumPy index is the mmap snapshot format of the Milvus collections;
+    # images are exported page by page together with their patches
+    index = MilvusIndex(load_db(db_file=args.db_file))
+    writer = None
+    num_images = num_patches = 0
+    hash_fields = [IMAGE_HASH_FIELD] if index.has_image_hash else []
+    for rows in query_rows(index.db,
+                           'image_embeddings',
+                           ['image_id', 'embedding', *IMAGE_META_FIELDS,
+                            *hash_fields],
+                           batch_size=args.page_size):
+        embedding = np.asarray([row['embedding'] for row in rows],
+                               dtype=np.float32)
+        if writer is None:
+            writer = NumpyIndexWriter(index_dir=args.index_dir,
+                                      embedding_size=embedding.shape[1],
+                                      patch_storage=args.patch_storage,
+                                      pq_subvectors=args.pq_subvectors)
+        image_ids = [row['image_id'] for row in rows]
+        writer.add_images(image_ids,
+                          embedding,
+                          image_meta=np.asarray(
+                              [[row[field] for field in IMAGE_META_FIELDS]
+                               for row in rows],
+                              dtype=np.int32),
+                          image_hashes=[
+                              row[IMAGE_HASH_FIELD] for row in rows
+                          ] if hash_fields else None)
+        num_patches += add_patch_rows(writer, index, image_ids)
+        num_images += len(rows)
+        writer.flush()
+    assert writer is not None, f'{args.db_file} has no images'
+    writer.close()
+    logger.info(f'Export {args.db_file} to {args.index_dir}: '
+                f'{num_images} images, {num_patches} patches')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    if args.model and args.weights_file:
+        export_model()
+    if args.db_file and args.index_dir:
+        export_index()
@@ -1,6 +1,7 @@
 import sys
 
 sys.path.insert(0, '.')
+sys.path.insert(0, 'deploy_services')
 
 import os
 
@@ -10,47 +11,121 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'image_recommender.settings'
 django.setup()
 
 import asyncio
+import json
+import time
 from argparse import ArgumentParser
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Set
 
 import aiohttp
-import joblib
 import numpy as np
 from loguru import logger
 from pymilvus import CollectionSchema, DataType, FieldSchema, MilvusClient
-from pymilvus.milvus_client import IndexParams
-from sklearn.decomposition import PCA
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import MinMaxScaler
 
+from foreground import ForegroundEstimator, ForegroundModel
 from image.models import Image
+from patch_codec import PATCH_STORAGES, pool_patches
+from vector_index import (IMAGE_HASH_FIELD, IMAGE_HASHES_FILE, IMAGE_IDS_FILE,
+                          IMAGE_META_FIELDS, INDEX_TYPES, PATCH_GRID_FIELDS,
+                          MilvusBulkInserter, NumpyIndexWriter,
+                          build_index_params, collection_fields,
+                          index_version_file, is_server_uri,
+                          parse_index_params, query_rows, resolve_index_dir,
+                          shard_db_file, shard_index_dir, shard_of,
+                          write_index_version, write_shard_manifest)
+from wire_format import FrameDecoder, accept_header
 
-IMAGE_EMBEDDING_API = '/generate-image-embedding/'
-PATCH_EMBEDDING_API = '/generate-patch-embedding/'
+EMBEDDING_API = '/generate-embedding/batch'
 
 
 def arg_parse():
     parser = ArgumentParser()
+    parser.add_argument('--index-format',
+                        type=str,
+                        nargs='+',
+                        default=['milvus'],
+                        choices=['milvus', 'numpy'])
     parser.add_argument('--db-file', type=str, default='embedding.db')
+    parser.add_argument('--index-dir', type=str, default='embedding-index')
+    parser.add_argument('--index-version-file',
+                        type=str,
+                        default=None,
+                        help='version file published for a Milvus server '
+                        'URI (Milvus Lite: [DB_FILE].version)')
     parser.add_argument('--embedding-url',
                         type=str,
                         default='http://127.0.0.1')
     parser.add_argument('--embedding-port', type=int, default=8000)
     parser.add_argument('--embedding-size', type=int, default=1024)
+    parser.add_argument('--embedding-format',
+                        type=str,
+                        default='ndarray',
+                        choices=['json', 'ndarray', 'msgpack'])
     parser.add_argument('--save-fg-pipeline',
                         type=str,
-                        default='fg-pipeline.pkl')
-    return parser.parse_args()
+                        default='fg-model.npz')
+    parser.add_argument('--fg-fit-images',
+                        type=int,
+                        default=256,
+                        help='random catalog images embedded first to fit '
+                        'the foreground model')
+    parser.add_argument('--fg-sample-size', type=int, default=50000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--request-batch-size', type=int, default=32)
+    parser.add_argument('--http-timeout', type=float, default=300.0)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--insert-batch-size', type=int, default=100000)
+    parser.add_argument('--checkpoint-file',
+                        type=str,
+                        default='embedding.checkpoint')
+    parser.add_argument('--resume', action='store_true')
+    for collection in ('image', 'patch'):
+        parser.add_argument(f'--{collection}-index-type',
+                            type=str,
+                            default='AUTOINDEX',
+                            choices=INDEX_TYPES)
+        parser.add_argument(f'--{collection}-index-params',
+                            type=str,
+                            nargs='*',
+                            default=[],
+                            help='build params, e.g. nlist=1024 m=16')
+    parser.add_argument('--rebuild-index', action='store_true')
+    parser.add_argument('--patch-storage',
+                        type=str,
+                        default='float32',
+                        choices=PATCH_STORAGES)
+    parser.add_argument('--pq-subvectors', type=int, default=64)
+    parser.add_argument('--patch-pooling',
+                        type=int,
+                        default=1,
+                        help='average foreground patches in k x k blocks')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--num-shards',
+                        type=int,
+                        default=1,
+                        help='partition images by a hash of their id into '
+                        'K Milvus DBs / NumPy indexes')
+    args = parser.parse_args()
+    if 'milvus' in args.index_format and args.patch_storage in ('sq8', 'pq'):
+        # Milvus keeps raw vectors; quantization lives in the index type
+        parser.error('milvus stores float32 or float16 patch vectors, use '
+                     '--patch-index-type IVF_SQ8 or IVF_PQ to quantize')
+    if 'milvus' in args.index_format and args.num_shards > 1 and (
+            is_server_uri(args.db_file)):
+        parser.error('--num-shards splits local Milvus Lite DB files; a '
+                     'Milvus server shards its collections itself')
+    return args
 
 
 def create_collection(
     client: MilvusClient,
     collection_name: str,
     schemas: List[FieldSchema],
-    index_param: IndexParams,
+    reset: bool = True,
 ):
     if client.has_collection(collection_name):
+        if not reset:
+            return client
         client.drop_collection(collection_name)
 
     client.create_collection(collection_name=collection_name,
@@ -60,110 +135,511 @@ def create_collection(
                                      s.capitalize()
                                      for s in collection_name.split('_')
                                  ])))
+    return client
 
-    client.create_index(collection_name=collection_name,
-                        index_params=index_param)
+
+def build_indexes(client: MilvusClient, rebuild: bool = False):
+    for collection in ('image', 'patch'):
+        collection_name = f'{collection}_embeddings'
+        index_type = getattr(args, f'{collection}_index_type')
+        index_params = parse_index_params(
+            getattr(args, f'{collection}_index_params'))
+        if rebuild and client.list_indexes(collection_name):
+            client.release_collection(collection_name)
+            client.drop_index(collection_name, index_name='embedding_index')
+        if not client.list_indexes(collection_name):
+            start = time.perf_counter()
+            client.create_index(collection_name=collection_name,
+                                index_params=build_index_params(
+                                    index_type, index_params))
+            logger.info(f'Build {index_type} index {index_params} on '
+                        f'{collection_name} in '
+                        f'{time.perf_counter() - start:.1f}s')
+        client.load_collection(collection_name)
     return client
 
 
-def create_db_collections(client: MilvusClient):
-    schemas = [
+def base_schemas(vector_dtype: DataType = DataType.FLOAT_VECTOR):
+    return [
         FieldSchema(name="id",
                     dtype=DataType.INT64,
                     is_primary=True,
                     auto_id=True),
         FieldSchema(name="image_id", dtype=DataType.VARCHAR, max_length=200),
         FieldSchema(name="embedding",
-                    dtype=DataType.FLOAT_VECTOR,
+                    dtype=vector_dtype,
                     dim=args.embedding_size)
     ]
-    index_params = MilvusClient.prepare_index_params()
-    index_params.add_index(
-        field_name="embedding",
-        metric_type="COSINE",
-        index_name="embedding_index",
-    )
+
+
+def create_db_collections(client: MilvusClient, reset: bool = True):
+    image_schemas = base_schemas() + [
+        FieldSchema(name=name, dtype=DataType.INT32)
+        for name in IMAGE_META_FIELDS
+    ] + [
+        FieldSchema(name=IMAGE_HASH_FIELD,
+                    dtype=DataType.VARCHAR,
+                    max_length=32)
+    ]
+    patch_vector_dtype = DataType.FLOAT16_VECTOR if (
+        args.patch_storage == 'float16') else DataType.FLOAT_VECTOR
+    patch_schemas = base_schemas(patch_vector_dtype) + [
+        FieldSchema(name=name, dtype=DataType.INT16)
+        for name in PATCH_GRID_FIELDS
+    ]
     client = create_collection(client=client,
                                collection_name='image_embeddings',
-                               schemas=schemas,
-                               index_param=index_params)
+                               schemas=image_schemas,
+                               reset=reset)
     client = create_collection(client=client,
                                collection_name='patch_embeddings',
-                               schemas=schemas,
-                               index_param=index_params)
-
-    return client
+                               schemas=patch_schemas,
+                               reset=reset)
+    # indexes of existing collections are needed to query and delete rows
+    return client if reset else build_indexes(client)
 
 
-def create_vector_db(db_file: str):
-    logger.info(f'Create DB: {db_file}')
+def create_vector_db(db_file: str, reset: bool = True):
+    logger.info(f'{"Create" if reset else "Open"} DB: {db_file}')
     logger.info(
         f'Create Collection: "image_embeddings" shape: {args.embedding_size}')
     if Path(f'.{db_file}.lock').exists():
         os.remove(f'.{db_file}.lock')
     client = MilvusClient(db_file)
-    return create_db_collections(client)
+    return create_db_collections(client, reset=reset)
 
 
-def process_patch_embeddings(patch_embeddings_info: List[dict]):
-    all_patch_embedding = np.vstack(
-        [p['embedding'] for p in patch_embeddings_info])
-    fg_pipeline = Pipeline([('pca', PCA(n_components=1)),
-                            ('scaler', MinMaxScaler())])
-    fg_pipeline.fit(all_patch_embedding)
+def process_patch_embeddings(fg_model: ForegroundModel,
+                             patch_embeddings_info: List[dict],
+                             threshold: float = 0.5,
+                             pooling: int = 1):
     for patch_embedding in patch_embeddings_info:
         embedding = patch_embedding['embedding']
-        trns_patch_embedding = fg_pipeline.transform(embedding)
-        fg_mask = (trns_patch_embedding > 0.5).ravel()
-        embedding = embedding[fg_mask, :]
+        fg_index = np.flatnonzero(fg_model.score(embedding) > threshold)
+        grid_width = patch_embedding['embedding_shape'][1]
+        # foreground rows keep their (y, x) position on the patch grid
+        grid = np.stack(divmod(fg_index, grid_width), axis=1)
+        _, grid, embedding = pool_patches(
+            np.zeros(len(fg_index), dtype=np.int64), grid,
+            embedding[fg_index, :], pooling)
+        patch_embedding['grid'] = grid
         patch_embedding['embedding'] = embedding
-    with open(args.save_fg_pipeline, 'wb') as fp:
-        joblib.dump(fg_pipeline, fp)
-
-
-async def get_embedding(session, url, info):
-    async with session.post(url, json={'image_path':
-                                       info['image_path']}) as response:
-        embedding_info = await response.json()
-        embedding_info['embedding'] = np.asarray(embedding_info['embedding'])
-        return embedding_info
-
-
-async def generate_embedding(args, img_info: List[str]):
-    db = create_vector_db(db_file=args.db_file)
-    image_embedding_url = f'{args.embedding_url}:{args.embedding_port}{IMAGE_EMBEDDING_API}'
-    patch_embedding_url = f'{args.embedding_url}:{args.embedding_port}{PATCH_EMBEDDING_API}'
-    async with aiohttp.ClientSession() as session:
-        image_tasks = [
-            get_embedding(session, image_embedding_url, info)
-            for info in img_info
-        ]
-        image_embedding_results = await asyncio.gather(*image_tasks)
-        patch_tasks = [
-            get_embedding(session, patch_embedding_url, info)
-            for info in img_info
+        patch_embedding['patch_size'] *= pooling
+
+
+# done images map image_id -> md5 hash of the embedded content; None for rows
+# written before hashes were stored, which are matched by image_id only
+
+
+def load_checkpoint(checkpoint_file: str):
+    if not Path(checkpoint_file).exists():
+        return {}
+    with open(checkpoint_file) as fp:
+        rows = [json.loads(line) for line in fp if line.strip()]
+    return {row['image_id']: row.get('md5_hash') for row in rows}
+
+
+def update_checkpoint(checkpoint_file: str, img_info: List[dict]):
+    with open(checkpoint_file, 'a') as fp:
+        for info in img_info:
+            fp.write(
+                json.dumps({
+                    'image_id': info['image_id'],
+                    'md5_hash': info['md5_hash']
+                }) + '\n')
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def indexed_image_hashes(db: MilvusClient):
+    has_hash = IMAGE_HASH_FIELD in collection_fields(db, 'image_embeddings')
+    output_fields = ['image_id', *([IMAGE_HASH_FIELD] if has_hash else [])]
+    image_hashes = {}
+    for rows in query_rows(db, 'image_embeddings', output_fields):
+        image_hashes.update(
+            (row['image_id'], row.get(IMAGE_HASH_FIELD)) for row in rows)
+    return image_hashes
+
+
+def numpy_image_hashes(index_dir: Path):
+    image_ids = np.load(index_dir / IMAGE_IDS_FILE).tolist()
+    if not (index_dir / IMAGE_HASHES_FILE).exists():
+        return dict.fromkeys(image_ids)
+    image_hashes = np.load(index_dir / IMAGE_HASHES_FILE).tolist()
+    return {
+        image_id: image_hash or None
+        for image_id, image_hash in zip(image_ids, image_hashes)
+    }
+
+
+async def get_embeddings(session, semaphore, url, img_info: List[dict]):
+    # results stream back one frame per image as the service finishes them
+    frames = []
+    async with semaphore, session.post(
+            url,
+            json={'image_paths': [info['image_path'] for info in img_info]},
+            headers={'Accept':
+                     accept_header(args.embedding_format)}) as response:
+        response.raise_for_status()
+        decoder = FrameDecoder(response.headers['Content-Type'])
+        async for data in response.content.iter_any():
+            frames.extend(decoder.feed(data))
+    assert len(frames) == len(img_info), 'incomplete embedding stream'
+    return sorted(frames, key=lambda frame: frame['index'])
+
+
+async def embed_chunk(session, semaphore, img_info: List[dict]):
+    embedding_url = f'{args.embedding_url}:{args.embedding_port}{EMBEDDING_API}'
+    # one load and forward pass per image returns both embeddings
+    batches = await asyncio.gather(*[
+        get_embeddings(session, semaphore, embedding_url,
+                       img_info[start:start + args.request_batch_size])
+        for start in range(0, len(img_info), args.request_batch_size)
+    ])
+    embedded_info, patch_embedding_results = [], []
+    for info, frame in zip(img_info, sum(batches, [])):
+        if 'error' in frame:
+            # failed images are not checkpointed and are retried next run
+            logger.warning(f'Skip image {info["image_id"]}: {frame["error"]}')
+            continue
+        embedded_info.append(info)
+        patch_embedding_results.append(frame)
+    image_embedding_results = [
+        dict(embedding=result.pop('image_embedding'))
+        for result in patch_embedding_results
+    ]
+    return embedded_info, image_embedding_results, patch_embedding_results
+
+
+def fg_sample_file():
+    path = Path(args.save_fg_pipeline)
+    return path.with_name(f'{path.stem}.sample.npz')
+
+
+async def fit_fg_model(session, semaphore, img_info: List[dict],
+                       num_images: int,
+                       fg_model: Optional[ForegroundModel]):
+    # a sampling pass before any row is written, so that one model filters
+    # every patch of the run and is the model published with the index.
+    # Images are sampled at the catalog-wide rate of --fg-fit-images per
+    # num_images: an incremental run adds its new images to the reservoir
+    # of the previous runs in proportion and refits
+    num_fit = min(
+        len(img_info),
+        max(1, round(args.fg_fit_images * len(img_info) / num_images)))
+    rng = np.random.default_rng(0)
+    sample = [
+        img_info[i]
+        for i in np.sort(rng.choice(len(img_info), num_fit, replace=False))
+    ]
+    fg_estimator = ForegroundEstimator.load(fg_sample_file()) if (
+        fg_model is not None) else ForegroundEstimator(
+            sample_size=args.fg_sample_size)
+    num_seen = fg_estimator.num_seen
+    # the sampled images are written from these embeddings by the main pass
+    embedded = [], [], []
+    for start in range(0, len(sample), args.chunk_size):
+        results = await embed_chunk(session, semaphore,
+                                    sample[start:start + args.chunk_size])
+        for result in results[2]:
+            fg_estimator.partial_fit(result['embedding'])
+        for fit_results, chunk_results in zip(embedded, results):
+            fit_results.extend(chunk_results)
+    if fg_estimator.num_seen == num_seen:
+        if fg_model is None:
+            raise RuntimeError(
+                f'none of the {len(sample)} images sampled to fit the '
+                'foreground model could be embedded')
+        logger.warning(f'None of the {len(sample)} sampled images could be '
+                       'embedded, keep the previous foreground model')
+        return fg_model, sample, embedded
+    fg_model = fg_estimator.fit_model()
+    fg_model.save(args.save_fg_pipeline)
+    fg_estimator.save(fg_sample_file())
+    return fg_model, sample, embedded
+
+
+async def embed_chunks(session,
+                       semaphore,
+                       img_info: List[dict],
+                       embedded: Optional[tuple] = None):
+    # images already embedded by the foreground sampling pass come first
+    if embedded is not None:
+        yield embedded
+    for start in range(0, len(img_info), args.chunk_size):
+        chunk = img_info[start:start + args.chunk_size]
+        yield (len(chunk), *await embed_chunk(session, semaphore, chunk))
+
+
+class IndexSinks:
+
+    def __init__(self, db, index_writer):
+        self.db = db
+        self.index_writer = index_writer
+        # collections created before hashes were stored keep their schema
+        self.store_hashes = db is not None and IMAGE_HASH_FIELD in (
+            collection_fields(db, 'image_embeddings'))
+        if db is not None and not self.store_hashes:
+            logger.warning('image_embeddings has no md5_hash field: changed '
+                           'images are not detected until the collections '
+                           'are rebuilt')
+        self.inserters = dict(
+            image=MilvusBulkInserter(db,
+                                     'image_embeddings',
+                                     batch_size=args.insert_batch_size),
+            patch=MilvusBulkInserter(
+                db,
+                'patch_embeddings',
+                batch_size=args.insert_batch_size,
+                vector_dtype=np.float16
+                if args.patch_storage == 'float16' else np.float32)
+        ) if db is not None else {}
+        self.num_buffered = 0
+
+    def delete(self, image_ids: List[str]):
+        if self.db is None:
+            return
+        image_filter = f'image_id in {json.dumps(image_ids)}'
+        self.db.delete('image_embeddings', filter=image_filter)
+        self.db.delete('patch_embeddings', filter=image_filter)
+
+    def add(self, image_ids: List[str], image_hashes: List[str],
+            image_embedding: np.ndarray, image_meta: np.ndarray,
+            patch_image_ids: List[str], patch_embedding: np.ndarray,
+            patch_grid: np.ndarray):
+        if self.inserters:
+            fields = dict(zip(IMAGE_META_FIELDS, image_meta.T))
+            if self.store_hashes:
+                fields[IMAGE_HASH_FIELD] = image_hashes
+            self.inserters['image'].add(image_ids,
+                                        image_embedding,
+                                        fields=fields)
+            self.inserters['patch'].add(patch_image_ids,
+                                        patch_embedding,
+                                        fields=dict(
+                                            zip(PATCH_GRID_FIELDS,
+                                                patch_grid.T)))
+        if self.index_writer is not None:
+            self.index_writer.add_images(image_ids,
+                                         image_embedding,
+                                         image_meta,
+                                         image_hashes=image_hashes)
+            self.index_writer.add_patches(patch_image_ids, patch_embedding,
+                                          patch_grid)
+        self.num_buffered += len(patch_image_ids) + len(image_ids)
+
+    def flush(self):
+        for inserter in self.inserters.values():
+            inserter.flush()
+        if self.inserters:
+            # inserted rows are searchable right away; the numpy index
+            # publishes its version when it is closed
+            write_index_version(
+                index_version_file('milvus',
+                                   db_file=args.db_file,
+                                   version_file=args.index_version_file))
+        if self.index_writer is not None:
+            self.index_writer.flush()
+        self.num_buffered = 0
+
+    def close(self, fg_model_file: Optional[str] = None):
+        self.flush()
+        if self.db is not None:
+            build_indexes(self.db, rebuild=args.rebuild_index)
+        if self.index_writer is not None:
+            return self.index_writer.close(fg_model_file=fg_model_file)
+        return None
+
+
+class ShardedSinks:
+    # images are partitioned by a hash of their id; every shard has its own
+    # Milvus DB and / or NumPy index
+
+    def __init__(self, shards: List[IndexSinks]):
+        self.shards = shards
+
+    @property
+    def num_buffered(self):
+        return sum(shard.num_buffered for shard in self.shards)
+
+    def delete(self, image_ids: List[str]):
+        shards = shard_of(image_ids, len(self.shards))
+        for index in np.unique(shards):
+            self.shards[index].delete(
+                np.asarray(image_ids)[shards == index].tolist())
+
+    def add(self, image_ids: List[str], image_hashes: List[str],
+            image_embedding: np.ndarray, image_meta: np.ndarray,
+            patch_image_ids: List[str], patch_embedding: np.ndarray,
+            patch_grid: np.ndarray):
+        image_shards = shard_of(image_ids, len(self.shards))
+        patch_shards = shard_of(patch_image_ids, len(self.shards))
+        image_ids, image_hashes, patch_image_ids = np.asarray(
+            image_ids), np.asarray(image_hashes), np.asarray(patch_image_ids,
+                                                              dtype=str)
+        for index in np.unique(image_shards):
+            image_rows = image_shards == index
+            patch_rows = patch_shards == index
+            self.shards[index].add(image_ids[image_rows].tolist(),
+                                   image_hashes[image_rows].tolist(),
+                                   image_embedding[image_rows],
+                                   image_meta[image_rows],
+                                   patch_image_ids[patch_rows].tolist(),
+                                   patch_embedding[patch_rows],
+                                   patch_grid[patch_rows])
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self, fg_model_file: Optional[str] = None):
+        shard_versions = [
+            shard.close(fg_model_file=fg_model_file) for shard in self.shards
         ]
-        patch_embedding_results = await asyncio.gather(*patch_tasks)
-
-    process_patch_embeddings(patch_embedding_results)
-    for info, img_embedding, patch_embedding in zip(img_info,
-                                                    image_embedding_results,
-                                                    patch_embedding_results):
-        image_id = info['image_id']
-        db.insert('image_embeddings', {
-            'embedding': img_embedding.pop('embedding'),
-            'image_id': image_id
-        })
-        db.insert('patch_embeddings', [{
-            'embedding': embedding,
-            'image_id': image_id
-        } for embedding in patch_embedding['embedding']])
-    logger.info(f'Generate {len(img_info)} images embedding')
+        if len(self.shards) > 1 and 'numpy' in args.index_format:
+            # recommenders swap once every shard has written its version,
+            # and load exactly the shard versions of this run
+            write_shard_manifest(args.index_dir, shard_versions)
+
+
+def write_chunk(sinks: ShardedSinks, img_info: List[dict],
+                image_embedding_results: List[dict],
+                patch_embedding_results: List[dict], replaced: Set[str]):
+    image_ids = [info['image_id'] for info in img_info]
+    if args.resume:
+        # a chunk re-run after an interruption replaces its partial rows
+        sinks.delete(image_ids)
+    elif replaced:
+        # rows of images whose content changed since they were indexed
+        sinks.delete([image_id for image_id in image_ids
+                      if image_id in replaced])
+    image_embedding = np.stack(
+        [result['embedding'] for result in image_embedding_results])
+    image_meta = np.asarray(
+        [[*result['image_shape'], result['patch_size']]
+         for result in patch_embedding_results],
+        dtype=np.int32)
+    patch_embedding, patch_grid = [
+        np.concatenate([result[key] for result in patch_embedding_results])
+        for key in ('embedding', 'grid')
+    ]
+    patch_image_ids = [
+        image_id for image_id, result in zip(image_ids,
+                                             patch_embedding_results)
+        for _ in range(len(result['embedding']))
+    ]
+    sinks.add(image_ids, [info['md5_hash'] for info in img_info],
+              image_embedding, image_meta, patch_image_ids, patch_embedding,
+              patch_grid.astype(np.int16))
+
+
+def pending_images(dbs: list, img_info: List[dict]):
+    # an image is done when it is indexed (or checkpointed) with its current
+    # content; indexed images whose content changed are re-embedded and their
+    # old rows replaced
+    indexed: Dict[str, Optional[str]] = {}
+    if args.incremental:
+        for db in dbs:
+            indexed.update(indexed_image_hashes(db))
+        for shard in range(args.num_shards):
+            index_dir, _ = resolve_index_dir(
+                shard_index_dir(args.index_dir, shard, args.num_shards))
+            if 'numpy' in args.index_format and (index_dir /
+                                                 IMAGE_IDS_FILE).exists():
+                indexed.update(numpy_image_hashes(index_dir))
+    done = dict(indexed)
+    if args.resume:
+        done.update(load_checkpoint(args.checkpoint_file))
+    elif Path(args.checkpoint_file).exists():
+        os.remove(args.checkpoint_file)
+
+    def is_done(info: dict):
+        if info['image_id'] not in done:
+            return False
+        md5_hash = done[info['image_id']]
+        return md5_hash is None or md5_hash == info['md5_hash']
+
+    pending = [info for info in img_info if not is_done(info)]
+    replaced = {info['image_id'] for info in pending} & set(indexed)
+    logger.info(f'{len(pending)} of {len(img_info)} images to embed, '
+                f'{len(replaced)} of them changed '
+                f'({len(done)} already indexed or checkpointed)')
+    return pending, replaced
+
+
+async def generate_embedding(args, img_info: List[dict]):
+    keep_existing = args.resume or args.incremental
+    shards = []
+    for shard in range(args.num_shards):
+        db = create_vector_db(
+            db_file=shard_db_file(args.db_file, shard, args.num_shards),
+            reset=not keep_existing) if 'milvus' in args.index_format else None
+        index_writer = NumpyIndexWriter(
+            index_dir=shard_index_dir(args.index_dir, shard, args.num_shards),
+            embedding_size=args.embedding_size,
+            resume=args.resume,
+            append=args.incremental,
+            patch_storage=args.patch_storage,
+            pq_subvectors=args.pq_subvectors
+        ) if 'numpy' in args.index_format else None
+        shards.append(IndexSinks(db, index_writer))
+    sinks = ShardedSinks(shards)
+    pending, replaced = pending_images(
+        [shard.db for shard in shards if shard.db is not None], img_info)
+    fg_model = ForegroundModel.load(args.save_fg_pipeline) if (
+        keep_existing and Path(args.save_fg_pipeline).exists()) else None
+    # a resumed run keeps the model that filtered its written rows; an
+    # incremental run updates the saved reservoir with its new images
+    fit_fg = pending and (fg_model is None or (
+        args.incremental and not args.resume and fg_sample_file().exists()))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    start_time, num_done, unflushed = time.perf_counter(), 0, []
+    async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=args.http_timeout),
+            connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+        sampled, fitted = set(), None
+        if fit_fg:
+            fg_model, sample, fitted = await fit_fg_model(
+                session, semaphore, pending, len(img_info), fg_model)
+            sampled = {info['image_id'] for info in sample}
+            fitted = (len(sample), *fitted)
+        chunks = embed_chunks(
+            session, semaphore,
+            [info for info in pending if info['image_id'] not in sampled],
+            fitted)
+        async for num_images, *results in chunks:
+            embedded, image_embedding_results, patch_embedding_results = results
+            process_patch_embeddings(fg_model,
+                                     patch_embedding_results,
+                                     pooling=args.patch_pooling)
+            if embedded:
+                write_chunk(sinks, embedded, image_embedding_results,
+                            patch_embedding_results, replaced)
+            unflushed.extend(embedded)
+            # images are checkpointed only once their rows are written
+            if sinks.num_buffered >= args.insert_batch_size:
+                sinks.flush()
+                update_checkpoint(args.checkpoint_file, unflushed)
+                unflushed = []
+            num_done += num_images
+            logger.info(f'Embedded {num_done}/{len(pending)} images '
+                        f'({num_done / (time.perf_counter() - start_time):.1f}'
+                        ' images/s)')
+
+    sinks.flush()
+    update_checkpoint(args.checkpoint_file, unflushed)
+    # a numpy index version carries the foreground model it was built with
+    sinks.close(fg_model_file=args.save_fg_pipeline)
+    if Path(args.checkpoint_file).exists():
+        os.remove(args.checkpoint_file)
+    logger.info(f'Generate {num_done} images embedding')
 
 
 if __name__ == '__main__':
     args = arg_parse()
     img_info = [
-        image.to_query() for image in Image.objects.filter(source='example')
+        image.to_query()
+        for image in Image.objects.filter(source='example').order_by('id')
     ]
     asyncio.run(generate_embedding(args=args, img_info=img_info))
@@ -0,0 +1,111 @@
+import sys
+
+sys.path.insert(0, '.')
+
+import os
+
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'image_recommender.settings'
+django.setup()
+
+import asyncio
+import time
+from argparse import ArgumentParser
+from typing import List
+
+import aiohttp
+import numpy as np
+from loguru import logger
+
+from image.models import Image
+
+
+def arg_parse():
+    parser = ArgumentParser()
+    parser.add_argument('--url',
+                        type=str,
+                        default='http://127.0.0.1:8002/recommend-image/')
+    parser.add_argument('--num-clients', type=int, default=50)
+    parser.add_argument('--requests-per-client', type=int, default=20)
+    parser.add_argument('--num-images', type=int, default=200)
+    parser.add_argument('--focus-ratio', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def build_queries(num_queries: int, rng: np.random.Generator):
+    images = list(
+        Image.objects.filter(source='example').order_by('?')[:args.num_images])
+    assert images, 'no example images in the database'
+    queries = []
+    for image_index in rng.integers(0, len(images), num_queries):
+        image = images[image_index]
+        query_info = image.to_query()
+        coords_info = None
+        if rng.random() < args.focus_ratio:
+            # a random box covering 20-60% of each side of a 1000x1000 view
+            width, height = rng.uniform(200, 600, 2)
+            x1, y1 = rng.uniform(0, 1000 - width), rng.uniform(0, 1000 - height)
+            coords_info = dict(x1=x1,
+                               y1=y1,
+                               x2=x1 + width,
+                               y2=y1 + height,
+                               width=1000,
+                               height=1000)
+        queries.append(
+            dict(image_path=query_info['image_path'],
+                 image_id=query_info['image_id'],
+                 image_hash=image.md5_hash,
+                 coords_info=coords_info))
+    return queries
+
+
+async def run_client(session: aiohttp.ClientSession, queries: List[dict],
+                     latencies: List[float], errors: List[str]):
+    for query in queries:
+        start = time.perf_counter()
+        try:
+            async with session.post(args.url, json=query) as response:
+                response.raise_for_status()
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            errors.append(repr(error))
+
+
+async def run_load_test(queries: List[dict]):
+    latencies, errors = [], []
+    async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=args.timeout),
+            connector=aiohttp.TCPConnector(limit=args.num_clients)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            run_client(session, queries[client::args.num_clients], latencies,
+                       errors) for client in range(args.num_clients)
+        ])
+        elapsed = time.perf_counter() - start
+    return elapsed, np.asarray(latencies), errors
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    queries = build_queries(args.num_clients * args.requests_per_client, rng)
+    elapsed, latencies, errors = asyncio.run(run_load_test(queries))
+    for error in sorted(set(errors))[:5]:
+        logger.warning(f'Request failed: {error}')
+    if not len(latencies):
+        logger.error(f'All {len(errors)} requests failed')
+        return
+    logger.info(f'clients: {args.num_clients} requests: {len(queries)} '
+                f'errors: {len(errors)} '
+                f'throughput: {len(latencies) / elapsed:.1f} req/s '
+                f'latency p50: {np.percentile(latencies, 50) * 1000:.1f} ms '
+                f'p95: {np.percentile(latencies, 95) * 1000:.1f} ms '
+                f'p99: {np.percentile(latencies, 99) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
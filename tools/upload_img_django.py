@@ -11,19 +11,45 @@ from django.core.files import File
 os.environ['DJANGO_SETTINGS_MODULE'] = 'image_recommender.settings'
 django.setup()
 
+import hashlib
+import io
+import time
+import uuid
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from typing import Optional
 
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
 from loguru import logger
+from PIL import Image as PILImage
 
 from image.models import Image
 
 IMG_EXT = ('*.jpg', '*.jpeg', '*.JPG', '*.PNG', '*.png')
+IMG_SUFFIXES = ('.jpg', '.jpeg', '.png')
 
 
 def arg_parse():
     parser = ArgumentParser()
     parser.add_argument('--img-dir', type=str)
+    parser.add_argument('--mode',
+                        type=str,
+                        default='bulk',
+                        choices=('bulk', 'create'),
+                        help='create: one Image.objects.create per file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--io-workers', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--thumbnail-size',
+                        type=int,
+                        default=0,
+                        help='longest side of a stored JPEG thumbnail, e.g. '
+                        '256; 0 (default) stores no thumbnail')
+    parser.add_argument('--source', type=str, default='example')
     return parser.parse_args()
 
 
@@ -39,8 +65,148 @@ def upload_images(img_dir: Path):
                 image.save()
                 img_cnt += 1
     logger.info(f'Upload {img_cnt} images')
+    return img_cnt
+
+
+def find_images(img_dir: Path):
+    # one walk of the tree for every extension
+    for root, _, file_names in os.walk(img_dir):
+        for file_name in sorted(file_names):
+            if file_name.lower().endswith(IMG_SUFFIXES):
+                yield Path(root) / file_name
+
+
+def hash_image(img_file: Path):
+    return img_file, hashlib.md5(img_file.read_bytes()).hexdigest()
+
+
+def make_thumbnail(img_file: Path, thumbnail_size: int):
+    # runs in a worker process: decoding rejects broken files before they
+    # are stored, and the decode is reused for the JPEG thumbnail
+    try:
+        with PILImage.open(img_file) as img:
+            if not thumbnail_size:
+                img.verify()
+                return None, None
+            img.draft('RGB', (thumbnail_size, thumbnail_size))
+            img = img.convert('RGB')
+            img.thumbnail((thumbnail_size, thumbnail_size))
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=85)
+            return buffer.getvalue(), None
+    except Exception as error:
+        return None, repr(error)
+
+
+def batched(iterable, batch_size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def new_images(hashes: list, seen: set):
+    # one query for the whole batch instead of one per file
+    known = set(
+        Image.objects.filter(
+            md5_hash__in=[md5_hash for _, md5_hash in hashes]).values_list(
+                'md5_hash', flat=True)) | seen
+    new = []
+    for img_file, md5_hash in hashes:
+        if md5_hash not in known:
+            known.add(md5_hash)
+            new.append((img_file, md5_hash))
+    seen.update(md5_hash for _, md5_hash in hashes)
+    return new
+
+
+def store_files(image: Image, img_file: Path, thumbnail: Optional[bytes]):
+    with open(img_file, 'rb') as f:
+        image.image.save(img_file.name, File(f), save=False)
+    if thumbnail is not None:
+        image.thumbnail.save(f'{img_file.stem}.jpg',
+                             ContentFile(thumbnail),
+                             save=False)
+
+
+def delete_files(image: Image):
+    image.image.delete(save=False)
+    if image.thumbnail:
+        image.thumbnail.delete(save=False)
+
+
+def insert_images(new: list, thumbnails: list,
+                  io_executor: ThreadPoolExecutor, source: str):
+    now = timezone.now()
+    images = [
+        Image(id=uuid.uuid4(),
+              md5_hash=md5_hash,
+              source=source,
+              created_date=now,
+              modified_date=now) for _, md5_hash in new
+    ]
+    # storage writes (local disk or GCS) overlap on a thread pool; rows are
+    # only inserted once every file of the batch is stored
+    list(
+        io_executor.map(store_files, images,
+                        [img_file for img_file, _ in new], thumbnails))
+    with transaction.atomic():
+        Image.objects.bulk_create(images, ignore_conflicts=True)
+    # rows skipped on conflict (a hash inserted by a concurrent upload since
+    # new_images) must not leave their stored files behind
+    inserted = set(
+        Image.objects.filter(id__in=[image.id for image in images
+                                     ]).values_list('id', flat=True))
+    rejected = [image for image in images if image.id not in inserted]
+    list(io_executor.map(delete_files, rejected))
+    return len(inserted)
+
+
+def bulk_upload_images(img_dir: Path,
+                       source: str = 'example',
+                       workers: Optional[int] = None,
+                       io_workers: int = 8,
+                       batch_size: int = 512,
+                       thumbnail_size: int = 0):
+    num_files = num_uploaded = num_failed = 0
+    seen = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=io_workers) as io_executor:
+        for img_files in batched(find_images(img_dir), batch_size):
+            num_files += len(img_files)
+            new = new_images(
+                list(executor.map(hash_image, img_files, chunksize=16)), seen)
+            results = executor.map(make_thumbnail,
+                                   [img_file for img_file, _ in new],
+                                   [thumbnail_size] * len(new),
+                                   chunksize=4)
+            readable, thumbnails = [], []
+            for (img_file, md5_hash), (thumbnail, error) in zip(new, results):
+                if error is not None:
+                    logger.warning(f'Skip {img_file}: {error}')
+                    num_failed += 1
+                    continue
+                readable.append((img_file, md5_hash))
+                thumbnails.append(thumbnail)
+            num_uploaded += insert_images(readable, thumbnails, io_executor,
+                                          source)
+    logger.info(f'Upload {num_uploaded} images, skip '
+                f'{num_files - num_uploaded - num_failed} known, '
+                f'{num_failed} unreadable')
+    return num_files
 
 
 if __name__ == '__main__':
     args = arg_parse()
-    upload_images(img_dir=args.img_dir)
+    start = time.perf_counter()
+    if args.mode == 'bulk':
+        num_files = bulk_upload_images(img_dir=args.img_dir,
+                                       source=args.source,
+                                       workers=args.workers,
+                                       io_workers=args.io_workers,
+                                       batch_size=args.batch_size,
+                                       thumbnail_size=args.thumbnail_size)
+    else:
+        num_files = upload_images(img_dir=args.img_dir)
+    elapsed = time.perf_counter() - start
+    logger.info(f'{args.mode}: {num_files} files in {elapsed:.1f}s, '
+                f'{num_files / elapsed:.1f} files/s')